@@ -0,0 +1,579 @@
+#!/usr/bin/env python3
+#
+# This file is part of git-big-picture
+#
+# git-big-picture is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# git-big-picture is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with git-big-picture.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for git-big-picture.
+
+Usage::
+
+    $ python3 benchmark.py refs --counts 10000 100000 1000000
+    $ python3 benchmark.py pipeline --commits 100000 --branches 200 --tags 1000
+    $ python3 benchmark.py pipeline --save-baseline benchmark-baseline.json
+    $ python3 benchmark.py kernels --commits 1000000 4000000
+    $ python3 benchmark.py rank-hints --commits 1000 10000 50000
+    $ python3 benchmark.py ids --commits 200000 1000000
+
+"""
+
+import argparse
+import ast
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import git_big_picture._main as gbp
+
+DEFAULT_REF_COUNTS = [10_000, 100_000, 1_000_000]
+
+DEFAULT_RANK_HINTS_COMMIT_COUNTS = [1_000, 10_000, 50_000]
+
+DEFAULT_KERNEL_COMMIT_COUNTS = [1_000_000, 2_000_000, 4_000_000]
+
+DEFAULT_ID_COMMIT_COUNTS = [200_000, 1_000_000]
+
+# kernels and what they compute, roots, merges and bifurcations together like filter does
+KERNELS = {
+    "roots, merges, bifurcations": lambda graph: (graph.roots, graph.merges, graph.bifurcations),
+    "_minimal_sha_one_digits": lambda graph: graph._minimal_sha_one_digits(),
+}
+
+DEFAULT_BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "benchmark-baseline.json"
+)
+
+PIPELINE_STAGES = [
+    "get_mappings",
+    "get_parent_map",
+    "CommitGraph",
+    "filter",
+    "_minimal_sha_one_digits",
+    "_generate_dot_file",
+    "_generate_dot_file (rank hints)",
+    "render (native)",
+    "render (dot)",
+    "render (dot, rank hints)",
+]
+
+
+def git(argv, repo_dir):
+    return subprocess.check_output(["git"] + argv, cwd=repo_dir).decode("utf-8").strip()
+
+
+def create_repository_with_refs(repo_dir, ref_count):
+    """Create a repository with a single commit and ref_count refs pointing to it.
+
+    The refs are written to file packed-refs directly because creating a million
+    refs through git itself would take longer than the benchmark itself.
+    Two fifths are local branches, the rest is split evenly between remote
+    branches, lightweight tags and annotated tags.
+    """
+    git(["init", "-q", "-b", "master"], repo_dir)
+    git(["config", "user.name", "git-big-picture"], repo_dir)
+    git(["config", "user.email", "git-big-picture@example.org"], repo_dir)
+    git(["commit", "-q", "--allow-empty", "-m", "benchmark"], repo_dir)
+    commit = git(["rev-parse", "HEAD"], repo_dir)
+    git(["tag", "-m", "benchmark", "annotated"], repo_dir)
+    tag_object = git(["rev-parse", "annotated"], repo_dir)
+    git(["tag", "-d", "annotated"], repo_dir)
+
+    fifth = ref_count // 5
+    local_branch_count = ref_count - 3 * fifth
+    digits = len(str(ref_count))
+
+    with open(os.path.join(repo_dir, ".git", "packed-refs"), "w") as f:
+        f.write("# pack-refs with: peeled fully-peeled sorted \n")
+        for i in range(local_branch_count):
+            f.write(f"{commit} refs/heads/branch-{i:0{digits}}\n")
+        for i in range(fifth):
+            f.write(f"{commit} refs/remotes/origin/branch-{i:0{digits}}\n")
+        for i in range(fifth):
+            f.write(f"{tag_object} refs/tags/annotated-{i:0{digits}}\n")
+            f.write(f"^{commit}\n")
+        for i in range(fifth):
+            f.write(f"{commit} refs/tags/lightweight-{i:0{digits}}\n")
+
+
+def generate_fast_import_stream(
+    commit_count, branch_count, tag_count, merge_density, tag_nesting, seed
+):
+    """Yield a git fast-import stream describing a synthetic history.
+
+    Commits are distributed over branch_count lines of development, each
+    new line forking off a random existing commit. A commit merges the head
+    of another line with probability merge_density. Tags point to random
+    commits and every tag_nesting-th of them is annotated, with annotated
+    tags being tagged again tag_nesting - 1 times. Identical parameters
+    yield identical streams, and hence identical commit hashes.
+    """
+    rng = random.Random(seed)
+    branch_count = max(1, branch_count)
+    head_of_branch = {}
+    for mark in range(1, commit_count + 1):
+        branch = 0 if mark == 1 else rng.randrange(branch_count)
+        refname = "refs/heads/master" if branch == 0 else f"refs/heads/branch-{branch}"
+        yield f"commit {refname}\nmark :{mark}\n"
+        yield f"committer Benchmark <benchmark@example.org> {mark} +0000\n"
+        yield f"data <<EOT\nCommit {mark}\nEOT\n"
+        if branch in head_of_branch:
+            yield f"from :{head_of_branch[branch]}\n"
+        elif mark > 1:
+            yield f"from :{rng.randrange(1, mark)}\n"
+        others = [head for other, head in head_of_branch.items() if other != branch]
+        if others and rng.random() < merge_density:
+            yield f"merge :{rng.choice(others)}\n"
+        yield "\n"
+        head_of_branch[branch] = mark
+
+    mark = commit_count
+    for i in range(tag_count):
+        target = rng.randrange(1, commit_count + 1)
+        if tag_nesting < 1 or i % max(1, tag_nesting):
+            yield f"reset refs/tags/lightweight-{i}\nfrom :{target}\n\n"
+            continue
+        for level in range(tag_nesting):
+            mark += 1
+            name = f"annotated-{i}" if level == 0 else f"nested-{i}-{level}"
+            yield f"tag {name}\nmark :{mark}\nfrom :{target}\n"
+            yield f"tagger Benchmark <benchmark@example.org> {commit_count} +0000\n"
+            yield f"data <<EOT\nTag {name}\nEOT\n\n"
+            target = mark
+
+
+def create_repository_with_history(repo_dir, **parameters):
+    """Create a repository from generate_fast_import_stream(**parameters)."""
+    git(["init", "-q", "-b", "master"], repo_dir)
+    process = subprocess.Popen(
+        ["git", "fast-import", "--quiet"], cwd=repo_dir, stdin=subprocess.PIPE
+    )
+    with io.TextIOWrapper(process.stdin, encoding="utf-8") as stdin:
+        for chunk in generate_fast_import_stream(**parameters):
+            stdin.write(chunk)
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, "git fast-import")
+
+
+def time_pipeline(repo_dir, repeat):
+    """Return the best time of each of PIPELINE_STAGES in a dict.
+
+    Stage "render (dot)" is missing if Graphviz is not installed.
+    """
+    timings = {}
+
+    def stage(name, function, *args):
+        result = None
+        best = None
+        for _ in range(repeat):
+            before = time.perf_counter()
+            result = function(*args)
+            elapsed = time.perf_counter() - before
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+        return result
+
+    repo = gbp.Git(repo_dir)
+    (_, _, branches), (tags, _, _) = stage("get_mappings", repo.get_mappings)
+    parents = stage("get_parent_map", repo.get_parent_map)
+    graph = stage("CommitGraph", gbp.CommitGraph, parents, branches, tags, repo)
+    graph = stage("filter", graph.filter)
+    digits = stage("_minimal_sha_one_digits", graph._minimal_sha_one_digits)
+    dot_file_lines = stage(
+        "_generate_dot_file",
+        lambda: graph._generate_dot_file(
+            sha_ones_on_labels=False, with_commit_messages=False, sha_one_digits=digits
+        ),
+    )
+    rank_hinted_dot_file_lines = stage(
+        "_generate_dot_file (rank hints)",
+        lambda: graph._generate_dot_file(
+            sha_ones_on_labels=False,
+            with_commit_messages=False,
+            sha_one_digits=digits,
+            rank_hints=True,
+        ),
+    )
+    stage(
+        "render (native)",
+        lambda: graph._write_svg(
+            io.BytesIO(),
+            sha_ones_on_labels=False,
+            with_commit_messages=False,
+            sha_one_digits=digits,
+        ),
+    )
+    if shutil.which("dot") is not None:
+        stage("render (dot)", gbp.run_dot, "svg", dot_file_lines)
+        stage("render (dot, rank hints)", gbp.run_dot, "svg", rank_hinted_dot_file_lines)
+    return timings
+
+
+def benchmark_pipeline(parameters, repeat, baseline_file, save_baseline_file):
+    repo_dir = tempfile.mkdtemp(prefix="gbp-benchmark-")
+    try:
+        before = time.perf_counter()
+        create_repository_with_history(repo_dir, **parameters)
+        print(f"Created repository in {time.perf_counter() - before:.3f}s: {parameters}")
+        timings = time_pipeline(repo_dir, repeat)
+    finally:
+        shutil.rmtree(repo_dir)
+
+    baseline = {}
+    if baseline_file is not None and os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            stored = json.load(f)
+        if stored["parameters"] == parameters:
+            baseline = stored["timings"]
+        else:
+            print(f"Ignoring baseline {baseline_file} created with {stored['parameters']}")
+
+    print(f"{'stage':<32}  {'time':>9}  {'baseline':>9}  {'ratio':>6}")
+    for name in PIPELINE_STAGES:
+        if name not in timings:
+            continue
+        line = f"{name:<32}  {timings[name]:>8.3f}s"
+        if name in baseline:
+            ratio = timings[name] / baseline[name] if baseline[name] else float("inf")
+            line += f"  {baseline[name]:>8.3f}s  {ratio:>5.2f}x"
+        print(line)
+
+    if save_baseline_file is not None:
+        with open(save_baseline_file, "w") as f:
+            json.dump({"parameters": parameters, "timings": timings}, f, indent=4)
+            f.write("\n")
+
+
+def benchmark_rank_hints(commit_counts, merge_density, seed, repeat):
+    """Compare the time dot takes to lay out graphs with and without rank hints.
+
+    Merges and bifurcations are kept by the filter, so that graphs grow
+    with history rather than with the number of refs.
+    """
+    if shutil.which("dot") is None:
+        raise SystemExit("Graphviz is not installed, cannot benchmark rank hints")
+    print(f"{'commits':>10}  {'nodes':>8}  {'edges':>8}  {'dot':>9}  {'hinted':>9}  {'ratio':>6}")
+    for commit_count in commit_counts:
+        repo_dir = tempfile.mkdtemp(prefix="gbp-benchmark-")
+        try:
+            create_repository_with_history(
+                repo_dir,
+                commit_count=commit_count,
+                branch_count=max(1, commit_count // 200),
+                tag_count=commit_count // 50,
+                merge_density=merge_density,
+                tag_nesting=0,
+                seed=seed,
+            )
+            graph = gbp.graph_factory(repo_dir).filter(merges=True, bifurcations=True)
+        finally:
+            shutil.rmtree(repo_dir)
+        timings = []
+        for rank_hints in (False, True):
+            dot_file_lines = graph._generate_dot_file(
+                sha_ones_on_labels=False,
+                with_commit_messages=False,
+                sha_one_digits=graph._minimal_sha_one_digits(),
+                rank_hints=rank_hints,
+            )
+            timings.append(best_of(repeat, gbp.run_dot, "svg", dot_file_lines))
+        plain, hinted = timings
+        print(
+            f"{commit_count:>10}  {len(graph.parents):>8}  {graph.edge_count:>8}"
+            f"  {plain:>8.3f}s  {hinted:>8.3f}s  {plain / hinted:>5.2f}x"
+        )
+
+
+def generate_parent_map(commit_count, merge_density, seed):
+    """Return a parent map of a synthetic linear history with random merges.
+
+    Building it in memory rather than through git keeps multi-million
+    commit histories affordable.
+    """
+    rng = random.Random(seed)
+    sha_ones = [f"{rng.getrandbits(160):040x}" for _ in range(commit_count)]
+    parents = {}
+    for i, sha_one in enumerate(sha_ones):
+        parent_sha_ones = set(sha_ones[i + 1 : i + 2])
+        if i + 2 < commit_count and rng.random() < merge_density:
+            parent_sha_ones.add(sha_ones[rng.randrange(i + 2, commit_count)])
+        parents[sha_one] = parent_sha_ones
+    return parents
+
+
+def benchmark_kernels(commit_counts, merge_density, seed, repeat):
+    """Compare the pure Python and NumPy implementations of KERNELS."""
+    if gbp.numpy is None:
+        print("NumPy is not installed, timing pure Python only")
+    print(f"{'commits':>10}  {'kernel':<28}  {'python':>9}  {'numpy':>9}  {'ratio':>6}")
+    for commit_count in commit_counts:
+        graph = gbp.CommitGraph(generate_parent_map(commit_count, merge_density, seed), {}, {})
+
+        def run(kernel, vectorize_min_commits):
+            gbp.VECTORIZE_MIN_COMMITS = vectorize_min_commits
+            graph._commit_arrays = None
+            return KERNELS[kernel](graph)
+
+        for kernel in KERNELS:
+            python = best_of(repeat, run, kernel, float("inf"))
+            line = f"{commit_count:>10}  {kernel:<28}  {python:>8.3f}s"
+            if gbp.numpy is not None:
+                if run(kernel, 0) != run(kernel, float("inf")):
+                    raise AssertionError(f"NumPy and pure Python disagree on {kernel}")
+                vectorized = best_of(repeat, run, kernel, 0)
+                line += f"  {vectorized:>8.3f}s  {python / vectorized:>5.1f}x"
+            print(line)
+
+
+def traced_memory(function, *args):
+    """Return the memory held by the result of function, in bytes."""
+    tracemalloc.start()
+    try:
+        result = function(*args)  # noqa: F841
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_ids(commit_counts, merge_density, seed):
+    """Compare the memory of parent maps with ids as hex strings and as raw bytes.
+
+    Either way, every commit id is a single object, shared by all mentions.
+    """
+    print(f"{'commits':>10}  {'hex str':>9}  {'bytes':>9}  {'ratio':>6}")
+    for commit_count in commit_counts:
+        hex_parents = generate_parent_map(commit_count, merge_density, seed)
+
+        def copy_with(convert):
+            known = {}
+
+            def intern(sha_one):
+                if sha_one not in known:
+                    known[sha_one] = convert(sha_one)
+                return known[sha_one]
+
+            return {intern(c): {intern(p) for p in ps} for c, ps in hex_parents.items()}
+
+        hex_memory = traced_memory(copy_with, lambda sha_one: bytes.fromhex(sha_one).hex())
+        bytes_memory = traced_memory(copy_with, bytes.fromhex)
+        print(
+            f"{commit_count:>10}  {hex_memory / 1e6:>7.1f}MB  {bytes_memory / 1e6:>7.1f}MB"
+            f"  {hex_memory / bytes_memory:>5.2f}x"
+        )
+
+
+def legacy_parse_refs(repo_dir):
+    """Parse refs the way get_mappings did before, i.e. using ast.literal_eval.
+
+    Tags are not dereferenced, so this is a lower bound of the former cost.
+    """
+    ref_format = "[%(objectname), %(*objectname), %(objecttype), %(refname)]"
+    output = git(["for-each-ref", f"--format={ref_format}", "--python"], repo_dir)
+    for ref_info in output.splitlines():
+        ast.literal_eval(ref_info)
+
+
+def best_of(repeat, function, *args):
+    timings = []
+    for _ in range(repeat):
+        before = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - before)
+    return min(timings)
+
+
+def benchmark_ref_loading(ref_counts, repeat):
+    print(f"{'refs':>10}  {'for-each-ref':>12}  {'get_mappings':>12}  {'legacy parse':>12}")
+    for ref_count in ref_counts:
+        repo_dir = tempfile.mkdtemp(prefix="gbp-benchmark-")
+        try:
+            create_repository_with_refs(repo_dir, ref_count)
+            repo = gbp.Git(repo_dir)
+            raw = best_of(repeat, git, ["for-each-ref", f"--format={gbp.REF_FORMAT}"], repo_dir)
+            mappings = best_of(repeat, repo.get_mappings)
+            legacy = best_of(repeat, legacy_parse_refs, repo_dir)
+        finally:
+            shutil.rmtree(repo_dir)
+        print(f"{ref_count:>10}  {raw:>11.3f}s  {mappings:>11.3f}s  {legacy:>11.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for git-big-picture")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    refs_parser = subparsers.add_parser("refs", help="benchmark loading of refs")
+    refs_parser.add_argument(
+        "--counts",
+        type=int,
+        nargs="+",
+        default=DEFAULT_REF_COUNTS,
+        metavar="COUNT",
+        help="numbers of refs to benchmark with (default: %(default)s)",
+    )
+    refs_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of runs to take the best time of (default: %(default)s)",
+    )
+
+    pipeline_parser = subparsers.add_parser(
+        "pipeline", help="benchmark every stage of the pipeline on a synthetic history"
+    )
+    pipeline_parser.add_argument(
+        "--commits", type=int, default=10_000, help="number of commits (default: %(default)s)"
+    )
+    pipeline_parser.add_argument(
+        "--branches", type=int, default=50, help="number of branches (default: %(default)s)"
+    )
+    pipeline_parser.add_argument(
+        "--tags", type=int, default=200, help="number of tags (default: %(default)s)"
+    )
+    pipeline_parser.add_argument(
+        "--merge-density",
+        type=float,
+        default=0.1,
+        help="probability of a commit being a merge (default: %(default)s)",
+    )
+    pipeline_parser.add_argument(
+        "--tag-nesting",
+        type=int,
+        default=2,
+        help="every N-th tag is annotated and nested N levels deep, 0 for"
+        " lightweight tags only (default: %(default)s)",
+    )
+    pipeline_parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the history generator (default: %(default)s)"
+    )
+    pipeline_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of runs to take the best time of (default: %(default)s)",
+    )
+    pipeline_parser.add_argument(
+        "--baseline",
+        default=DEFAULT_BASELINE_FILE,
+        metavar="FILE",
+        help="baseline to compare with, if created with the same parameters"
+        " (default: %(default)s)",
+    )
+    pipeline_parser.add_argument(
+        "--save-baseline", metavar="FILE", help="store the results as baseline in FILE"
+    )
+
+    kernels_parser = subparsers.add_parser(
+        "kernels", help="compare pure Python and NumPy graph kernels on synthetic histories"
+    )
+    kernels_parser.add_argument(
+        "--commits",
+        type=int,
+        nargs="+",
+        default=DEFAULT_KERNEL_COMMIT_COUNTS,
+        metavar="COUNT",
+        help="numbers of commits to benchmark with (default: %(default)s)",
+    )
+    kernels_parser.add_argument(
+        "--merge-density",
+        type=float,
+        default=0.1,
+        help="probability of a commit being a merge (default: %(default)s)",
+    )
+    kernels_parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the history generator (default: %(default)s)"
+    )
+    kernels_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of runs to take the best time of (default: %(default)s)",
+    )
+
+    rank_hints_parser = subparsers.add_parser(
+        "rank-hints", help="compare dot layout time with and without --rank-hints"
+    )
+    rank_hints_parser.add_argument(
+        "--commits",
+        type=int,
+        nargs="+",
+        default=DEFAULT_RANK_HINTS_COMMIT_COUNTS,
+        metavar="COUNT",
+        help="numbers of commits to benchmark with (default: %(default)s)",
+    )
+    rank_hints_parser.add_argument(
+        "--merge-density",
+        type=float,
+        default=0.1,
+        help="probability of a commit being a merge (default: %(default)s)",
+    )
+    rank_hints_parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the history generator (default: %(default)s)"
+    )
+    rank_hints_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of runs to take the best time of (default: %(default)s)",
+    )
+
+    ids_parser = subparsers.add_parser(
+        "ids", help="compare memory of parent maps with hex string and raw bytes ids"
+    )
+    ids_parser.add_argument(
+        "--commits",
+        type=int,
+        nargs="+",
+        default=DEFAULT_ID_COMMIT_COUNTS,
+        metavar="COUNT",
+        help="numbers of commits to benchmark with (default: %(default)s)",
+    )
+    ids_parser.add_argument(
+        "--merge-density",
+        type=float,
+        default=0.1,
+        help="probability of a commit being a merge (default: %(default)s)",
+    )
+    ids_parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the history generator (default: %(default)s)"
+    )
+
+    opts = parser.parse_args()
+
+    if opts.benchmark == "refs":
+        benchmark_ref_loading(opts.counts, opts.repeat)
+    elif opts.benchmark == "pipeline":
+        parameters = {
+            "commit_count": opts.commits,
+            "branch_count": opts.branches,
+            "tag_count": opts.tags,
+            "merge_density": opts.merge_density,
+            "tag_nesting": opts.tag_nesting,
+            "seed": opts.seed,
+        }
+        benchmark_pipeline(parameters, opts.repeat, opts.baseline, opts.save_baseline)
+    elif opts.benchmark == "rank-hints":
+        benchmark_rank_hints(opts.commits, opts.merge_density, opts.seed, opts.repeat)
+    elif opts.benchmark == "kernels":
+        benchmark_kernels(opts.commits, opts.merge_density, opts.seed, opts.repeat)
+    elif opts.benchmark == "ids":
+        benchmark_ids(opts.commits, opts.merge_density, opts.seed)
+
+
+if __name__ == "__main__":
+    main()
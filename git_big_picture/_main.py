@@ -21,17 +21,37 @@
 # along with git-big-picture.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-import ast
+import concurrent.futures
+import contextlib
 import copy
 import errno
+import fnmatch
+import hashlib
+import io
+import json
 import os
 import re
 import signal
+import stat
 import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
 import time
+import tracemalloc
+import weakref
+from xml.sax.saxutils import escape as xml_escape
+
+try:
+    import numpy
+except ImportError:  # optional, see class _CommitArrays
+    numpy = None
+
+try:
+    import sqlite3
+except ImportError:  # not built into every Python, see class SubjectStore
+    sqlite3 = None
 
 __version__ = "1.3.0"
 __docformat__ = "restructuredtext"
@@ -44,6 +64,13 @@ VIEWER = "viewer"
 OUT_FILE = "outfile"
 WAIT_SECONDS = "wait"
 SIMPLIFY = "simplify"
+MAX_NODES = "maxnodes"
+MAX_EDGES = "maxedges"
+LARGE_GRAPH_POLICY = "largegraph"
+RENDERER = "renderer"
+RANK_HINTS = "rankhints"
+FSYNC = "fsync"
+LAYOUT_JOBS = "layoutjobs"
 OUTPUT_SETTINGS = [
     FORMAT,
     GRAPHVIZ,
@@ -52,6 +79,13 @@ OUTPUT_SETTINGS = [
     OUT_FILE,
     WAIT_SECONDS,
     SIMPLIFY,
+    MAX_NODES,
+    MAX_EDGES,
+    LARGE_GRAPH_POLICY,
+    RENDERER,
+    RANK_HINTS,
+    FSYNC,
+    LAYOUT_JOBS,
 ]
 OUTPUT_DEFAULTS = {
     FORMAT: "svg",
@@ -61,6 +95,96 @@ OUTPUT_DEFAULTS = {
     OUT_FILE: False,
     WAIT_SECONDS: 2.0,
     SIMPLIFY: False,
+    MAX_NODES: 10_000,
+    MAX_EDGES: 50_000,
+    LARGE_GRAPH_POLICY: "warn",
+    RENDERER: "graphviz",
+    RANK_HINTS: False,
+    FSYNC: False,
+    LAYOUT_JOBS: 1,
+}
+
+# how to turn the graph into an image
+RENDERERS = [
+    "graphviz",  # lay out and render using the Graphviz "dot" utility
+    "native",  # lay out by generation and write SVG without Graphviz
+]
+
+# formats of option --export
+EXPORT_FORMATS = [
+    "jsonl",  # JSON Lines, one record per node and per edge
+    "binary",  # interned node ids and varint encoded edges
+]
+
+# start of files in binary export format, followed by the format version
+BINARY_EXPORT_MAGIC = b"GBP"
+BINARY_EXPORT_VERSION = 1
+
+# units of --ref-max-age
+AGE_UNIT_SECONDS = {
+    "h": 60 * 60,
+    "d": 24 * 60 * 60,
+    "w": 7 * 24 * 60 * 60,
+    "y": 365 * 24 * 60 * 60,
+}
+
+# number of commits from which CommitGraph uses NumPy, if installed
+VECTORIZE_MIN_COMMITS = 50_000
+
+# number of sorted ids compared at once when calculating their unique prefix length
+PREFIX_CHUNK_SIZE = 1 << 20
+
+# identification of the JSON files written by --save-snapshot
+SNAPSHOT_FORMAT = "git-big-picture-snapshot"
+SNAPSHOT_VERSION = 1
+
+# number of trailing bytes of stderr of child processes kept for error messages
+STDERR_TAIL_BYTES = 64 * 1024
+
+# directory within the Git directory to cache submodule graphs and commit subjects in
+CACHE_DIR = "big-picture-cache"
+
+# number of commits to ask 'git log' for at once
+SUBJECTS_PER_GIT_LOG = 1000
+
+# file within CACHE_DIR to keep commit subjects in across runs
+SUBJECT_STORE_FILE = "subjects.sqlite3"
+
+# number of commit subjects kept by SubjectStore, oldest are dropped first
+SUBJECT_STORE_MAX_ENTRIES = 1_000_000
+
+# number of commits to look up in SubjectStore at once, within SQLite's limit
+SUBJECT_STORE_BATCH_SIZE = 500
+
+# seconds to wait for other processes writing to SubjectStore
+SUBJECT_STORE_TIMEOUT_SECONDS = 10.0
+
+# what to do about graphs exceeding MAX_NODES or MAX_EDGES
+LARGE_GRAPH_POLICIES = [
+    "refuse",  # abort
+    "warn",  # render anyway
+    "simplify",  # render with --simplify
+    "sfdp",  # render using the cheaper "sfdp" layout engine
+    "no-labels",  # render commits without refs as points
+]
+
+# settings limited to a fixed set of values
+CHOICES_OF_SETTING = {
+    LARGE_GRAPH_POLICY: LARGE_GRAPH_POLICIES,
+    RENDERER: RENDERERS,
+}
+
+# settings that are not plain strings or booleans
+TYPE_OF_SETTING = {
+    WAIT_SECONDS: float,
+    MAX_NODES: int,
+    MAX_EDGES: int,
+    LAYOUT_JOBS: int,
+}
+
+# settings that are numbers with a lower bound
+MIN_OF_SETTING = {
+    LAYOUT_JOBS: 0,
 }
 
 # filter settings
@@ -107,10 +231,45 @@ EXIT_CODES = {
     "tred_not_found": 11,
     "problem_with_tred": 12,
     "tred_terminated_early": 13,
+    "graph_too_large": 14,
+    "not_supported_by_renderer": 15,
+    "export_others": 16,
+    "no_such_revision": 17,
+    "bad_snapshot": 18,
+    "unsupported_object_format": 19,
     "killed_by_sigint": 128 + signal.SIGINT,
 }
 
-sha1_pattern = re.compile("[0-9a-fA-F]{40}")
+# number of hex digits of object ids, by output of "git rev-parse --show-object-format"
+OBJECT_ID_DIGITS = {
+    "sha1": 40,
+    "sha256": 64,
+}
+
+# NOTE: Fields are separated by NUL bytes because those can neither occur
+#       in ref names nor in any of the other fields.
+REF_FORMAT = "%00".join(
+    [
+        "%(objectname)",
+        "%(*objectname)",
+        "%(objecttype)",
+        "%(*objecttype)",
+        "%(committerdate:unix)",
+        "%(*committerdate:unix)",
+        "%(refname)",
+    ]
+)
+REF_FIELD_SEPARATOR = "\0"
+
+# ref kinds
+LOCAL_BRANCH = "local branch"
+REMOTE_BRANCH = "remote branch"
+TAG = "tag"
+REF_KIND_OF_PREFIX = {
+    "refs/heads/": LOCAL_BRANCH,
+    "refs/remotes/": REMOTE_BRANCH,
+    "refs/tags/": TAG,
+}
 
 # https://graphviz.org/doc/info/attrs.html#k:rankdir
 # NOTE: "left to right" to a human is "right to left" to Graphviz; same for top and bottom
@@ -121,6 +280,44 @@ RANKDIR_OF_HISTORY_DIRECTION = {
     "upwards": "TB",
 }
 
+# https://graphviz.org/doc/info/colors.html#brewer (i.e. "/pastel13/1" to "/pastel13/3")
+PASTEL13_COLORS = {
+    1: "#fbb4ae",
+    2: "#b3cde3",
+    3: "#ccebc5",
+}
+
+# outline of the refs containing the commit given to --contains
+HIGHLIGHT_COLOR = "red"
+HIGHLIGHT_PEN_WIDTH = 3
+
+# geometry of the native renderer, in pixels
+SVG_CHAR_WIDTH = 7
+SVG_LINE_HEIGHT = 16
+SVG_FONT_SIZE = 14
+SVG_NODE_PADDING = 12
+SVG_NODE_SEPARATION = 16
+SVG_RANK_SEPARATION = 48
+SVG_MARGIN = 8
+
+# formats of option --timings
+TIMINGS_FORMATS = [
+    "table",
+    "json",  # JSON Lines
+]
+
+# when option --progress reports progress
+PROGRESS_MODES = [
+    "auto",  # only if stderr is a terminal
+    "always",
+]
+
+# seconds between two updates of the progress report
+PROGRESS_INTERVAL_SECONDS = 0.5
+
+# number of items counted between two looks at the clock
+PROGRESS_CHECK_EVERY = 4096
+
 DEBUG = False
 
 USAGE = "%(prog)s OPTIONS [REPOSITORY]"
@@ -163,6 +360,23 @@ def create_parser():
         help="enforce a specific direction of history on Graphviz\n(default: %(default)s)",
     )
 
+    format_group.add_argument(
+        "--renderer",
+        dest=RENDERER,
+        choices=RENDERERS,
+        help="\n".join(
+            textwrap.wrap(
+                'render using the Graphviz "dot" utility, or natively'
+                " by laying out commits in layers by generation and"
+                " writing SVG directly, which is much faster for very"
+                " large graphs but supports neither other formats"
+                " nor simplification"
+                f" (default: {OUTPUT_DEFAULTS[RENDERER]})",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
     format_group.add_argument(
         "--simplify",
         action="store_true",
@@ -170,6 +384,97 @@ def create_parser():
         'filter "tred" (default: do not remove implied edges)',
     )
 
+    format_group.add_argument(
+        "--rank-hints",
+        default=None,
+        action="store_true",
+        dest=RANK_HINTS,
+        help="\n".join(
+            textwrap.wrap(
+                "put commits of the same generation, i.e. with the same"
+                " longest distance to a root commit, on the same rank"
+                " (default: let Graphviz rank commits)",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
+    format_group.add_argument(
+        "--layout-jobs",
+        type=parse_count,
+        dest=LAYOUT_JOBS,
+        metavar="COUNT",
+        help="\n".join(
+            textwrap.wrap(
+                "lay out unconnected parts of the graph, e.g. orphan branches"
+                ", in up to COUNT Graphviz processes in parallel and pack"
+                " the results into one image, using 0 for the number of"
+                f" CPUs (default: {OUTPUT_DEFAULTS[LAYOUT_JOBS]})",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
+    format_group.add_argument(
+        "--max-nodes",
+        type=int,
+        dest=MAX_NODES,
+        metavar="COUNT",
+        help="consider graphs with more than COUNT nodes too large\n"
+        f"to render as usual (default: {OUTPUT_DEFAULTS[MAX_NODES]})",
+    )
+    format_group.add_argument(
+        "--max-edges",
+        type=int,
+        dest=MAX_EDGES,
+        metavar="COUNT",
+        help="consider graphs with more than COUNT edges too large\n"
+        f"to render as usual (default: {OUTPUT_DEFAULTS[MAX_EDGES]})",
+    )
+    format_group.add_argument(
+        "--on-large-graph",
+        dest=LARGE_GRAPH_POLICY,
+        choices=LARGE_GRAPH_POLICIES,
+        help="\n".join(
+            textwrap.wrap(
+                "what to do about graphs that are too large before"
+                " rendering them: refuse to render them, warn,"
+                " remove implied edges as with --simplify,"
+                ' switch to Graphviz layout engine "sfdp"'
+                ", or render commits without refs as unlabeled points"
+                f" (default: {OUTPUT_DEFAULTS[LARGE_GRAPH_POLICY]})",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
+    format_group.add_argument(
+        "--export",
+        dest="export_format",
+        choices=EXPORT_FORMATS,
+        help="\n".join(
+            textwrap.wrap(
+                "write the graph as a list of nodes and edges to stdout"
+                " or to the file given by -o, either as JSON Lines or in"
+                " compact binary form, instead of using Graphviz",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
+    format_group.add_argument(
+        "--save-snapshot",
+        dest="snapshot_outfile",
+        metavar="FILE",
+        help="\n".join(
+            textwrap.wrap(
+                "save the refs and the filtered graph to FILE, for use with"
+                " --diff-snapshot later; no other output option is needed",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
     format_group.add_argument(
         "-g",
         "--graphviz",
@@ -231,6 +536,20 @@ def create_parser():
         dest=OUT_FILE,
         help="disable writing image to file",
     )
+    format_group.add_argument(
+        "--fsync",
+        default=None,
+        action="store_true",
+        dest=FSYNC,
+        help="\n".join(
+            textwrap.wrap(
+                "flush the output file to disk before putting it in place,"
+                " so that it survives a crash of the system"
+                " (default: leave that to the operating system)",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
 
     format_group.add_argument(
         "-w",
@@ -357,6 +676,110 @@ def create_parser():
         help="do not include bifurcation commits",
     )
 
+    filter_group.add_argument(
+        "--ref-max-age",
+        type=parse_age,
+        dest="ref_max_age",
+        metavar="AGE",
+        help="\n".join(
+            textwrap.wrap(
+                "do not show branches and tags pointing to commits with a"
+                " committer date older than AGE, e.g. '90d'; units are h, d,"
+                " w and y (default: d)",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
+    filter_group.add_argument(
+        "--hide-merged",
+        nargs="?",
+        const="HEAD",
+        dest="hide_merged_rev",
+        metavar="REF",
+        help="\n".join(
+            textwrap.wrap(
+                "do not show branches that have been merged into REF"
+                " (default: HEAD), i.e. that point to an ancestor of it",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
+    filter_group.add_argument(
+        "--submodules",
+        action="store_true",
+        dest="submodules",
+        help="\n".join(
+            textwrap.wrap(
+                "include the initialized submodules of the repository,"
+                " recursively, each as a cluster of its own; graphs of"
+                " submodules are collected in parallel and cached in the"
+                f" Git directory (in {CACHE_DIR}/) until their"
+                " refs change",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
+    filter_group.add_argument(
+        "--collapse",
+        action="append",
+        default=[],
+        dest="collapse_patterns",
+        metavar="PATTERN",
+        help="\n".join(
+            textwrap.wrap(
+                "fold all branches and all tags matching shell pattern"
+                " PATTERN, e.g. 'nightly-*', into a single branch or tag"
+                " on the newest of their commits; can be given multiple times",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+    filter_group.add_argument(
+        "--collapse-tag-runs",
+        action="store_true",
+        dest="collapse_tag_runs",
+        help="\n".join(
+            textwrap.wrap(
+                "fold the tags of commits on a linear chain that no branch"
+                " points to into a single tag on the newest of these commits,"
+                " also across commits without any refs in between",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
+    filter_group.add_argument(
+        "--contains",
+        dest="contains_rev",
+        metavar="REV",
+        help="\n".join(
+            textwrap.wrap(
+                "highlight the branches and tags that contain commit REV,"
+                " i.e. that REV is reachable from, and list them (on stdout"
+                " if no output option is given, on stderr otherwise)",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
+    filter_group.add_argument(
+        "--diff-snapshot",
+        dest="snapshot_infile",
+        metavar="FILE",
+        help="\n".join(
+            textwrap.wrap(
+                "show only the branches and tags added, moved or deleted"
+                " since the snapshot in FILE was saved, together with their"
+                " nearest interesting ancestors; labels are suffixed with"
+                " (new), (moved), (old) or (deleted)",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
     filter_group.add_argument(
         "-c",
         "--commit-messages",
@@ -382,6 +805,70 @@ def create_parser():
         help="run cProfile profiler writing pstats output to FILE",
     )
 
+    parser.add_argument(
+        "--timings",
+        nargs="?",
+        const="table",
+        choices=TIMINGS_FORMATS,
+        dest="timings_format",
+        help="\n".join(
+            textwrap.wrap(
+                "write wall clock time and CPU time spent in each phase"
+                " of the run to stderr, as a table or as JSON Lines"
+                " (default format: table)",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
+    parser.add_argument(
+        "--progress",
+        nargs="?",
+        const="auto",
+        choices=PROGRESS_MODES,
+        dest="progress_mode",
+        help="\n".join(
+            textwrap.wrap(
+                "report the current phase, commits parsed, refs loaded and"
+                " commits filtered, with their rates, on stderr while running,"
+                " if stderr is a terminal or, with mode always, regardless"
+                " (default mode: auto)",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
+    parser.add_argument(
+        "--process-log",
+        dest="process_log_file",
+        metavar="FILE",
+        help="\n".join(
+            textwrap.wrap(
+                "write argv, wall clock time, bytes read and written and exit"
+                " status of each child process to FILE as JSON Lines",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
+    parser.add_argument(
+        "--memstats",
+        nargs="?",
+        const=5,
+        type=int,
+        dest="memstats_top_count",
+        metavar="COUNT",
+        help="\n".join(
+            textwrap.wrap(
+                "write traced Python memory and resident set size at the end"
+                " of each phase of the run to stderr, along with the COUNT"
+                " sites that allocated the most memory in that phase"
+                " (default: 5)",
+                width=_RIGHT_COLUMN_WRAP_WIDTH,
+            )
+        ),
+    )
+
     parser.add_argument(
         "-d", "--debug", action="store_true", dest="debug", help="activate debug output"
     )
@@ -410,6 +897,8 @@ def barf(message, exit_code):
         exit code for program
 
     """
+    if PROGRESS is not None:
+        PROGRESS.finish()
     sys.stderr.write("fatal: %s\n" % message)
     sys.exit(exit_code)
 
@@ -423,6 +912,8 @@ def warn(message):
         the warning
 
     """
+    if PROGRESS is not None:
+        PROGRESS.finish()
     sys.stderr.write("warning: %s\n" % message)
 
 
@@ -439,80 +930,567 @@ def debug(message):
         sys.stdout.write("debug:   %s\n" % message)
 
 
-def parse_variable_args(args):
-    """Parse arguments and get repo_dir.
-
-    Parameters
-    ----------
-    args : list
-        arguments given on command line
+class Timings:
+    """Wall clock and CPU time spent in each phase of a run.
 
-    Returns
-    -------
-    repo_dir : path
-        path to the repo_dir
+    CPU time is recorded separately for this process and for terminated
+    child processes (i.e. git and Graphviz). Time spent in a phase that
+    is entered multiple times adds up. CPU time is only known per process,
+    so it is not reported for phases that ran at the same time as a phase
+    of another thread; these phases are marked as concurrent instead.
 
     """
-    if len(args) > 1:
-        barf("Too many arguments: %s" % args, EXIT_CODES["too_many_args"])
-    return args[0] if len(args) == 1 else os.getcwd()
 
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.concurrent = set()
+        self._running = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Record the time spent in the body of the with statement."""
+        running = (name, threading.get_ident())
+        with self._lock:
+            others = {n for n, thread in self._running if thread != running[1]}
+            if others:
+                self.concurrent |= others | {name}
+            self._running.append(running)
+        times_before, wall_before = os.times(), time.perf_counter()
+        try:
+            yield
+        finally:
+            times_after, wall_after = os.times(), time.perf_counter()
+            with self._lock:
+                self._running.remove(running)
+            wall, cpu, child_cpu = self.phases.get(name, (0.0, 0.0, 0.0))
+            self.phases[name] = (
+                wall + wall_after - wall_before,
+                cpu
+                + (times_after.user + times_after.system)
+                - (times_before.user + times_before.system),
+                child_cpu
+                + (times_after.children_user + times_after.children_system)
+                - (times_before.children_user + times_before.children_system),
+            )
 
-def run_graphviz_command(
-    argv: list[str],
-    stdin_lines: list[str],
-    enoent_exit_code: int,
-    nonzero_exit_code: int,
-    exception_exit_code: int,
-    hint: str = "",
-):
-    tool = argv[0]
-    try:
-        p = subprocess.Popen(
-            argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-    except OSError as e:
-        if e.errno == errno.ENOENT:
-            barf(f"{tool!r} not found! Please install the Graphviz utility.", enoent_exit_code)
+    def report(self, timings_format):
+        """Write all phases and the total wall clock time to stderr.
+
+        Parameters
+        ----------
+        timings_format : string
+            one of TIMINGS_FORMATS
+
+        """
+        total = time.perf_counter() - self.started
+        if timings_format == "json":
+            for name, (wall, cpu, child_cpu) in self.phases.items():
+                concurrent = name in self.concurrent
+                record = {
+                    "phase": name,
+                    "wall_seconds": round(wall, 6),
+                    "cpu_seconds": None if concurrent else round(cpu, 6),
+                    "child_cpu_seconds": None if concurrent else round(child_cpu, 6),
+                    "concurrent": concurrent,
+                }
+                sys.stderr.write(json.dumps(record) + "\n")
+            sys.stderr.write(
+                json.dumps({"phase": "total", "wall_seconds": round(total, 6)}) + "\n"
+            )
         else:
-            barf(f"A problem occurred calling {' '.join(argv)!r}", exception_exit_code)
+            sys.stderr.write(f"{'phase':<20} {'wall':>9} {'cpu':>9} {'child cpu':>9}\n")
+            for name, (wall, cpu, child_cpu) in self.phases.items():
+                if name in self.concurrent:
+                    sys.stderr.write(
+                        f"{name:<20} {wall:>8.3f}s {'n/a':>9} {'n/a':>9} (concurrent)\n"
+                    )
+                else:
+                    sys.stderr.write(f"{name:<20} {wall:>8.3f}s {cpu:>8.3f}s {child_cpu:>8.3f}s\n")
+            sys.stderr.write(f"{'total':<20} {total:>8.3f}s\n")
 
-    out, err = p.communicate(input="\n".join(stdin_lines).encode("utf-8"))
 
-    if p.returncode != 0:
-        hint_part = f";\n{hint}" if hint else ""
-        barf(
-            f"{tool!r} terminated prematurely with error code {p.returncode}{hint_part}.\n"
-            f"The error from {tool!r} was:\n"
-            f">>>{err.decode('utf-8')}",
-            nonzero_exit_code,
-        )
+class MemStats:
+    """Memory in use at the end of each phase of a run, and its peak.
 
-    return out
+    Python allocations are traced using tracemalloc, which has to be
+    started beforehand. Each phase is reported to stderr as soon as it
+    ends, so that the report interleaves with debug output.
 
+    """
 
-def run_dot(output_format, dot_file_lines):
-    """Run the 'dot' utility.
+    def __init__(self, top_count):
+        self.top_count = top_count
 
-    Parameters
-    ----------
-    output_format : string
-        format of output [svg, png, ps, pdf, ...]
-    dot_file_lines : list of strings
-        graphviz input lines
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Report memory used by the body of the with statement."""
+        tracemalloc.reset_peak()
+        snapshot_before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot_after = tracemalloc.take_snapshot()
+            rss_current, rss_peak = get_rss()
+            sys.stderr.write(
+                f"memstats: {name}: traced {format_size(current)}"
+                f" (peak {format_size(peak)}),"
+                f" RSS {format_size(rss_current)} (peak {format_size(rss_peak)})\n"
+            )
+            ignored = [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen *>"),
+            ]
+            differences = snapshot_after.filter_traces(ignored).compare_to(
+                snapshot_before.filter_traces(ignored), "lineno"
+            )
+            for statistic in differences[: self.top_count]:
+                if statistic.size_diff <= 0:
+                    break
+                frame = statistic.traceback[0]
+                sys.stderr.write(
+                    f"memstats:   {format_size(statistic.size_diff):>10}"
+                    f" {frame.filename}:{frame.lineno}\n"
+                )
 
-    Returns
-    -------
-    Raw output from 'dot' utility
+
+class Progress:
+    """Progress of a run, reported on stderr while it goes on.
+
+    The report names the phases in progress and, for each counter, the
+    number of items counted so far and their rate.  On a terminal a single
+    status line is rewritten in place, otherwise a line is appended per
+    update; either way at most every PROGRESS_INTERVAL_SECONDS.
 
     """
-    return run_graphviz_command(
-        argv=["dot", f"-T{output_format}"],
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.in_place = stream.isatty()
+        self.phases = []
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._next_update = 0.0
+
+    @contextlib.contextmanager
+    def in_phase(self, name):
+        """Report phase name as in progress in the body of the with statement."""
+        self.phases.append(name)
+        self.update(force=True)
+        try:
+            yield
+        finally:
+            self.phases.remove(name)
+
+    def iterate(self, name, iterable, check_every=PROGRESS_CHECK_EVERY):
+        """Yield the items of iterable, counting them as name.
+
+        Items are counted in batches of check_every, so that the clock is
+        only looked at once per batch.
+        """
+        # count, seconds spent counting before, start of counting now
+        counter = self.counters.setdefault(name, [0, 0.0, None])
+        counter[2] = time.perf_counter()
+        uncounted = 0
+        for item in iterable:
+            uncounted += 1
+            if uncounted == check_every:
+                counter[0] += uncounted
+                uncounted = 0
+                self.update()
+            yield item
+        counter[0] += uncounted
+        counter[1] += time.perf_counter() - counter[2]
+        counter[2] = None
+        self.update()
+
+    def update(self, force=False):
+        """Write the report, unless written less than an interval ago."""
+        now = time.perf_counter()
+        if now < self._next_update and not force:
+            return
+        with self._lock:
+            self._next_update = now + PROGRESS_INTERVAL_SECONDS
+            parts = []
+            for name, (count, seconds, started) in list(self.counters.items()):
+                if started is not None:
+                    seconds += now - started
+                rate = count / seconds if seconds > 0 else 0.0
+                parts.append(f"{count:,} {name} ({rate:,.0f}/s)")
+            line = f"progress: {', '.join(self.phases) or 'starting'}"
+            if parts:
+                line += ": " + ", ".join(parts)
+            if self.in_place:
+                self.stream.write(f"\r{line}\x1b[K")
+            else:
+                self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def finish(self):
+        """Remove the status line from the terminal."""
+        if self.in_place:
+            self.stream.write("\r\x1b[K")
+            self.stream.flush()
+
+
+def format_size(size):
+    """Format a number of bytes for humans, or "n/a" for None."""
+    if size is None:
+        return "n/a"
+    for unit in ["B", "KiB", "MiB"]:
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def get_rss():
+    """Return current and peak resident set size in bytes.
+
+    Either may be None where the operating system does not tell.
+
+    """
+    try:
+        import resource
+    except ImportError:  # e.g. on Windows
+        rss_peak = None
+    else:
+        # NOTE: ru_maxrss is in bytes on macOS but in KiB elsewhere
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            rss_peak *= 1024
+    try:
+        with open("/proc/self/statm") as f:
+            rss_current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        rss_current = None
+    else:
+        # NOTE: ru_maxrss may lag behind by a few pages
+        if rss_peak is not None:
+            rss_peak = max(rss_peak, rss_current)
+    return rss_current, rss_peak
+
+
+class ProcessLog:
+    """Accounting of the child processes launched during a run."""
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, argv, started, bytes_read, bytes_written, exit_status):
+        """Record a terminated child process.
+
+        Parameters
+        ----------
+        argv : list of strings
+            the command and its arguments
+        started : float
+            time.perf_counter() right before launching the process
+        bytes_read : int
+            number of bytes read from its stdout
+        bytes_written : int
+            number of bytes written to its stdin
+        exit_status : int
+            its exit status
+
+        """
+        self.records.append(
+            {
+                "argv": list(argv),
+                "wall_seconds": round(time.perf_counter() - started, 6),
+                "bytes_read": bytes_read,
+                "bytes_written": bytes_written,
+                "exit_status": exit_status,
+            }
+        )
+
+    def totals(self):
+        """Return a dict mapping each program to count, wall time, bytes read and written."""
+        totals = {}
+        for record in self.records:
+            program = os.path.basename(record["argv"][0])
+            count, wall, bytes_read, bytes_written = totals.get(program, (0, 0.0, 0, 0))
+            totals[program] = (
+                count + 1,
+                wall + record["wall_seconds"],
+                bytes_read + record["bytes_read"],
+                bytes_written + record["bytes_written"],
+            )
+        return totals
+
+    def summary(self):
+        """Return a one-line summary, e.g. "214 git processes (3.100s)"."""
+        return ", ".join(
+            f"{count} {program} process{'es' if count != 1 else ''} ({wall:.3f}s)"
+            for program, (count, wall, _, _) in self.totals().items()
+        )
+
+    def report(self, timings_format):
+        """Write totals per program to stderr.
+
+        Parameters
+        ----------
+        timings_format : string
+            one of TIMINGS_FORMATS
+
+        """
+        if timings_format == "json":
+            for program, (count, wall, bytes_read, bytes_written) in self.totals().items():
+                record = {
+                    "program": program,
+                    "count": count,
+                    "wall_seconds": round(wall, 6),
+                    "bytes_read": bytes_read,
+                    "bytes_written": bytes_written,
+                }
+                sys.stderr.write(json.dumps(record) + "\n")
+        else:
+            sys.stderr.write(
+                f"{'program':<20} {'count':>9} {'wall':>9} {'read':>11} {'written':>11}\n"
+            )
+            for program, (count, wall, bytes_read, bytes_written) in self.totals().items():
+                sys.stderr.write(
+                    f"{program:<20} {count:>9} {wall:>8.3f}s"
+                    f" {format_size(bytes_read):>11} {format_size(bytes_written):>11}\n"
+                )
+
+    def write_records(self, f):
+        """Write a JSON Lines record for each child process to text file f."""
+        for record in self.records:
+            f.write(json.dumps(record) + "\n")
+
+
+class _CountingReader(io.RawIOBase):
+    """Raw stream counting the bytes read from an underlying binary stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.stream.readinto(buffer)
+        self.bytes_read += count
+        return count
+
+
+TIMINGS = Timings()
+MEMSTATS = None
+PROCESSES = ProcessLog()
+PROGRESS = None
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Account the body of the with statement to phase name.
+
+    Time is always recorded, memory only if --memstats was given, and
+    progress is only reported if --progress was given.
+
+    """
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(TIMINGS.phase(name))
+        if MEMSTATS is not None:
+            stack.enter_context(MEMSTATS.phase(name))
+        if PROGRESS is not None:
+            stack.enter_context(PROGRESS.in_phase(name))
+        yield
+
+
+def progress(name, iterable, check_every=PROGRESS_CHECK_EVERY):
+    """Count the items of iterable as progress counter name, see Progress.
+
+    Without --progress, iterable is returned as is, at no cost.
+
+    """
+    if PROGRESS is None:
+        return iterable
+    return PROGRESS.iterate(name, iterable, check_every)
+
+
+def parse_age(text):
+    """Parse an age like "90d" into seconds, for use as an argparse type.
+
+    Units are h for hours, d for days, w for weeks and y for years of 365
+    days; a number without a unit is a number of days.
+    """
+    match = re.fullmatch(r"(\d+)([hdwy]?)", text.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError(
+            f"invalid age: {text!r} (expected a number followed by h, d, w or y)"
+        )
+    number, unit = match.groups()
+    return int(number) * AGE_UNIT_SECONDS[unit or "d"]
+
+
+def parse_count(text):
+    """Parse a count of zero or more, for use as an argparse type."""
+    try:
+        count = int(text)
+    except ValueError:
+        count = -1
+    if count < 0:
+        raise argparse.ArgumentTypeError(f"invalid count: {text!r} (expected 0 or more)")
+    return count
+
+
+def parse_variable_args(args):
+    """Parse arguments and get repo_dir.
+
+    Parameters
+    ----------
+    args : list
+        arguments given on command line
+
+    Returns
+    -------
+    repo_dir : path
+        path to the repo_dir
+
+    """
+    if len(args) > 1:
+        barf("Too many arguments: %s" % args, EXIT_CODES["too_many_args"])
+    return args[0] if len(args) == 1 else os.getcwd()
+
+
+def run_graphviz_command(
+    argv: list[str],
+    stdin_lines: list[str],
+    enoent_exit_code: int,
+    nonzero_exit_code: int,
+    exception_exit_code: int,
+    hint: str = "",
+    out=None,
+):
+    """Run a Graphviz utility, returning its output or writing it to out.
+
+    If out has a file descriptor, the utility writes to it directly, so
+    that its output does not pass through this process at all.
+    """
+    tool = argv[0]
+    stdin_bytes = "\n".join(stdin_lines).encode("utf-8")
+    try:
+        if out is None:
+            return b"".join(stream_command(argv, stdin_bytes=stdin_bytes))
+        try:
+            fd = out.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            for chunk in stream_command(argv, stdin_bytes=stdin_bytes):
+                out.write(chunk)
+        else:
+            out.flush()
+            for _ in stream_command(argv, stdin_bytes=stdin_bytes, stdout=fd):
+                pass
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            barf(f"{tool!r} not found! Please install the Graphviz utility.", enoent_exit_code)
+        else:
+            barf(f"A problem occurred calling {' '.join(argv)!r}", exception_exit_code)
+    except CommandError as e:
+        hint_part = f";\n{hint}" if hint else ""
+        barf(
+            f"{tool!r} terminated prematurely with error code {e.returncode}{hint_part}.\n"
+            f"The error from {tool!r} was:\n"
+            f">>>{e.stderr_tail.decode('utf-8', errors='replace')}",
+            nonzero_exit_code,
+        )
+
+
+def run_dot(output_format, dot_file_lines, layout_engine=None, out=None):
+    """Run the 'dot' utility.
+
+    Parameters
+    ----------
+    output_format : string
+        format of output [svg, png, ps, pdf, ...]
+    dot_file_lines : list of strings
+        graphviz input lines
+    layout_engine : string
+        Graphviz layout engine to use instead of 'dot', if any
+    out : binary file object
+        where to write the output to, rather than returning it
+
+    Returns
+    -------
+    Raw output from 'dot' utility, unless out is given
+
+    """
+    argv = ["dot", f"-T{output_format}"]
+    if layout_engine is not None:
+        argv.append(f"-K{layout_engine}")
+    return run_graphviz_command(
+        argv=argv,
         stdin_lines=dot_file_lines,
         enoent_exit_code=EXIT_CODES["dot_not_found"],
         nonzero_exit_code=EXIT_CODES["dot_terminated_early"],
         exception_exit_code=EXIT_CODES["problem_with_dot"],
         hint="probably you specified an invalid format, see 'man dot'",
+        out=out,
+    )
+
+
+def run_dot_in_parallel(
+    output_format, dot_files_lines, layout_engine=None, jobs=None, simplify=False, out=None
+):
+    """Lay out several graphs in parallel and render them as one.
+
+    Each graph is laid out by a 'dot' process of its own, then the layouts
+    are packed side by side using 'gvpack' and rendered using 'neato',
+    which keeps the positions from the layouts.
+
+    Parameters
+    ----------
+    output_format : string
+        format of output [svg, png, ps, pdf, ...]
+    dot_files_lines : list of lists of strings
+        graphviz input lines of each graph
+    layout_engine : string
+        Graphviz layout engine to use instead of 'dot', if any
+    jobs : int
+        number of graphs to lay out at the same time (default: number of CPUs)
+    simplify : boolean
+        if True run each graph through 'tred' before laying it out
+    out : binary file object
+        where to write the output to, rather than returning it
+
+    Returns
+    -------
+    Raw output from 'neato' utility, unless out is given
+
+    """
+
+    def lay_out(dot_file_lines):
+        if simplify:
+            dot_file_lines = simplify_using_tred(dot_file_lines).decode("utf-8").split("\n")
+        return run_graphviz_command(
+            argv=["dot", "-Tdot"] + ([f"-K{layout_engine}"] if layout_engine is not None else []),
+            stdin_lines=dot_file_lines,
+            enoent_exit_code=EXIT_CODES["dot_not_found"],
+            nonzero_exit_code=EXIT_CODES["dot_terminated_early"],
+            exception_exit_code=EXIT_CODES["problem_with_dot"],
+        ).decode("utf-8")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        layouts = list(executor.map(lay_out, dot_files_lines))
+    packed = run_graphviz_command(
+        argv=["gvpack"],
+        stdin_lines=layouts,
+        enoent_exit_code=EXIT_CODES["dot_not_found"],
+        nonzero_exit_code=EXIT_CODES["dot_terminated_early"],
+        exception_exit_code=EXIT_CODES["problem_with_dot"],
+    )
+    return run_graphviz_command(
+        argv=["neato", "-s", "-n2", f"-T{output_format}"],
+        stdin_lines=[packed.decode("utf-8")],
+        enoent_exit_code=EXIT_CODES["dot_not_found"],
+        nonzero_exit_code=EXIT_CODES["dot_terminated_early"],
+        exception_exit_code=EXIT_CODES["problem_with_dot"],
+        hint="probably you specified an invalid format, see 'man dot'",
+        out=out,
     )
 
 
@@ -537,22 +1515,53 @@ def simplify_using_tred(dot_file_lines):
     )
 
 
-def write_to_file(output_file, dot_output):
-    """Write the output from the 'dot' utility to file.
+def write_to_file(output_file, write_output, fsync=False):
+    """Write the rendered output to file.
+
+    Regular files are written to a temporary file in the same directory
+    first, which is then renamed to output_file, so that output_file is
+    never seen half-written and is left alone on failure.  If output_file
+    is a symbolic link, the file it points to is replaced, keeping the link,
+    and the permissions of a replaced file are kept.
 
     Parameters
     ----------
     output_file : string
         filename of output file
-    dot_output : list of strings
-        raw output from the 'dot' utility
+    write_output : callable
+        function writing the rendered output to a given binary file object
+    fsync : boolean
+        if True flush the file to disk before renaming it
 
     """
     try:
-        with open(output_file, "wb+") as f:
-            f.write(dot_output)
-            f.flush()
-            os.fsync(f.fileno())
+        target = os.path.realpath(output_file)
+        if os.path.exists(target) and not os.path.isfile(target):
+            # e.g. /dev/stdout or a named pipe, which cannot be replaced
+            with open(target, "wb") as f:
+                write_output(f)
+            return
+        if os.path.exists(target):
+            mode = stat.S_IMODE(os.stat(target).st_mode)
+        else:
+            # NOTE: Temporary files are private, the output file should not be
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        directory, basename = os.path.split(target)
+        with tempfile.NamedTemporaryFile(
+            dir=directory, prefix=f".{basename}.", suffix=".tmp", delete=False
+        ) as f:
+            try:
+                os.chmod(f.fileno(), mode)
+                write_output(f)
+                f.flush()
+                if fsync:
+                    os.fsync(f.fileno())
+            except BaseException:
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, target)
     except OSError as e:
         barf(f"Could not write to file '{output_file}':\n>>>{e}", EXIT_CODES["not_write_to_file"])
 
@@ -572,8 +1581,10 @@ def show_in_viewer(output_file, viewer):
         name of the viewer to use
 
     """
+    started = time.perf_counter()
     try:
-        subprocess.call([viewer, output_file])
+        exit_status = subprocess.call([viewer, output_file])
+        PROCESSES.record([viewer, output_file], started, 0, 0, exit_status)
     except OSError as e:
         barf(f"Error calling viewer: '{viewer}':\n>>>{e}", EXIT_CODES["no_such_viewer"])
 
@@ -681,6 +1692,145 @@ def set_settings(settings, defaults, conf, cli):
     return output
 
 
+class CommandError(Exception):
+    """A child process exited with non-zero status.
+
+    Attributes
+    ----------
+    argv : list of strings
+        the command and its arguments
+    returncode : int
+        the exit status, negative if killed by a signal
+    stderr_tail : bytes
+        the last STDERR_TAIL_BYTES bytes written to stderr
+
+    """
+
+    def __init__(self, argv, returncode, stderr_tail):
+        self.argv = argv
+        self.returncode = returncode
+        self.stderr_tail = stderr_tail
+        err = stderr_tail.decode("utf-8", errors="replace")
+        err = "\n".join(("> " + e) for e in err.split("\n"))
+        super().__init__(
+            'Stderr:\n%s\nReturn code %d from command "%s"' % (err, returncode, " ".join(argv))
+        )
+
+
+class CommandTimeoutError(CommandError):
+    """A child process was killed for exceeding its timeout."""
+
+
+def stream_command(
+    argv, cwd=None, env=None, stdin_bytes=None, timeout=None, lines=False, stdout=None
+):
+    """Execute arbitrary commands, yielding output as it arrives.
+
+    Stdin is fed and stderr is drained by background threads, so that
+    the process cannot block on a full pipe while stdout is being read.
+    Only the last STDERR_TAIL_BYTES bytes of stderr are kept. If the
+    generator is closed early, the process is killed.
+
+    Parameters
+    ----------
+    argv : list of strings
+        the command and its arguments
+    cwd : string
+        current working directory to execute command in
+    env : dict
+        the environment, if not the current one
+    stdin_bytes : bytes
+        input to feed to the command, if any
+    timeout : float
+        number of seconds after which to kill the command, if any
+    lines : boolean
+        if True yield lines of UTF-8 without line terminator, else chunks of bytes
+    stdout : int or file object
+        where the command should write its output to directly, if not to us,
+        in which case nothing is yielded
+
+    Raises
+    ------
+    CommandError
+        if the command exits with non-zero status
+    CommandTimeoutError
+        if the command has been killed for exceeding timeout
+    OSError
+        if the command cannot be executed
+    """
+    started = time.perf_counter()
+    p = subprocess.Popen(
+        argv,
+        stdin=subprocess.DEVNULL if stdin_bytes is None else subprocess.PIPE,
+        stdout=subprocess.PIPE if stdout is None else stdout,
+        stderr=subprocess.PIPE,
+        env=env,
+        cwd=cwd,
+    )
+    stderr_tail = bytearray()
+
+    def drain_stderr():
+        with p.stderr:
+            while chunk := p.stderr.read1(STDERR_TAIL_BYTES):
+                stderr_tail.extend(chunk)
+                del stderr_tail[:-STDERR_TAIL_BYTES]
+
+    def feed_stdin():
+        try:
+            with p.stdin:
+                p.stdin.write(stdin_bytes)
+        except BrokenPipeError:  # the command does not want any more input
+            pass
+
+    timed_out = threading.Event()
+
+    def kill_on_timeout():
+        timed_out.set()
+        p.kill()
+
+    threads = [threading.Thread(target=drain_stderr, daemon=True)]
+    if stdin_bytes is not None:
+        threads.append(threading.Thread(target=feed_stdin, daemon=True))
+    timer = threading.Timer(timeout, kill_on_timeout) if timeout is not None else None
+    for thread in threads + ([timer] if timer is not None else []):
+        thread.start()
+
+    stdout = _CountingReader(p.stdout)
+    try:
+        if p.stdout is not None:
+            with p.stdout:
+                if lines:
+                    for line in io.TextIOWrapper(
+                        io.BufferedReader(stdout), encoding="utf-8", newline="\n"
+                    ):
+                        yield line.rstrip("\n")
+                else:
+                    while chunk := p.stdout.read1(io.DEFAULT_BUFFER_SIZE):
+                        stdout.bytes_read += len(chunk)
+                        yield chunk
+        p.wait()
+    finally:
+        if p.returncode is None:  # generator closed early or reading failed
+            p.kill()
+            p.wait()
+        if timer is not None:
+            timer.cancel()
+        for thread in threads:
+            thread.join()
+        PROCESSES.record(
+            argv,
+            started,
+            stdout.bytes_read,
+            len(stdin_bytes) if stdin_bytes is not None else 0,
+            p.returncode,
+        )
+
+    if timed_out.is_set():
+        raise CommandTimeoutError(argv, p.returncode, bytes(stderr_tail))
+    if p.returncode:
+        raise CommandError(argv, p.returncode, bytes(stderr_tail))
+
+
 def get_command_output(command_list, cwd=None, git_env=None):
     """Execute arbitrary commands.
 
@@ -698,56 +1848,246 @@ def get_command_output(command_list, cwd=None, git_env=None):
     output : string
         the raw output of the command executed
     """
-    p = subprocess.Popen(
-        command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=git_env, cwd=cwd
-    )
-    load = p.stdout.read().decode("utf-8")
-    p.stdout.close()
-    p.stderr.close()
-    p.wait()
-    if p.returncode:
-        try:
-            err = p.stderr.read()
-        except ValueError:  # case "read of closed file"
-            err = ""
-        err = "\n".join(("> " + e) for e in err.split("\n"))
-        raise Exception(
-            'Stderr:\n%s\nReturn code %d from command "%s"'
-            % (err, p.returncode, " ".join(command_list))
+    return b"".join(stream_command(command_list, cwd=cwd, env=git_env)).decode("utf-8")
+
+
+def get_command_output_lines(command_list, cwd=None, git_env=None):
+    """Execute arbitrary commands, yielding lines of output as they arrive.
+
+    Parameters
+    ----------
+    command_list : list of strings
+        the command and its arguments
+    cwd : string
+        current working directory to execute command in
+    git_env : dict
+        the git environment, if any
+
+    Yields
+    ------
+    line : string
+        a line of output of the command executed, without the line terminator
+    """
+    return stream_command(command_list, cwd=cwd, env=git_env, lines=True)
+
+
+def parse_ref_lines(lines):
+    """Parse the output of 'git for-each-ref' run with REF_FORMAT.
+
+    Refs outside of the namespaces in REF_KIND_OF_PREFIX are skipped.
+
+    Parameters
+    ----------
+    lines : iterable of strings
+        the output lines of 'git for-each-ref'
+
+    Yields
+    ------
+    (kind, short_name, sha1, ref_type, deref_sha1, deref_type, commit_date)
+
+    kind : string
+        one of LOCAL_BRANCH, REMOTE_BRANCH and TAG
+    short_name : string
+        the name of the ref without its namespace prefix
+    sha1 : string
+        the object the ref points to
+    ref_type : string
+        the type of that object
+    deref_sha1 : string
+        the object a tag object points to, empty for other types
+    deref_type : string
+        the type of that object, empty for other types
+    commit_date : int
+        the committer date of the commit that the ref points to, directly or
+        through a single tag object, as a Unix timestamp, otherwise None
+    """
+    for line in lines:
+        sha1, deref_sha1, ref_type, deref_type, date, deref_date, name = line.split(
+            REF_FIELD_SEPARATOR
+        )
+        prefix = name[: name.find("/", len("refs/")) + 1]
+        kind = REF_KIND_OF_PREFIX.get(prefix)
+        if kind is None:
+            continue
+        commit_date = date or deref_date
+        commit_date = int(commit_date) if commit_date else None
+        yield kind, name[len(prefix) :], sha1, ref_type, deref_sha1, deref_type, commit_date
+
+
+class SubjectStore:
+    """Commit subjects kept in an SQLite database, shared between runs.
+
+    The subject of a commit never changes, so entries never go stale.
+    Writes happen in immediate transactions, so that concurrent processes
+    wait for each other rather than fail, and beyond max_entries the oldest
+    entries are dropped.  Every method may raise sqlite3.Error.
+
+    Parameters
+    ----------
+    filename : string
+        the database file, created if missing
+    max_entries : int
+        the number of subjects to keep at most
+    """
+
+    def __init__(self, filename, max_entries=SUBJECT_STORE_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.max_entries = max_entries
+        # NOTE: The connection is kept for all lookups of a Git instance, which
+        #       may come from any thread, but only ever from one at a time.
+        self._connection = sqlite3.connect(
+            filename,
+            timeout=SUBJECT_STORE_TIMEOUT_SECONDS,
+            isolation_level=None,
+            check_same_thread=False,
         )
-    return load
+        try:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS subjects (sha_one TEXT PRIMARY KEY, subject TEXT)"
+            )
+        except sqlite3.Error:
+            self.close()
+            raise
+
+    def close(self):
+        self._connection.close()
+
+    def get(self, sha_ones):
+        """Look up the stored subjects of commits.
+
+        Returns
+        -------
+        subjects : dict mapping strings to strings
+            mapping of commit sha1s to their subject, for stored commits only
+        """
+        subjects = {}
+        for i in range(0, len(sha_ones), SUBJECT_STORE_BATCH_SIZE):
+            batch = sha_ones[i : i + SUBJECT_STORE_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            subjects.update(
+                self._connection.execute(
+                    f"SELECT sha_one, subject FROM subjects WHERE sha_one IN ({placeholders})",
+                    batch,
+                )
+            )
+        return subjects
+
+    def put(self, subjects):
+        """Store the subjects of commits, then drop the oldest beyond max_entries."""
+        connection = self._connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT OR IGNORE INTO subjects VALUES (?, ?)", subjects.items()
+            )
+            connection.execute(
+                "DELETE FROM subjects WHERE rowid <= (SELECT max(rowid) FROM subjects) - ?",
+                (self.max_entries,),
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
 
 
 class Git:
     def __init__(self, repo_dir):
         self.repo_dir = repo_dir
+        self._config = None
+        self.commit_dates = {}
+        # NOTE: In partial clones, git fetches missing objects from promisor
+        #       remotes on demand.  Our calls must never need any, and if they
+        #       did, failing is preferable to unexpected network traffic.
+        #       Versions of git predating GIT_NO_LAZY_FETCH (2.45.1, and the
+        #       maintenance releases 2.39.4 to 2.44.1) ignore it, so no
+        #       transport is allowed either, which makes any fetch fail.
+        self.env = dict(os.environ, GIT_NO_LAZY_FETCH="1", GIT_ALLOW_PROTOCOL="")
+        self._subject_store = None
+        self._subject_store_lock = threading.Lock()
         # under the assumption that if git rev-parse fails
         # it really is not a git repo
         try:
-            self(["git", "rev-parse"])
+            object_format = self(["git", "rev-parse", "--show-object-format"])[0]
         except Exception:
             barf(
                 "'%s' is probably not a Git repository" % self.repo_dir, EXIT_CODES["no_git_repo"]
             )
+        # NOTE: Versions of git predating SHA-256 support echo the option back.
+        if object_format.startswith("-"):
+            object_format = "sha1"
+        if object_format not in OBJECT_ID_DIGITS:
+            barf(
+                f"Object format {object_format!r} of '{self.repo_dir}' is not supported",
+                EXIT_CODES["unsupported_object_format"],
+            )
+        self.object_format = object_format
+        self.object_id_digits = OBJECT_ID_DIGITS[object_format]
 
     def __call__(self, argv):
-        return get_command_output(argv, cwd=self.repo_dir).splitlines()
+        return get_command_output(argv, cwd=self.repo_dir, git_env=self.env).splitlines()
+
+    def iter_lines(self, argv):
+        return get_command_output_lines(argv, cwd=self.repo_dir, git_env=self.env)
+
+    def read_config(self):
+        """Read all settings of section "big-picture" using a single call.
+
+        The result is cached, so that it can be read ahead of time.
+
+        Returns
+        -------
+        config : dict mapping strings to strings
+            mapping of lower case setting names to their last value
+        """
+        if self._config is None:
+            config = {}
+            try:
+                output = get_command_output(
+                    ["git", "config", "-z", "--get-regexp", r"^big-picture\."],
+                    cwd=self.repo_dir,
+                    git_env=self.env,
+                )
+            except CommandError:  # e.g. no matching settings at all
+                output = ""
+            for record in output.split("\0"):
+                if record:
+                    key, _, value = record.partition("\n")
+                    config[key[len("big-picture.") :]] = value
+            self._config = config
+        return self._config
 
     def config(self, settings):
         config_settings = {}
         for setting in settings:
-            try:
-                val = self(["git", "config", f"big-picture.{setting}"])[0]
-            except Exception:
-                val = None
+            val = self.read_config().get(setting)
+
+            if setting in CHOICES_OF_SETTING and val is not None:
+                choices = CHOICES_OF_SETTING[setting]
+                if val not in choices:
+                    warn(
+                        f"Ignoring invalid value {val!r} of setting big-picture.{setting},"
+                        f" expected one of: {', '.join(choices)}"
+                    )
+                    val = None
+                config_settings[setting] = val
+                continue
 
             # We need to keep the result of "git config big-picture.wait 1"
             # from ending up as boolean True a few lines below
-            if setting == WAIT_SECONDS and val is not None:
+            if setting in TYPE_OF_SETTING and val is not None:
+                type_ = TYPE_OF_SETTING[setting]
                 try:
-                    config_settings[setting] = float(val)
+                    config_settings[setting] = type_(val)
                 except ValueError:
-                    debug(f"Could not convert {val!r} to float")
+                    warn(f"Ignoring invalid value {val!r} of setting big-picture.{setting}")
+                    config_settings[setting] = None
+                    continue
+                if config_settings[setting] < MIN_OF_SETTING.get(setting, float("-inf")):
+                    warn(
+                        f"Ignoring invalid value {val!r} of setting big-picture.{setting},"
+                        f" expected {MIN_OF_SETTING[setting]} or more"
+                    )
                     config_settings[setting] = None
                 continue
 
@@ -764,8 +2104,15 @@ class Git:
     def get_mappings(self):
         """Get mappings for all refs.
 
-        This is implemented using a single call to 'git for-each-ref'. Note
-        that it can handle non commit tags too and returns these
+        This is implemented using a single call to 'git for-each-ref', whose
+        output is parsed while it is still streaming in. Only tags of tags
+        need additional calls to find the object they ultimately point to,
+        and no call needs any object other than commits and tags.
+        Note that it can handle non commit tags too and returns these
+
+        The committer dates of the commits that refs point to are read by
+        the same call and kept in self.commit_dates, except for tags of
+        tags.
 
         Returns
         -------
@@ -785,66 +2132,675 @@ class Git:
             mapping of non-commit sha1s to sets of strings
         """
 
-        ref_format = "[%(objectname), %(*objectname), %(objecttype), %(refname)]"
-        output = self(["git", "for-each-ref", f"--format={ref_format}", "--python"])
-        lbranch_prefix = "refs/heads/"
-        rbranch_prefix = "refs/remotes/"
-        tag_prefix = "refs/tags/"
+        output = self.iter_lines(["git", "for-each-ref", f"--format={REF_FORMAT}"])
         lbranches, rbranches, abranches = {}, {}, {}
         tags, ctags, nctags = {}, {}, {}
+        branch_dicts_of_kind = {
+            LOCAL_BRANCH: (lbranches, abranches),
+            REMOTE_BRANCH: (rbranches, abranches),
+        }
 
         def add_to_dict(dic, sha1, name):
             dic.setdefault(sha1, set()).add(name)
 
-        for ref_info in output:
-            sha1, tag_sha1, ref_type, name = ast.literal_eval(ref_info)
+        for kind, name, sha1, ref_type, deref_sha1, deref_type, commit_date in parse_ref_lines(
+            progress("refs loaded", output)
+        ):
             if ref_type not in ["commit", "tag"]:
                 continue
-            elif name.startswith(lbranch_prefix):
-                add_to_dict(lbranches, sha1, name.replace(lbranch_prefix, ""))
-                add_to_dict(abranches, sha1, name.replace(lbranch_prefix, ""))
-            elif name.startswith(rbranch_prefix):
-                add_to_dict(rbranches, sha1, name.replace(rbranch_prefix, ""))
-                add_to_dict(abranches, sha1, name.replace(rbranch_prefix, ""))
-            elif name.startswith(tag_prefix):
-                # recursively dereference until we find a non-tag object
-                sha1 = self(["git", "rev-parse", "%s^{}" % name])[0]
-                # determine object type and to respective dict
-                obj_type = self(["git", "cat-file", "-t", sha1])[0]
-                if obj_type in ["blob", "tree"]:
-                    add_to_dict(nctags, sha1, name.replace(tag_prefix, ""))
-                else:
-                    add_to_dict(ctags, sha1, name.replace(tag_prefix, ""))
-                add_to_dict(tags, sha1, name.replace(tag_prefix, ""))
+            if commit_date is not None:
+                self.commit_dates[deref_sha1 or sha1] = commit_date
+            if kind != TAG:
+                for dic in branch_dicts_of_kind[kind]:
+                    add_to_dict(dic, sha1, name)
+                continue
+
+            if ref_type == "commit":
+                obj_type = ref_type
+            elif deref_type != "tag":
+                sha1, obj_type = deref_sha1, deref_type
+            else:
+                # recursively dereference until we find a non-tag object, reading
+                # its type from the tag pointing to it rather than from the object
+                # itself, which may be missing from a partial clone
+                sha1, obj_type = deref_sha1, deref_type
+                while obj_type == "tag":
+                    header = self(["git", "cat-file", "tag", sha1])
+                    sha1, obj_type = header[0].split()[1], header[1].split()[1]
+            if obj_type in ["blob", "tree"]:
+                add_to_dict(nctags, sha1, name)
+            else:
+                add_to_dict(ctags, sha1, name)
+            add_to_dict(tags, sha1, name)
 
         return (lbranches, rbranches, abranches), (tags, ctags, nctags)
 
-    def get_parent_map(self):
+    def get_parent_map(self, simplify_by_decoration=False):
         """Get a mapping of children to parents.
 
+        Parameters
+        ----------
+        simplify_by_decoration : bool
+            if True let git reduce history to the commits pointed to by refs,
+            merge commits and root commits other than those with an empty
+            tree, with parents rewritten to the nearest of these commits;
+            reachability among these commits is preserved, but a parent is
+            left out if it can also be reached through another parent
+
         Returns
         -------
         parents : dict mapping strings to sets of strings
-            mapping of children sha1s to parents sha1
+            mapping of children sha1s to parents sha1, with a single string
+            object per commit, no matter how many children name it
         """
 
         parents = {}
-        lines = self(["git", "rev-list", "--all", "--parents"])
-        for line in lines:
-            sha_ones = [e.group(0) for e in re.finditer(sha1_pattern, line)]
-            count = len(sha_ones)
-            if count > 1:
+        known = {}
+        argv = ["git", "rev-list", "--all", "--parents"]
+        if simplify_by_decoration:
+            argv += ["--full-history", "--simplify-by-decoration"]
+        for line in progress("commits parsed", self.iter_lines(argv)):
+            sha_ones = [known.setdefault(e, e) for e in line.split()]
+            if sha_ones:
                 parents[sha_ones[0]] = set(sha_ones[1:])
-            elif count == 1:
-                parents[sha_ones[0]] = set()
         return parents
 
+    def get_roots(self):
+        """Get the root commits of all history."""
+        return self(["git", "rev-list", "--all", "--max-parents=0"])
+
+    def is_partial_clone(self):
+        """Check whether objects may be missing and available from promisor remotes."""
+        try:
+            self(
+                [
+                    "git",
+                    "config",
+                    "--get-regexp",
+                    r"^(extensions\.partialclone|remote\..*\.promisor)$",
+                ]
+            )
+        except CommandError:  # no such settings
+            return False
+        return True
+
+    def get_shallow_parents(self):
+        """Get the parents of the commits at the boundary of a shallow clone.
+
+        To git, these commits appear to have no parents, but the commit
+        objects name them nonetheless.
+
+        Returns
+        -------
+        shallow_parents : dict mapping strings to sets of strings
+            mapping of boundary commit sha1s to their parent sha1s, empty
+            unless the repository is a shallow clone
+        """
+        shallow_file = os.path.join(
+            self.repo_dir, self(["git", "rev-parse", "--git-path", "shallow"])[0]
+        )
+        try:
+            with open(shallow_file) as f:
+                boundaries = f.read().split()
+        except FileNotFoundError:
+            return {}
+        output = b"".join(
+            stream_command(
+                ["git", "cat-file", "--batch"],
+                cwd=self.repo_dir,
+                env=self.env,
+                stdin_bytes="".join(f"{sha_one}\n" for sha_one in boundaries).encode("ascii"),
+            )
+        )
+        shallow_parents = {}
+        position = 0
+        while position < len(output):
+            header_end = output.index(b"\n", position)
+            fields = output[position:header_end].decode("ascii").split()
+            if len(fields) < 3:  # e.g. "<sha1> missing" for objects not present
+                position = header_end + 1
+                continue
+            sha_one, obj_type, size = fields
+            content_end = header_end + 1 + int(size)
+            if obj_type == "commit":
+                content = output[header_end + 1 : content_end].decode("utf-8", errors="replace")
+                headers = content.split("\n\n", 1)[0]
+                shallow_parents[sha_one] = {
+                    line.split()[1] for line in headers.split("\n") if line.startswith("parent ")
+                }
+            position = content_end + 1
+        return shallow_parents
+
+    def get_submodules(self):
+        """Find the initialized submodules of the repository, recursively.
+
+        Returns
+        -------
+        submodules : list of (string, string)
+            the path of each submodule relative to the top-level directory
+            of the repository, and its absolute path
+        """
+        toplevel = self(["git", "rev-parse", "--show-toplevel"])[0]
+        try:
+            output = get_command_output(
+                ["git", "config", "-z", "--file", ".gitmodules", "--get-regexp", r"\.path$"],
+                cwd=toplevel,
+                git_env=self.env,
+            )
+        except CommandError:  # e.g. no file .gitmodules
+            return []
+        submodules = []
+        for record in output.split("\0"):
+            if not record:
+                continue
+            path = record.partition("\n")[2]
+            absolute_path = os.path.join(toplevel, path)
+            if not os.path.exists(os.path.join(absolute_path, ".git")):
+                continue  # not initialized
+            submodules.append((path, absolute_path))
+            submodules.extend(
+                (f"{path}/{nested_path}", nested_absolute_path)
+                for nested_path, nested_absolute_path in Git(absolute_path).get_submodules()
+            )
+        return submodules
+
+    def get_ref_state(self):
+        """Get HEAD and all refs along with the objects they point to.
+
+        As these determine the history reachable from them, the result
+        serves to tell whether a cached graph is still up to date.
+        """
+        try:
+            return get_command_output(
+                ["git", "show-ref", "--head"], cwd=self.repo_dir, git_env=self.env
+            )
+        except CommandError:  # no refs at all
+            return ""
+
+    def resolve_commit(self, rev):
+        """Get the sha1 of the commit that rev refers to.
+
+        Raises CommandError if rev does not refer to a commit.
+        """
+        return self(["git", "rev-parse", "--verify", "--quiet", rev + "^{commit}"])[0]
+
+    def get_subjects(self, sha_ones):
+        """Get the subject lines of commits.
+
+        Subjects are looked up in the SubjectStore of the repository first,
+        and only those of commits missing from there are read from git, and
+        then stored.  If the store cannot be used, all are read from git.
+
+        Parameters
+        ----------
+        sha_ones : list of strings
+            the commits
+
+        Returns
+        -------
+        subjects : dict mapping strings to strings
+            mapping of commit sha1s to their subject
+        """
+        if sqlite3 is None:
+            return self._read_subjects(sha_ones)
+        with self._subject_store_lock:
+            store = self._open_subject_store()
+            subjects = {}
+            if store is not None:
+                try:
+                    subjects = store.get(sha_ones)
+                except sqlite3.Error as e:
+                    debug(f"Could not read stored commit subjects: {e}")
+            missing = [sha_one for sha_one in sha_ones if sha_one not in subjects]
+            read = self._read_subjects(missing) if missing else {}
+            if store is not None and read:
+                try:
+                    store.put(read)
+                except sqlite3.Error as e:
+                    debug(f"Could not store commit subjects: {e}")
+        subjects.update(read)
+        return subjects
+
+    def _open_subject_store(self):
+        """Open the SubjectStore of the repository, once per instance.
+
+        The store is closed when the instance is garbage collected or at exit
+        at the latest.
+
+        Returns
+        -------
+        store : SubjectStore or None
+            the store, or None if it cannot be used
+        """
+        if self._subject_store is None:
+            self._subject_store = False
+            try:
+                store = SubjectStore(
+                    os.path.join(
+                        self.repo_dir,
+                        self(["git", "rev-parse", "--git-common-dir"])[0],
+                        CACHE_DIR,
+                        SUBJECT_STORE_FILE,
+                    )
+                )
+            except (OSError, sqlite3.Error) as e:
+                debug(f"Could not open stored commit subjects: {e}")
+            else:
+                weakref.finalize(self, store.close)
+                self._subject_store = store
+        return self._subject_store or None
+
+    def _read_subjects(self, sha_ones):
+        """Read the subject lines of commits from git, see get_subjects."""
+        subjects = {}
+        for i in range(0, len(sha_ones), SUBJECTS_PER_GIT_LOG):
+            lines = self(
+                ["git", "log", "--no-walk=unsorted", "--format=%H%x00%s"]
+                + sha_ones[i : i + SUBJECTS_PER_GIT_LOG]
+            )
+            for line in lines:
+                sha_one, subject = line.split("\0", 1)
+                subjects[sha_one] = subject
+        return subjects
+
+
+def encode_varint(number):
+    """Encode a non-negative integer as LEB128, 7 bits per byte."""
+    encoded = bytearray()
+    while number > 0x7F:
+        encoded.append((number & 0x7F) | 0x80)
+        number >>= 7
+    encoded.append(number)
+    return bytes(encoded)
+
+
+def encode_zigzag_varint(number):
+    """Encode an integer as varint, mapping 0, -1, 1, -2, ... to 0, 1, 2, 3, ..."""
+    return encode_varint(number * 2 if number >= 0 else -number * 2 - 1)
+
+
+def encode_string(string):
+    """Encode a string as varint length followed by its UTF-8 bytes."""
+    encoded = string.encode("utf-8")
+    return encode_varint(len(encoded)) + encoded
+
+
+def graph_factory(repo_dir, git=None, simplify_by_decoration=False):
+    """Create a CommitGraph object from a git_dir.
+
+    With simplify_by_decoration, git rather than Python reduces history,
+    see Git.get_parent_map, unless the repository has root commits git
+    would leave out or is a shallow clone.  Filtering the resulting graph
+    then gives the same graph as filtering the full one for commits pointed
+    to by refs and root commits, up to edges implied by transitivity.
+
+    Instead of a boolean, simplify_by_decoration may be a function deciding
+    it, which is called with the Git object exactly once, as soon as the
+    configuration of the repository has been read, while refs are loaded.
+    """
+    if git is None:
+        with phase("git preflight"):
+            git = Git(repo_dir)
+
+    def in_phase(name, function):
+        with phase(name):
+            return function()
+
+    def decide():
+        if git._config is None:
+            in_phase("config read", git.read_config)
+        if callable(simplify_by_decoration):
+            return simplify_by_decoration(git)
+        return simplify_by_decoration
+
+    # NOTE: These calls hardly depend on each other, so they run concurrently,
+    #       with parsing of one output overlapping the others.  Only the history
+    #       walk waits for the quick read of the configuration.  Memory can only
+    #       be attributed to phases that do not overlap, though.
+    max_workers = 3 if MEMSTATS is None else 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        reduced = executor.submit(decide)
+        mappings = executor.submit(in_phase, "ref loading", git.get_mappings)
+        parent_map = executor.submit(
+            in_phase, "history walk", lambda: git.get_parent_map(reduced.result())
+        )
+        shallow_parents = executor.submit(git.get_shallow_parents)
+        roots = executor.submit(lambda: git.get_roots() if reduced.result() else None)
+    (lb, rb, ab), (tags, ctags, nctags) = mappings.result()
+    parent_map = parent_map.result()
+    if reduced.result():
+        if shallow_parents.result() or not all(r in parent_map for r in roots.result()):
+            debug("History cannot be reduced by git, walking all of it")
+            parent_map = in_phase("history walk", git.get_parent_map)
+        else:
+            debug(f"History reduced by git to {len(parent_map)} commits")
+    # NOTE: Checking costs a git process, which is only worth it for the message
+    if DEBUG and git.is_partial_clone():
+        debug("The repository is a partial clone, lazy fetching is disabled")
+
+    # NOTE: Parents missing beyond the boundary of a shallow clone are shown
+    #       as "..." so that history is not mistaken to start there.
+    dotdot = set()
+    for sha_one, parents in shallow_parents.result().items():
+        if sha_one not in parent_map:
+            continue
+        parent_map[sha_one] |= parents
+        for p in parents:
+            if p not in parent_map:
+                parent_map[p] = set()
+                dotdot.add(p)
+    if dotdot:
+        debug(f"The repository is a shallow clone, with {len(dotdot)} missing parents")
+
+    with phase("graph build"):
+        return CommitGraph(
+            parent_map, ab, tags, git=git, dotdot=dotdot, commit_dates=git.commit_dates
+        )
+
+
+def prepare_graph(
+    graph,
+    all_commits,
+    filter_settings,
+    collapse_patterns,
+    collapse_tag_runs,
+    additional=None,
+    merged_into=None,
+    min_ref_date=None,
+):
+    """Collapse ref families and filter a graph as requested on the command line."""
+    if min_ref_date is not None:
+        graph = graph.hide_stale_refs(min_ref_date)
+    if merged_into is not None:
+        graph = graph.hide_merged(merged_into)
+    if collapse_patterns or collapse_tag_runs:
+        graph = graph.collapse_refs(collapse_patterns, collapse_tag_runs)
+    if not all_commits:
+        graph = graph.filter(additional=additional, **filter_settings)
+    return graph
+
+
+def read_snapshot(filename):
+    """Read a snapshot written by CommitGraph.write_snapshot."""
+    try:
+        with open(filename) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError) as e:
+        barf(
+            f"Could not read snapshot from file '{filename}':\n>>>{e}", EXIT_CODES["bad_snapshot"]
+        )
+    if not isinstance(snapshot, dict) or snapshot.get("format") != SNAPSHOT_FORMAT:
+        barf(f"File '{filename}' is not a snapshot.", EXIT_CODES["bad_snapshot"])
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        barf(
+            f"Snapshot '{filename}' has unsupported version {snapshot.get('version')!r}.",
+            EXIT_CODES["bad_snapshot"],
+        )
+
+    def is_valid(name, value):
+        if name == "parents":
+            return isinstance(value, list) and all(isinstance(p, str) for p in value)
+        return isinstance(value, str)
+
+    for name in ("branches", "tags", "parents"):
+        mapping = snapshot.get(name)
+        if not (
+            isinstance(mapping, dict) and all(is_valid(name, value) for value in mapping.values())
+        ):
+            barf(
+                f"Snapshot '{filename}' has missing or invalid {name}.",
+                EXIT_CODES["bad_snapshot"],
+            )
+    return snapshot
+
+
+def list_containing_refs(graph, sha_ones, out):
+    """Write the names of the branches and the tags pointing to any of sha_ones.
+
+    Branches are listed before tags, each sorted by name, one per line.
+    """
+    for ref_dict in (graph.branches, graph.tags):
+        for name in sorted(name for sha_one in sha_ones for name in ref_dict.get(sha_one, ())):
+            print(name, file=out)
+
+
+def _is_cached_graph(cached, key):
+    """Check that data read from a cache file is a graph cached under key."""
+
+    def is_id_list(value):
+        return isinstance(value, list) and all(isinstance(e, str) for e in value)
+
+    return (
+        isinstance(cached, dict)
+        and cached.get("key") == key
+        and all(
+            isinstance(cached.get(name), dict) and all(map(is_id_list, cached[name].values()))
+            for name in ("parents", "branches", "tags")
+        )
+        and is_id_list(cached.get("dotdot"))
+        and isinstance(cached.get("commit_dates"), dict)
+        and all(isinstance(date, int) for date in cached["commit_dates"].values())
+    )
+
+
+def load_submodule_graph(repo_dir, cache_dir, preparation):
+    """Create the prepared CommitGraph of a submodule, cached in cache_dir.
+
+    The prepared graph is cached, keyed by the state of all refs of the
+    submodule and the preparation, so unchanged submodules do not have
+    their history walked.  Rather than by the minimum ref date, which
+    changes with the time of each run, it is keyed by the refs that are
+    hidden for their age.
+
+    Parameters
+    ----------
+    repo_dir : string
+        the submodule
+    cache_dir : string
+        the directory to cache graphs in
+    preparation : dict
+        keyword arguments for prepare_graph besides the graph
+
+    Returns
+    -------
+    commit_graph : CommitGraph
+        the prepared graph
 
-def graph_factory(repo_dir):
-    """Create a CommitGraph object from a git_dir."""
+    """
     git = Git(repo_dir)
-    (lb, rb, ab), (tags, ctags, nctags) = git.get_mappings()
-    return CommitGraph(git.get_parent_map(), ab, tags, git=git)
+    stale = None
+    if preparation.get("min_ref_date") is not None:
+        git.get_mappings()  # for the commit dates of refs
+        stale = sorted(
+            sha_one
+            for sha_one, date in git.commit_dates.items()
+            if date < preparation["min_ref_date"]
+        )
+    key = hashlib.sha256(
+        json.dumps(
+            [
+                __version__,
+                git.get_ref_state(),
+                {name: value for name, value in preparation.items() if name != "min_ref_date"},
+                stale,
+            ]
+        ).encode("utf-8")
+    ).hexdigest()
+    cache_file = os.path.join(
+        cache_dir, hashlib.sha256(os.path.realpath(repo_dir).encode("utf-8")).hexdigest() + ".json"
+    )
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = None
+    if _is_cached_graph(cached, key):
+        debug(f"Using cached graph of submodule {repo_dir!r}")
+        return CommitGraph(
+            *(
+                {sha_one: set(values) for sha_one, values in cached[name].items()}
+                for name in ("parents", "branches", "tags")
+            ),
+            git=git,
+            dotdot=set(cached["dotdot"]),
+            commit_dates=cached["commit_dates"],
+        )
+
+    graph = prepare_graph(graph_factory(repo_dir, git=git), **preparation)
+    to_cache = {
+        "key": key,
+        "dotdot": sorted(graph.dotdot),
+        "commit_dates": graph.commit_dates,
+    }
+    for name, mapping in (
+        ("parents", graph.parents),
+        ("branches", graph.branches),
+        ("tags", graph.tags),
+    ):
+        to_cache[name] = {sha_one: sorted(values) for sha_one, values in mapping.items()}
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=cache_dir, delete=False) as f:
+            json.dump(to_cache, f)
+        os.replace(f.name, cache_file)
+    except OSError as e:
+        debug(f"Could not cache graph of submodule {repo_dir!r}: {e}")
+    return graph
+
+
+def collect_submodule_graphs(git, preparation):
+    """Create the prepared CommitGraphs of all submodules in parallel.
+
+    With --memstats, they are created one after the other, because memory
+    can only be attributed to phases that do not overlap.
+
+    Parameters
+    ----------
+    git : Git
+        interface to the superproject
+    preparation : dict
+        keyword arguments for prepare_graph besides the graph
+
+    Returns
+    -------
+    submodule_graphs : list of (string, CommitGraph)
+        the path of each submodule and its graph
+    """
+    submodules = git.get_submodules()
+    cache_dir = os.path.join(git(["git", "rev-parse", "--absolute-git-dir"])[0], CACHE_DIR)
+    max_workers = min(len(submodules), os.cpu_count() or 1) or 1
+    if MEMSTATS is not None:
+        max_workers = 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        graphs = [
+            executor.submit(load_submodule_graph, absolute_path, cache_dir, preparation)
+            for _, absolute_path in submodules
+        ]
+    return [(path, graph.result()) for (path, _), graph in zip(submodules, graphs)]
+
+
+def generate_clustered_dot_file(named_graphs, history_direction=None, **statement_options):
+    """Generate graphviz input showing multiple graphs as clusters.
+
+    Parameters
+    ----------
+    named_graphs : list of (string, CommitGraph, int)
+        the label, graph and number of digits to use for showing sha1s
+        of each cluster
+    history_direction : string
+        see CommitGraph._generate_dot_file
+    statement_options : dict
+        further keyword arguments for CommitGraph._generate_dot_statements
+
+    Returns
+    -------
+    dot_file_lines : list of strings
+        lines of the graphviz input
+    """
+    dot_file_lines = ["digraph {"]
+    if history_direction is not None:
+        rankdir = RANKDIR_OF_HISTORY_DIRECTION[history_direction]
+        dot_file_lines.append(f'\trankdir="{rankdir}";')
+    for i, (name, graph, sha_one_digits) in enumerate(named_graphs):
+        label = name.replace('"', '\\"')
+        dot_file_lines.append(f'\tsubgraph "cluster_{i}" {{')
+        dot_file_lines.append(f'\t\tlabel="{label}";')
+        dot_file_lines.extend(
+            "\t\t" + statement
+            for statement in graph._generate_dot_statements(
+                sha_one_digits=sha_one_digits,
+                node_id_prefix=f"{label}:",
+                **statement_options,
+            )
+        )
+        dot_file_lines.append("\t}")
+    dot_file_lines.append("}")
+    return dot_file_lines
+
+
+class _CommitArrays:
+    """The commits of a CommitGraph held in NumPy arrays.
+
+    Parent and child counts live in integer arrays in the order of the
+    parent and child map, so that commits are classified by degree in bulk
+    rather than one by one.  Ids are packed into a fixed-width byte array
+    only when their unique prefix length is asked for.
+
+    Parameters
+    ----------
+    parents : dict mapping SHA1s to sets of SHA1s
+        the parent map
+    children : dict mapping SHA1s to sets of SHA1s
+        the child map
+    """
+
+    def __init__(self, parents, children):
+        self.keys = list(parents)
+        self.child_keys = list(children)
+        self.parent_counts = numpy.fromiter(
+            map(len, parents.values()), dtype=numpy.intp, count=len(self.keys)
+        )
+        self.child_counts = numpy.fromiter(
+            map(len, children.values()), dtype=numpy.intp, count=len(self.child_keys)
+        )
+
+    @staticmethod
+    def _select(keys, mask):
+        return [keys[i] for i in numpy.flatnonzero(mask).tolist()]
+
+    @property
+    def roots(self):
+        return self._select(self.keys, self.parent_counts == 0)
+
+    @property
+    def merges(self):
+        return self._select(self.keys, self.parent_counts > 1)
+
+    @property
+    def bifurcations(self):
+        return self._select(self.child_keys, self.child_counts > 1)
+
+    def unique_prefix_length(self):
+        """Calculate the number of leading characters that tell all ids apart.
+
+        Once sorted, each id shares its longest common prefix with one of its
+        neighbours, so comparing neighbours byte by byte is enough.
+
+        Raises
+        ------
+        UnicodeEncodeError
+            if ids are not plain ASCII
+        """
+        sorted_ids = numpy.sort(numpy.array(self.keys, dtype=bytes))
+        width = sorted_ids.dtype.itemsize
+        longest_common = 0
+        for start in range(0, len(sorted_ids) - 1, PREFIX_CHUNK_SIZE):
+            chunk = sorted_ids[start : start + PREFIX_CHUNK_SIZE + 1]
+            chunk = chunk.view(numpy.uint8).reshape(-1, width)
+            differs = chunk[1:] != chunk[:-1]
+            common = numpy.where(differs.any(axis=1), differs.argmax(axis=1), width)
+            longest_common = max(longest_common, int(common.max()))
+        return longest_common + 1
 
 
 class CommitGraph:
@@ -880,19 +2836,47 @@ class CommitGraph:
         tags
     git : Git
         interface to dispatch commands to this repo
+    dotdot : set of SHA1s
+        the parents missing beyond the boundary of a shallow clone
+    commit_dates : dict mapping SHA1s to int
+        the committer dates of the commits pointed to by refs
 
     """
 
-    def __init__(self, parent_map, branch_dict, tag_dict, git=None):
+    def __init__(
+        self, parent_map, branch_dict, tag_dict, git=None, dotdot=None, commit_dates=None
+    ):
         self.parents = parent_map
         self.branches = branch_dict
         self.tags = tag_dict
-        self.dotdot = set()
+        self.dotdot = set() if dotdot is None else dotdot
+        self.commit_dates = {} if commit_dates is None else commit_dates
         self.git = git
+        self.object_id_digits = OBJECT_ID_DIGITS["sha1"] if git is None else git.object_id_digits
 
         self.children = {}
         self._calculate_child_mapping()
         self._verify_child_mapping()
+        self._commit_arrays = None
+        self._subjects = None
+        self._containing = {}
+
+    def _derive(self, parent_map, branch_dict, tag_dict, keep=None):
+        """Create a graph from this one with other parents and refs.
+
+        The repository, the commit dates and the missing parents of a
+        shallow clone are carried over, the latter as far as they are still
+        part of the graph and in keep, if given.
+        """
+        dotdot = {sha_one for sha_one in self.dotdot if sha_one in parent_map}
+        return CommitGraph(
+            parent_map,
+            branch_dict,
+            tag_dict,
+            self.git,
+            dotdot=dotdot if keep is None else dotdot & keep,
+            commit_dates=self.commit_dates,
+        )
 
     def _has_label(self, sha_one):
         """Check if a sha1 is pointed to by a ref.
@@ -925,21 +2909,43 @@ class CommitGraph:
                 for p in self.parents[c]:
                     assert c in self.children[p]
 
+    def _vectorized(self):
+        """Get the commits as _CommitArrays, or None to stay with pure Python.
+
+        NumPy only pays off for large graphs.
+        """
+        if numpy is None or len(self.parents) < VECTORIZE_MIN_COMMITS:
+            return None
+        if self._commit_arrays is None:
+            self._commit_arrays = _CommitArrays(self.parents, self.children)
+        return self._commit_arrays
+
     @property
     def roots(self):
         """Find all root commits."""
+        if (arrays := self._vectorized()) is not None:
+            return arrays.roots
         return [sha for sha, parents in self.parents.items() if not parents]
 
     @property
     def merges(self):
         """Find all merge commits."""
+        if (arrays := self._vectorized()) is not None:
+            return arrays.merges
         return [sha for sha, parents in self.parents.items() if len(parents) > 1]
 
     @property
     def bifurcations(self):
         """Find all bifurcations."""
+        if (arrays := self._vectorized()) is not None:
+            return arrays.bifurcations
         return [sha for sha, children in self.children.items() if len(children) > 1]
 
+    @property
+    def edge_count(self):
+        """Count all edges, i.e. all child-parent relations."""
+        return sum(len(parents) for parents in self.parents.values())
+
     def filter(
         self,
         branches=FILTER_DEFAULTS[BRANCHES],
@@ -993,10 +2999,11 @@ class CommitGraph:
             interesting.extend(self.bifurcations)
         if additional:
             interesting.extend(additional)
+        interesting.extend(self.dotdot)
 
         reachable_interesting_parents = dict()
         # for everything that we are interested in
-        for commit_i in interesting:
+        for commit_i in progress("commits filtered", interesting, check_every=1):
             # Handle tags pointing to non-commits
             if commit_i in self.parents:
                 to_visit = list(self.parents[commit_i])
@@ -1020,24 +3027,424 @@ class CommitGraph:
                         # is not interesting, keep searching
                         to_visit.extend(self.parents[commit_j])
 
-        return CommitGraph(
-            reachable_interesting_parents,
-            copy.deepcopy(self.branches),
-            copy.deepcopy(self.tags),
-            self.git,
+        return self._derive(
+            reachable_interesting_parents, copy.deepcopy(self.branches), copy.deepcopy(self.tags)
+        )
+
+    def _ancestors(self, sha_one):
+        """Find all ancestors of a commit, excluding the commit itself."""
+        ancestors = set()
+        to_visit = list(self.parents.get(sha_one, ()))
+        while to_visit:
+            p = to_visit.pop()
+            if p not in ancestors:
+                ancestors.add(p)
+                to_visit.extend(self.parents.get(p, ()))
+        return ancestors
+
+    def hide_stale_refs(self, min_date):
+        """Drop all branches and tags pointing to commits older than a date.
+
+        Refs whose commit date is unknown, see Git.get_mappings, are kept.
+
+        Parameters
+        ----------
+        min_date : int
+            the oldest committer date to keep refs for, as a Unix timestamp
+
+        Returns
+        -------
+        commit_graph : CommitGraph
+            the graph without the stale refs
+        """
+
+        def is_fresh(sha_one):
+            return self.commit_dates.get(sha_one, min_date) >= min_date
+
+        return self._derive(
+            self.parents,
+            {c: names for c, names in self.branches.items() if is_fresh(c)},
+            {c: names for c, names in self.tags.items() if is_fresh(c)},
+        )
+
+    def hide_merged(self, sha_one):
+        """Drop all branches that have been merged into a commit.
+
+        A branch counts as merged if it points to an ancestor of the commit.
+        The ancestors are found in a single traversal, so this takes time
+        linear in the size of the graph, regardless of the number of
+        branches.  Branches pointing to the commit itself are kept.
+
+        Parameters
+        ----------
+        sha_one : string
+            the commit to check branches against
+
+        Returns
+        -------
+        commit_graph : CommitGraph
+            the graph without the merged branches
+        """
+        merged = self._ancestors(sha_one)
+        return self._derive(
+            self.parents,
+            {c: names for c, names in self.branches.items() if c not in merged},
+            self.tags,
+        )
+
+    def collapse_refs(self, patterns=(), tag_runs=False):
+        """Fold families of refs into aggregate refs.
+
+        Refs are replaced by a single aggregate ref on a single commit,
+        which makes the other commits uninteresting to filter(), unless
+        they are pointed to by other refs.
+
+        Parameters
+        ----------
+        patterns : list of strings
+            fnmatch patterns; all branches matching a pattern are replaced by
+            a single branch like "ticket-* (57 branches)" on the commit with
+            the highest generation number among them, and likewise for tags
+        tag_runs : bool
+            replace the tags of each run of two or more commits on a linear
+            chain that are pointed to by tags only by a single tag like
+            "v1.0 .. v1.9 (10 tags)" on the newest commit of the run; commits
+            of the chain without refs may lie in between
+
+        Returns
+        -------
+        commit_graph : CommitGraph
+            the graph with collapsed refs
+
+        """
+        branches = {sha_one: set(names) for sha_one, names in self.branches.items()}
+        tags = {sha_one: set(names) for sha_one, names in self.tags.items()}
+        aggregates = set()
+
+        if patterns:
+            generation = {
+                sha_one: gen for gen, layer in enumerate(self._generations()) for sha_one in layer
+            }
+            for ref_dict, kind in ((branches, "branches"), (tags, "tags")):
+                for pattern in patterns:
+                    matches = [
+                        (generation.get(sha_one, -1), name, sha_one)
+                        for sha_one, names in ref_dict.items()
+                        for name in names
+                        if fnmatch.fnmatchcase(name, pattern)
+                    ]
+                    if len(matches) < 2:
+                        continue
+                    for _, name, sha_one in matches:
+                        ref_dict[sha_one].remove(name)
+                        if not ref_dict[sha_one]:
+                            del ref_dict[sha_one]
+                    _, _, newest = max(matches)
+                    ref_dict.setdefault(newest, set()).add(f"{pattern} ({len(matches)} {kind})")
+                    aggregates.add(newest)
+
+        if tag_runs:
+
+            def can_join_run(sha_one):
+                return (
+                    sha_one in tags
+                    and sha_one not in branches
+                    and sha_one not in aggregates
+                    and sha_one in self.parents
+                )
+
+            def can_be_skipped(sha_one):
+                return (
+                    len(self.parents.get(sha_one, ())) == 1
+                    and len(self.children.get(sha_one, ())) == 1
+                    and sha_one not in tags
+                    and sha_one not in branches
+                )
+
+            def next_in_run(sha_one):
+                children = self.children.get(sha_one, ())
+                while len(children) == 1:
+                    (child,) = children
+                    if len(self.parents[child]) != 1:
+                        return None
+                    if can_join_run(child):
+                        return child
+                    if not can_be_skipped(child):
+                        return None
+                    children = self.children[child]
+                return None
+
+            def previous_in_run(sha_one):
+                parents = self.parents.get(sha_one, ())
+                while len(parents) == 1:
+                    (parent,) = parents
+                    if len(self.children.get(parent, ())) != 1:
+                        return None
+                    if can_join_run(parent):
+                        return parent
+                    if not can_be_skipped(parent):
+                        return None
+                    parents = self.parents[parent]
+                return None
+
+            for sha_one in list(tags):
+                if not can_join_run(sha_one) or previous_in_run(sha_one) is not None:
+                    continue  # not the oldest commit of its run
+                run = [sha_one]
+                while (child := next_in_run(run[-1])) is not None:
+                    run.append(child)
+                if len(run) < 2:
+                    continue
+                names = [name for commit in run for name in sorted(tags.pop(commit))]
+                tags[run[-1]] = {f"{names[0]} .. {names[-1]} ({len(names)} tags)"}
+
+        return self._derive(self.parents, branches, tags)
+
+    def components(self):
+        """Split the graph into its weakly connected components.
+
+        Returns
+        -------
+        components : list of CommitGraph
+            the components, largest first
+        """
+        seen = set()
+        components = []
+        for start in sorted(self.parents):
+            if start in seen:
+                continue
+            seen.add(start)
+            component = [start]
+            for sha_one in component:
+                for neighbour in (*self.parents[sha_one], *self.children.get(sha_one, ())):
+                    if neighbour not in seen and neighbour in self.parents:
+                        seen.add(neighbour)
+                        component.append(neighbour)
+            component = set(component)
+            components.append(
+                self._derive(
+                    {sha_one: self.parents[sha_one] & component for sha_one in component},
+                    {c: names for c, names in self.branches.items() if c in component},
+                    {c: names for c, names in self.tags.items() if c in component},
+                )
+            )
+        components.sort(key=lambda commit_graph: len(commit_graph.parents), reverse=True)
+        return components
+
+    def write_snapshot(self, out):
+        """Write the refs and the parent map of the graph as compact JSON.
+
+        Parameters
+        ----------
+        out : text file object
+            where to write the snapshot to
+        """
+
+        def names_to_sha_ones(ref_dict):
+            return {name: sha_one for sha_one, names in ref_dict.items() for name in names}
+
+        snapshot = {
+            "format": SNAPSHOT_FORMAT,
+            "version": SNAPSHOT_VERSION,
+            "branches": names_to_sha_ones(self.branches),
+            "tags": names_to_sha_ones(self.tags),
+            "parents": {sha_one: sorted(parents) for sha_one, parents in self.parents.items()},
+        }
+        json.dump(snapshot, out, separators=(",", ":"), sort_keys=True)
+        out.write("\n")
+
+    def diff_snapshot(self, snapshot):
+        """Compare the refs of the graph against those of a snapshot.
+
+        Commits from the snapshot that are missing from the graph, e.g. those
+        of deleted branches, are added back with the parents recorded in the
+        snapshot.  Changed refs are relabeled: added ones as "name (new)",
+        moved ones as "name (moved)" at their current commit and as
+        "name (old)" at their former one, and deleted ones as
+        "name (deleted)".
+
+        Parameters
+        ----------
+        snapshot : dict
+            as written by write_snapshot
+
+        Returns
+        -------
+        (commit_graph, changed)
+
+        commit_graph : CommitGraph
+            the relabeled graph
+        changed : set of SHA1s
+            the commits that changed refs point to, now or in the snapshot
+        """
+        parents = {sha_one: set(ps) for sha_one, ps in self.parents.items()}
+        for sha_one, ps in snapshot["parents"].items():
+            if sha_one not in parents:
+                parents[sha_one] = set(ps)
+        for ps in list(parents.values()):
+            for p in ps:
+                parents.setdefault(p, set())
+
+        changed = set()
+        ref_dicts = []
+        for ref_dict, kind in ((self.branches, "branches"), (self.tags, "tags")):
+            before = snapshot[kind]
+            now = {name: sha_one for sha_one, names in ref_dict.items() for name in names}
+            labels = {}
+
+            def add_label(sha_one, name):
+                labels.setdefault(sha_one, set()).add(name)
+
+            for name, sha_one in now.items():
+                if name not in before:
+                    add_label(sha_one, f"{name} (new)")
+                elif before[name] != sha_one:
+                    add_label(sha_one, f"{name} (moved)")
+                    add_label(before[name], f"{name} (old)")
+                    changed.add(before[name])
+                else:
+                    add_label(sha_one, name)
+                    continue
+                changed.add(sha_one)
+            for name, sha_one in before.items():
+                if name not in now:
+                    add_label(sha_one, f"{name} (deleted)")
+                    changed.add(sha_one)
+            ref_dicts.append(labels)
+
+        return self._derive(parents, *ref_dicts), changed
+
+    def neighbourhood(self, sha_ones):
+        """Reduce the graph to some commits and their parents.
+
+        Refs pointing to other commits are dropped and the remaining commits
+        are connected as in filter().
+
+        Parameters
+        ----------
+        sha_ones : set of SHA1s
+            the commits to keep
+
+        Returns
+        -------
+        commit_graph : CommitGraph
+            the reduced graph
+        """
+        keep = {sha_one for sha_one in sha_ones if sha_one in self.parents}
+        keep.update(p for sha_one in list(keep) for p in self.parents[sha_one])
+        reduced = self._derive(
+            self.parents,
+            {sha_one: names for sha_one, names in self.branches.items() if sha_one in keep},
+            {sha_one: names for sha_one, names in self.tags.items() if sha_one in keep},
+            keep=keep,
+        )
+        return reduced.filter(
+            branches=False,
+            tags=False,
+            roots=False,
+            merges=False,
+            bifurcations=False,
+            additional=sorted(keep),
         )
 
+    def commits_containing(self, sha_one):
+        """Find all commits of the graph that sha_one is reachable from.
+
+        These are found in a single walk from sha_one along the child map,
+        which is done once per commit and graph.
+
+        Parameters
+        ----------
+        sha_one : string
+            the commit to look for
+
+        Returns
+        -------
+        containing : set of SHA1s
+            the commits containing sha_one, including itself if in the graph
+        """
+        if sha_one not in self._containing:
+            containing = set()
+            if sha_one in self.parents:
+                containing.add(sha_one)
+                to_visit = [sha_one]
+                while to_visit:
+                    for child in self.children.get(to_visit.pop(), ()):
+                        if child not in containing:
+                            containing.add(child)
+                            to_visit.append(child)
+            self._containing[sha_one] = containing
+        return self._containing[sha_one]
+
     def _minimal_sha_one_digits(self):
         """Calculate the minimal number of sha1 digits required to represent
         all commits unambiguously."""
+        if (arrays := self._vectorized()) is not None:
+            with contextlib.suppress(UnicodeEncodeError):
+                return min(max(7, arrays.unique_prefix_length()), self.object_id_digits)
         key_count = len(self.parents)
-        for digit_count in range(7, 40):
+        for digit_count in range(7, self.object_id_digits):
             if len({e[0:digit_count] for e in self.parents.keys()}) == key_count:
                 return digit_count
-        return 40
+        return self.object_id_digits
+
+    def _format_sha_one(self, sha_one, sha_one_digits):
+        """Shorten sha1 if required."""
+        if (sha_one_digits is None) or (sha_one_digits == self.object_id_digits):
+            return sha_one
+        else:
+            return sha_one[0:sha_one_digits]
+
+    def _format_label(self, sha_one, with_commit_messages, sha_one_digits):
+        """Format the sha1 of a commit and, if requested, its message."""
+        # NOTE: Commits beyond the boundary of a shallow clone are missing and
+        #       tags may point to blobs and trees, which have no message.
+        if with_commit_messages and sha_one not in self.dotdot:
+            if self._subjects is None:
+                self._subjects = self.git.get_subjects(
+                    [e for e in self.parents if e not in self.dotdot]
+                )
+            subject = self._subjects.get(sha_one)
+            if subject is not None:
+                message = subject.replace('"', "").replace("'", "")
+                return self._format_sha_one(sha_one, sha_one_digits) + "\n" + message
+        return self._format_sha_one(sha_one, sha_one_digits)
+
+    def _label_gen(self):
+        """Generate the ref names of all commits pointed to by refs.
+
+        Yields
+        ------
+        (sha_one, labels, case)
+
+        sha_one : string
+            the commit
+        labels : list of strings
+            the tag names followed by the branch names
+        case : int
+            1 for tags only, 2 for branches only, 3 for both
+        """
+        keys = set(self.branches.keys()).union(set(self.tags.keys()))
+        for k in (k for k in keys if k in self.parents or k in self.children):
+            labels = []
+            case = 0
+            if k in self.tags:
+                case += 1
+                labels.extend(sorted(self.tags[k]))
+            if k in self.branches:
+                case += 2
+                labels.extend(sorted(self.branches[k]))
+            yield (k, labels, case)
 
     def _generate_dot_file(
-        self, sha_ones_on_labels, with_commit_messages, sha_one_digits=None, history_direction=None
+        self,
+        sha_ones_on_labels,
+        with_commit_messages,
+        sha_one_digits=None,
+        history_direction=None,
+        unlabeled_as_points=False,
+        rank_hints=False,
+        contains=None,
     ):
         """Generate graphviz input.
 
@@ -1049,6 +3456,12 @@ class CommitGraph:
             if True the commit messages are displayed too
         sha_one_digits : int
             number of digits to use for showing sha1
+        unlabeled_as_points : boolean
+            if True commits without refs are drawn as points without a label
+        rank_hints : boolean
+            if True commits of the same generation are put on the same rank
+        contains : string
+            SHA1 of a commit to mark, highlighting all refs containing it
 
         Returns
         -------
@@ -1056,41 +3469,57 @@ class CommitGraph:
             lines of the graphviz input
         """
 
-        def format_sha_one(sha_one):
-            """Shorten sha1 if required."""
-            if (sha_one_digits is None) or (sha_one_digits == 40):
-                return sha_one
-            else:
-                return sha_one[0:sha_one_digits]
-
-        def format_label(sha_one):
-            if with_commit_messages:
-                output = self.git(["git", "log", "-1", "--pretty=format:%s", sha_one])
-                message = output[0].replace('"', "").replace("'", "")
-                return format_sha_one(sha_one) + "\n" + message
-            else:
-                return format_sha_one(sha_one)
-
-        def label_gen():
-            keys = set(self.branches.keys()).union(set(self.tags.keys()))
-            for k in (k for k in keys if k in self.parents or k in self.children):
-                labels = []
-                case = 0
-                if k in self.tags:
-                    case += 1
-                    labels.extend(sorted(self.tags[k]))
-                if k in self.branches:
-                    case += 2
-                    labels.extend(sorted(self.branches[k]))
-                # http://www.graphviz.org/doc/info/colors.html
-                color = "/pastel13/%d" % case
-                yield (k, labels, color)
-
         dot_file_lines = ["digraph {"]
         if history_direction is not None:
             rankdir = RANKDIR_OF_HISTORY_DIRECTION[history_direction]
             dot_file_lines.append(f'\trankdir="{rankdir}";')
-        for sha_one, labels, color in sorted(label_gen()):
+        dot_file_lines.extend(
+            "\t" + statement
+            for statement in self._generate_dot_statements(
+                sha_ones_on_labels,
+                with_commit_messages,
+                sha_one_digits=sha_one_digits,
+                unlabeled_as_points=unlabeled_as_points,
+                rank_hints=rank_hints,
+                contains=contains,
+            )
+        )
+        dot_file_lines.append("}")
+        return dot_file_lines
+
+    def _generate_dot_statements(
+        self,
+        sha_ones_on_labels,
+        with_commit_messages,
+        sha_one_digits=None,
+        unlabeled_as_points=False,
+        rank_hints=False,
+        contains=None,
+        node_id_prefix="",
+    ):
+        """Generate the node and edge statements of graphviz input.
+
+        See _generate_dot_file for the parameters. Node ids are prefixed
+        with node_id_prefix, so that multiple graphs can share a DOT file.
+
+        Returns
+        -------
+        statements : list of strings
+            the statements, without indentation
+        """
+
+        def format_label(sha_one):
+            return self._format_label(sha_one, with_commit_messages, sha_one_digits)
+
+        highlighted = self.commits_containing(contains) if contains is not None else set()
+        statements = []
+        shape = ""
+        if unlabeled_as_points:
+            statements.append("node[shape=point];")
+            shape = ", shape=ellipse"
+        for sha_one, labels, case in sorted(self._label_gen()):
+            # http://www.graphviz.org/doc/info/colors.html
+            color = "/pastel13/%d" % case
             label = "\\n".join(
                 labels
                 + (
@@ -1102,59 +3531,614 @@ class CommitGraph:
                 )
             )
             label = label.replace('"', '\\"')
-            dot_file_lines.append(
-                f'\t"{sha_one}"[label="{label}", color="{color}", style=filled];'
+            colors = f'color="{color}"'
+            if sha_one in highlighted:
+                colors = (
+                    f'color="{HIGHLIGHT_COLOR}", fillcolor="{color}"'
+                    f", penwidth={HIGHLIGHT_PEN_WIDTH}"
+                )
+            statements.append(
+                f'"{node_id_prefix}{sha_one}"[label="{label}", {colors}, style=filled{shape}];'
             )
+        if contains in highlighted:
+            statements.append(f'"{node_id_prefix}{contains}"[peripheries=2];')
         for sha_one in self.dotdot:
-            dot_file_lines.append(f'\t"{sha_one}"[label="..."];')
-        if (sha_one_digits is not None) and (sha_one_digits != 40):
+            statements.append(f'"{node_id_prefix}{sha_one}"[label="..."{shape}];')
+        if (
+            (sha_one_digits is not None)
+            and (sha_one_digits != self.object_id_digits)
+            and not unlabeled_as_points
+        ):
             for sha_one in (
                 e for e in self.parents.keys() if not (self._has_label(e) or e in self.dotdot)
             ):
                 sha_label = format_label(sha_one)
-                dot_file_lines.append(f'\t"{sha_one}"[label="{sha_label}"];')
-        for child, self.parents in self.parents.items():
-            for p in sorted(self.parents):
-                dot_file_lines.append(f'\t"{child}" -> "{p}";')
-        dot_file_lines.append("}")
-        return dot_file_lines
+                statements.append(f'"{node_id_prefix}{sha_one}"[label="{sha_label}"];')
+        if rank_hints:
+            for layer in self._generations():
+                if len(layer) > 1:
+                    same_rank = " ".join(f'"{node_id_prefix}{sha_one}";' for sha_one in layer)
+                    statements.append(f"{{rank=same; {same_rank}}}")
+        for child, parents in self.parents.items():
+            for p in sorted(parents):
+                statements.append(f'"{node_id_prefix}{child}" -> "{node_id_prefix}{p}";')
+        return statements
+
+    def _export_ids(self):
+        """Assign ids to the commits of the graph, for export.
+
+        Commits of the parent map come first, in order, followed by the
+        sorted parents missing from it.
+
+        Returns
+        -------
+        sha_ones : list of strings
+            the commits, by id
+        id_of_sha_one : dict mapping strings to ints
+            the id of each commit
+        """
+        sha_ones = list(self.parents)
+        id_of_sha_one = {sha_one: i for i, sha_one in enumerate(sha_ones)}
+        outside = {p for parents in self.parents.values() for p in parents} - id_of_sha_one.keys()
+        for p in sorted(outside):
+            id_of_sha_one[p] = len(sha_ones)
+            sha_ones.append(p)
+        return sha_ones, id_of_sha_one
+
+    def _export_parent_ids(self, sha_one, id_of_sha_one):
+        """Get the ids of the parents of a commit, in the order of their sha1s."""
+        parents = self.parents.get(sha_one, ())
+        return [id_of_sha_one[p] for p in (sorted(parents) if len(parents) > 1 else parents)]
+
+    def _export_nodes(self, with_commit_messages, sha_ones, id_of_sha_one):
+        """Generate the commits of the graph with ids assigned by _export_ids.
+
+        Subjects are fetched for SUBJECTS_PER_GIT_LOG commits at a time, as
+        the nodes are generated.
+
+        Yields
+        ------
+        (node_id, sha_one, branches, tags, subject, parent_ids)
+
+        node_id : int
+            the position of the commit, starting at 0
+        sha_one : string
+            the commit
+        branches, tags : list of strings
+            the sorted names of the refs pointing to the commit
+        subject : string
+            the subject line of the commit, None unless requested
+        parent_ids : list of ints
+            the ids of the parents, in the order of their sha1s
+        """
+        subjects = {}
+        no_refs = ()
+        for node_id, sha_one in enumerate(sha_ones):
+            if with_commit_messages and node_id % SUBJECTS_PER_GIT_LOG == 0:
+                # NOTE: Commits beyond the boundary of a shallow clone are missing
+                subjects = self.git.get_subjects(
+                    [
+                        e
+                        for e in sha_ones[node_id : node_id + SUBJECTS_PER_GIT_LOG]
+                        if e not in self.dotdot
+                    ]
+                )
+            branches = self.branches.get(sha_one, no_refs)
+            tags = self.tags.get(sha_one, no_refs)
+            yield (
+                node_id,
+                sha_one,
+                sorted(branches) if branches else [],
+                sorted(tags) if tags else [],
+                subjects.get(sha_one),
+                self._export_parent_ids(sha_one, id_of_sha_one),
+            )
+
+    def _export_jsonl(self, out, with_commit_messages):
+        """Write the graph to binary file out as JSON Lines.
+
+        A header record with node and edge counts comes first, followed
+        by one record per commit and then one record per edge, from child
+        to parent. Ref lists are omitted if empty, subjects unless requested.
+        Records are written as they are generated.
+        """
+        sha_ones, id_of_sha_one = self._export_ids()
+        header = {"type": "graph", "nodes": len(sha_ones), "edges": self.edge_count}
+        out.write(json.dumps(header).encode("utf-8") + b"\n")
+        for node_id, sha_one, branches, tags, subject, _ in self._export_nodes(
+            with_commit_messages, sha_ones, id_of_sha_one
+        ):
+            line = f'{{"type": "node", "id": {node_id}, "sha1": "{sha_one}"'
+            if branches:
+                line += f', "branches": {json.dumps(branches)}'
+            if tags:
+                line += f', "tags": {json.dumps(tags)}'
+            if subject is not None:
+                line += f', "subject": {json.dumps(subject)}'
+            out.write((line + "}\n").encode("utf-8"))
+        for node_id, sha_one in enumerate(sha_ones):
+            for parent_id in self._export_parent_ids(sha_one, id_of_sha_one):
+                out.write(f'{{"type": "edge", "from": {node_id}, "to": {parent_id}}}\n'.encode())
+
+    def _export_binary(self, out, with_commit_messages):
+        """Write the graph to binary file out in compact binary form.
+
+        The file starts with BINARY_EXPORT_MAGIC, a version byte, a byte
+        holding the number of bytes per object id and the varint node
+        count. Each node follows as its raw object id, a flags byte (1:
+        has branches, 2: has tags, 4: has subject), varint counts and
+        strings of branches and tags, the subject string and the varint
+        count of parents. Parents are given by their zigzag varint id
+        relative to the id of the node, which is usually small.
+        Strings are encoded as varint byte length followed by UTF-8.
+        Nodes are written as they are generated.
+        """
+        sha_ones, id_of_sha_one = self._export_ids()
+        object_id_size = self.object_id_digits // 2
+        out.write(BINARY_EXPORT_MAGIC + bytes([BINARY_EXPORT_VERSION, object_id_size]))
+        out.write(encode_varint(len(sha_ones)))
+        for node_id, sha_one, branches, tags, subject, parent_ids in self._export_nodes(
+            with_commit_messages, sha_ones, id_of_sha_one
+        ):
+            flags = (branches and 1 or 0) | (tags and 2 or 0) | (subject is not None and 4 or 0)
+            chunks = [bytes.fromhex(sha_one), bytes([flags])]
+            for names in (branches, tags):
+                if names:
+                    chunks.append(encode_varint(len(names)))
+                    chunks.extend(encode_string(name) for name in names)
+            if subject is not None:
+                chunks.append(encode_string(subject))
+            chunks.append(encode_varint(len(parent_ids)))
+            chunks.extend(encode_zigzag_varint(parent_id - node_id) for parent_id in parent_ids)
+            out.write(b"".join(chunks))
+
+    def _generations(self):
+        """Group commits by generation number.
+
+        The generation number of a commit is the length of the longest path
+        down to a root commit, so every commit has a higher generation number
+        than all of its parents. Parents outside of the graph are ignored.
+
+        Returns
+        -------
+        layers : list of lists of SHA1s
+            the commits of each generation, starting with the roots
+        """
+        parent_counts = {
+            sha_one: sum(1 for p in parents if p in self.parents)
+            for sha_one, parents in self.parents.items()
+        }
+        generation = {}
+        layers = []
+        to_visit = sorted(sha_one for sha_one, count in parent_counts.items() if count == 0)
+        for sha_one in to_visit:
+            gen = 1 + max(
+                (generation[p] for p in self.parents[sha_one] if p in generation), default=-1
+            )
+            generation[sha_one] = gen
+            if gen == len(layers):
+                layers.append([])
+            layers[gen].append(sha_one)
+            for child in sorted(self.children.get(sha_one, ())):
+                if child in parent_counts:
+                    parent_counts[child] -= 1
+                    if parent_counts[child] == 0:
+                        to_visit.append(child)
+        return layers
+
+    def _layered_layout(self):
+        """Assign commits to layers and order the commits within each layer.
+
+        Commits are layered by generation number (see _generations) so that
+        every commit ends up in a later layer than all of its parents.
+        Crossings are then reduced using a few sweeps of the barycenter
+        heuristic. Long edges are not split up into chains of dummy nodes,
+        which keeps the runtime at O(n log n + e) for n commits and e edges.
+
+        Returns
+        -------
+        layers : list of lists of SHA1s
+            the commits of each generation, in order, starting with the roots
+        """
+        layers = self._generations()
+        position = {}
+
+        def update_positions(layer):
+            for i, sha_one in enumerate(layer):
+                position[sha_one] = (i + 0.5) / len(layer)
+
+        def barycenter(sha_one, neighbours):
+            positions = [position[n] for n in neighbours.get(sha_one, ()) if n in position]
+            return sum(positions) / len(positions) if positions else position[sha_one]
+
+        for layer in layers:
+            update_positions(layer)
+        for _ in range(2):
+            for neighbours, sweep in (
+                (self.parents, layers[1:]),
+                (self.children, reversed(layers[:-1])),
+            ):
+                for layer in sweep:
+                    key_of = {sha_one: barycenter(sha_one, neighbours) for sha_one in layer}
+                    layer.sort(key=key_of.__getitem__)
+                    update_positions(layer)
+
+        return layers
+
+    def _write_svg(
+        self,
+        out,
+        sha_ones_on_labels,
+        with_commit_messages,
+        sha_one_digits=None,
+        history_direction=None,
+        contains=None,
+    ):
+        """Lay out the graph natively and write it as SVG, without Graphviz.
+
+        The SVG is written element by element rather than built in memory.
+        Labels and colors are the same as with _generate_dot_file.
+
+        Parameters
+        ----------
+        out : binary file object
+            where to write the SVG to
+        sha_ones_on_labels : boolean
+            if True show sha1 (or minimal) on labels in addition to ref names
+        with_commit_messages : boolean
+            if True the commit messages are displayed too
+        sha_one_digits : int
+            number of digits to use for showing sha1
+        history_direction : string
+            one of the keys of RANKDIR_OF_HISTORY_DIRECTION
+        contains : string
+            SHA1 of a commit to mark, highlighting all refs containing it
+        """
+        highlighted = self.commits_containing(contains) if contains is not None else set()
+        lines_of = {}
+        fill_of = {}
+        for sha_one, labels, case in self._label_gen():
+            if with_commit_messages or sha_ones_on_labels:
+                labels = labels + self._format_label(
+                    sha_one, with_commit_messages, sha_one_digits
+                ).split("\n")
+            lines_of[sha_one] = labels
+            fill_of[sha_one] = PASTEL13_COLORS[case]
+        for sha_one in self.dotdot:
+            lines_of[sha_one] = ["..."]
+        for sha_one in self.parents:
+            if sha_one in lines_of:
+                continue
+            if (sha_one_digits is None) or (sha_one_digits == self.object_id_digits):
+                lines_of[sha_one] = [sha_one]
+            else:
+                lines_of[sha_one] = self._format_label(
+                    sha_one, with_commit_messages, sha_one_digits
+                ).split("\n")
+
+        def node_size(sha_one):
+            lines = lines_of[sha_one]
+            text_width = max(len(line) for line in lines) * SVG_CHAR_WIDTH
+            text_height = len(lines) * SVG_LINE_HEIGHT
+            # NOTE: An ellipse needs about sqrt(2) times the size of the text box to contain it
+            return (
+                text_width * 1.4 + 2 * SVG_NODE_PADDING,
+                text_height * 1.4 + SVG_NODE_PADDING,
+            )
+
+        rankdir = RANKDIR_OF_HISTORY_DIRECTION.get(history_direction, "TB")
+        history_is_horizontal = rankdir in ("LR", "RL")
+        layers = self._layered_layout()
+
+        # Coordinates "u" run along the direction of history, "v" across it
+        size_of = {}
+        layer_thicknesses = []
+        layer_lengths = []
+        for layer in layers:
+            thickness = length = 0
+            for sha_one in layer:
+                width, height = size_of[sha_one] = node_size(sha_one)
+                u_size, v_size = (width, height) if history_is_horizontal else (height, width)
+                thickness = max(thickness, u_size)
+                length += v_size + SVG_NODE_SEPARATION
+            layer_thicknesses.append(thickness)
+            layer_lengths.append(length - SVG_NODE_SEPARATION)
+        max_u = sum(layer_thicknesses) + SVG_RANK_SEPARATION * max(len(layers) - 1, 0)
+        max_v = max(layer_lengths, default=0)
+
+        center_of = {}
+        u = 0
+        for layer, thickness, length in zip(layers, layer_thicknesses, layer_lengths):
+            v = (max_v - length) / 2
+            for sha_one in layer:
+                width, height = size_of[sha_one]
+                v_size = height if history_is_horizontal else width
+                layer_u = u + thickness / 2
+                if rankdir in ("LR", "TB"):
+                    layer_u = max_u - layer_u
+                node_v = v + v_size / 2
+                if history_is_horizontal:
+                    center_of[sha_one] = (SVG_MARGIN + layer_u, SVG_MARGIN + node_v)
+                else:
+                    center_of[sha_one] = (SVG_MARGIN + node_v, SVG_MARGIN + layer_u)
+                v += v_size + SVG_NODE_SEPARATION
+            u += thickness + SVG_RANK_SEPARATION
+
+        if history_is_horizontal:
+            svg_width, svg_height = max_u, max_v
+        else:
+            svg_width, svg_height = max_v, max_u
+        svg_width += 2 * SVG_MARGIN
+        svg_height += 2 * SVG_MARGIN
+
+        def write(text):
+            out.write(text.encode("utf-8"))
+
+        write(
+            '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{svg_width:.0f}pt"'
+            f' height="{svg_height:.0f}pt" viewBox="0 0 {svg_width:.2f} {svg_height:.2f}">\n'
+            "<defs>\n"
+            '<marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5"'
+            ' markerWidth="7" markerHeight="7" orient="auto">\n'
+            '<path d="M 0 0 L 10 5 L 0 10 z"/>\n'
+            "</marker>\n"
+            "</defs>\n"
+            f'<g font-family="Times,serif" font-size="{SVG_FONT_SIZE}" text-anchor="middle">\n'
+        )
+
+        def clip(sha_one, dx, dy):
+            """Find how far to go along (dx, dy) from the center to leave the ellipse."""
+            width, height = size_of[sha_one]
+            return 1 / (((2 * dx / width) ** 2 + (2 * dy / height) ** 2) ** 0.5)
+
+        for layer in layers:
+            for child in layer:
+                child_x, child_y = center_of[child]
+                for p in sorted(self.parents[child]):
+                    if p not in center_of:
+                        continue
+                    parent_x, parent_y = center_of[p]
+                    dx, dy = parent_x - child_x, parent_y - child_y
+                    if dx == dy == 0:
+                        continue
+                    t_child, t_parent = clip(child, dx, dy), clip(p, dx, dy)
+                    if t_child + t_parent >= 1:
+                        continue
+                    x1, y1 = child_x + dx * t_child, child_y + dy * t_child
+                    x2, y2 = parent_x - dx * t_parent, parent_y - dy * t_parent
+                    write(
+                        f'<line x1="{x1:.2f}" y1="{y1:.2f}" x2="{x2:.2f}" y2="{y2:.2f}"'
+                        ' stroke="black" marker-end="url(#arrow)"/>\n'
+                    )
+
+        for layer in layers:
+            for sha_one in layer:
+                x, y = center_of[sha_one]
+                width, height = size_of[sha_one]
+                fill = fill_of.get(sha_one, "none")
+                stroke = fill_of.get(sha_one, "black")
+                stroke_width = 1
+                if sha_one in highlighted and (sha_one in fill_of or sha_one == contains):
+                    stroke, stroke_width = HIGHLIGHT_COLOR, HIGHLIGHT_PEN_WIDTH
+                lines = lines_of[sha_one]
+                first_line_y = y - (len(lines) - 1) * SVG_LINE_HEIGHT / 2 + SVG_FONT_SIZE / 3
+                write(
+                    f'<g class="node"><title>{sha_one}</title>\n'
+                    f'<ellipse cx="{x:.2f}" cy="{y:.2f}" rx="{width / 2:.2f}"'
+                    f' ry="{height / 2:.2f}" fill="{fill}" stroke="{stroke}"'
+                    + (f' stroke-width="{stroke_width}"' if stroke_width != 1 else "")
+                    + "/>\n"
+                )
+                for i, line in enumerate(lines):
+                    write(
+                        f'<text x="{x:.2f}" y="{first_line_y + i * SVG_LINE_HEIGHT:.2f}">'
+                        f"{xml_escape(line)}</text>\n"
+                    )
+                write("</g>\n")
+
+        write("</g>\n</svg>\n")
+
+
+def check_graph_size(node_count, edge_count, max_nodes, max_edges, policy):
+    """Check the size of a graph against limits before rendering it.
+
+    Reports on stderr if the graph exceeds any limit and aborts execution
+    if the policy is to refuse rendering such graphs.
+
+    Parameters
+    ----------
+    node_count : int
+        number of nodes of the graph to render
+    edge_count : int
+        number of edges of the graph to render
+    max_nodes : int
+        maximum number of nodes to render as usual
+    max_edges : int
+        maximum number of edges to render as usual
+    policy : string
+        one of LARGE_GRAPH_POLICIES
+
+    Returns
+    -------
+    policy : string
+        the policy to apply or None if the graph is within limits
+
+    """
+    if node_count <= max_nodes and edge_count <= max_edges:
+        debug(f"Graph to render has {node_count} nodes and {edge_count} edges")
+        return None
+
+    message = (
+        f"Graph to render has {node_count} nodes (limit: {max_nodes})"
+        f" and {edge_count} edges (limit: {max_edges})"
+    )
+    if policy == "refuse":
+        barf(
+            f"{message}; refusing to render it.\n"
+            "Use '--on-large-graph', '--max-nodes' or '--max-edges' to render it anyway.",
+            EXIT_CODES["graph_too_large"],
+        )
+    consequence = {
+        "warn": "rendering may take very long",
+        "simplify": "removing edges implied by transitivity",
+        "sfdp": 'switching to Graphviz layout engine "sfdp"',
+        "no-labels": "rendering commits without refs as points",
+    }[policy]
+    warn(f"{message}; {consequence}")
+    return policy
 
 
 def innermost_main(opts):
     repo_dir = parse_variable_args(opts.repo_dirs)
     debug("The Git repository is at: '%s'" % repo_dir)
-    graph = graph_factory(repo_dir)
-    output_settings = set_settings(
-        OUTPUT_SETTINGS,
-        OUTPUT_DEFAULTS,
-        graph.git.config(OUTPUT_SETTINGS),
-        parse_output_options(opts),
-    )
-    filter_settings = set_settings(
-        FILTER_SETTINGS,
-        FILTER_DEFAULTS,
-        graph.git.config(FILTER_SETTINGS),
-        parse_filter_options(opts, FILTER_SETTINGS),
-    )
-    annotation_settings = set_settings(
-        ANNOTATION_SETTINGS,
-        ANNOTATION_DEFAULTS,
-        graph.git.config(ANNOTATION_SETTINGS),
-        parse_filter_options(opts, ANNOTATION_SETTINGS),
-    )
-    if opts.all_commits:
-        sha_one_digits = graph._minimal_sha_one_digits()
-    else:
-        sha_one_digits = None
-        graph = graph.filter(**filter_settings)
+    with phase("git preflight"):
+        git = Git(repo_dir)
+    settings = []
+
+    def simplify_by_decoration(git):
+        with phase("config"):
+            settings.append(
+                set_settings(
+                    OUTPUT_SETTINGS,
+                    OUTPUT_DEFAULTS,
+                    git.config(OUTPUT_SETTINGS),
+                    parse_output_options(opts),
+                )
+            )
+            settings.append(
+                set_settings(
+                    FILTER_SETTINGS,
+                    FILTER_DEFAULTS,
+                    git.config(FILTER_SETTINGS),
+                    parse_filter_options(opts, FILTER_SETTINGS),
+                )
+            )
+            settings.append(
+                set_settings(
+                    ANNOTATION_SETTINGS,
+                    ANNOTATION_DEFAULTS,
+                    git.config(ANNOTATION_SETTINGS),
+                    parse_filter_options(opts, ANNOTATION_SETTINGS),
+                )
+            )
+        output_settings, filter_settings, _ = settings
+        # NOTE: Git can reduce history to commits pointed to by refs and root
+        #       commits itself, with the same reachability but without some
+        #       implied edges.  So the result is only the same when these edges
+        #       are removed afterwards and no other commits are of interest,
+        #       neither to look up ancestry nor to tell which commits lie
+        #       between refs.
+        return (
+            output_settings[SIMPLIFY]
+            and output_settings[RENDERER] != "native"
+            and not opts.all_commits
+            and not filter_settings[MERGES]
+            and not filter_settings[BIFURCATIONS]
+            and opts.export_format is None
+            and opts.contains_rev is None
+            and opts.hide_merged_rev is None
+            and not opts.collapse_patterns
+            and not opts.collapse_tag_runs
+            and opts.snapshot_infile is None
+            and opts.snapshot_outfile is None
+        )
+
+    # NOTE: The settings are read while graph_factory decides how to walk history
+    graph = graph_factory(repo_dir, git=git, simplify_by_decoration=simplify_by_decoration)
+    output_settings, filter_settings, annotation_settings = settings
+
+    def resolve_commit(rev):
+        if rev is None:
+            return None
+        try:
+            return graph.git.resolve_commit(rev)
+        except CommandError:
+            barf(f"Could not resolve '{rev}' to a commit.", EXIT_CODES["no_such_revision"])
+
+    contains = resolve_commit(opts.contains_rev)
+    merged_into = resolve_commit(opts.hide_merged_rev)
+    preparation = {
+        "all_commits": bool(opts.all_commits),
+        "filter_settings": filter_settings,
+        "collapse_patterns": opts.collapse_patterns,
+        "collapse_tag_runs": opts.collapse_tag_runs,
+        "min_ref_date": None if opts.ref_max_age is None else int(time.time() - opts.ref_max_age),
+    }
+    snapshot = None
+    if opts.snapshot_infile is not None:
+        snapshot = read_snapshot(opts.snapshot_infile)
+    with phase("filter"):
+        if opts.snapshot_outfile is not None:
+            try:
+                with open(opts.snapshot_outfile, "w") as f:
+                    prepare_graph(graph, merged_into=merged_into, **preparation).write_snapshot(f)
+            except OSError as e:
+                barf(
+                    f"Could not write to file '{opts.snapshot_outfile}':\n>>>{e}",
+                    EXIT_CODES["not_write_to_file"],
+                )
+        additional = [contains] if contains is not None else []
+        if snapshot is not None:
+            graph, changed = graph.diff_snapshot(snapshot)
+            additional.extend(sorted(changed))
+        graph = prepare_graph(graph, additional=additional, merged_into=merged_into, **preparation)
+        if snapshot is not None:
+            # NOTE: Everything else in between has been filtered out already
+            graph = graph.neighbourhood(set(additional))
         sha_one_digits = graph._minimal_sha_one_digits()
 
-    dot_file_lines = graph._generate_dot_file(
-        sha_ones_on_labels=opts.all_commits,
-        with_commit_messages=annotation_settings["messages"],
-        sha_one_digits=sha_one_digits,
-        history_direction=opts.history_direction,
+    no_output_options = opts.export_format is None and not any(
+        output_settings[setting] for setting in (GRAPHVIZ, PROCESSED, VIEWER, OUT_FILE)
     )
+    if contains is not None:
+        output_on_stdout = (
+            output_settings[GRAPHVIZ]
+            or output_settings[PROCESSED]
+            or (opts.export_format is not None and not output_settings[OUT_FILE])
+        )
+        with phase("contains"):
+            list_containing_refs(
+                graph,
+                graph.commits_containing(contains),
+                sys.stderr if output_on_stdout else sys.stdout,
+            )
+    # NOTE: Without any output option, listing refs or saving a snapshot is all
+    #       that is asked for
+    if no_output_options and (contains is not None or opts.snapshot_outfile is not None):
+        return
+
+    submodule_graphs = []
+    if opts.submodules:
+        with phase("submodules"):
+            submodule_graphs = collect_submodule_graphs(graph.git, preparation)
+
+    if opts.export_format is not None:
+        if opts.submodules:
+            barf(
+                "Option '--export' is incompatible with option '--submodules'.",
+                EXIT_CODES["export_others"],
+            )
+        if output_settings[GRAPHVIZ] or output_settings[PROCESSED] or output_settings[VIEWER]:
+            barf(
+                "Option '--export' is incompatible with options '-g | --graphviz'"
+                ", '-p | --processed' and '-v | --viewer'.",
+                EXIT_CODES["export_others"],
+            )
+        export = {"jsonl": graph._export_jsonl, "binary": graph._export_binary}[opts.export_format]
+
+        def write_output(f):
+            export(f, with_commit_messages=annotation_settings["messages"])
+
+        with phase("output write"):
+            if output_settings[OUT_FILE]:
+                debug("Writing export to file: '%s'" % output_settings[OUT_FILE])
+                write_to_file(
+                    output_settings[OUT_FILE], write_output, fsync=output_settings[FSYNC]
+                )
+            else:
+                write_output(sys.stdout.buffer)
+        return
 
     if output_settings[GRAPHVIZ] and output_settings[PROCESSED]:
         barf(
@@ -1182,14 +4166,87 @@ def innermost_main(opts):
             EXIT_CODES["no_options"],
         )
 
-    if output_settings[SIMPLIFY]:
-        dot_file_lines = simplify_using_tred(dot_file_lines).decode("utf-8").split("\n")
+    render_natively = output_settings[RENDERER] == "native" and not output_settings[GRAPHVIZ]
+    if render_natively and output_settings[SIMPLIFY]:
+        barf(
+            "Option '--simplify' is not supported by the native renderer.",
+            EXIT_CODES["not_supported_by_renderer"],
+        )
+    if render_natively and opts.submodules:
+        barf(
+            "Option '--submodules' is not supported by the native renderer.",
+            EXIT_CODES["not_supported_by_renderer"],
+        )
+
+    # guard against graphs that Graphviz would take ages to render
+    large_graph_policy = None
+    if not (output_settings[GRAPHVIZ] or render_natively):
+        large_graph_policy = check_graph_size(
+            len(graph.parents) + sum(len(g.parents) for _, g in submodule_graphs),
+            graph.edge_count + sum(g.edge_count for _, g in submodule_graphs),
+            output_settings[MAX_NODES],
+            output_settings[MAX_EDGES],
+            output_settings[LARGE_GRAPH_POLICY],
+        )
+    if large_graph_policy == "simplify":
+        output_settings[SIMPLIFY] = True
+    layout_engine = "sfdp" if large_graph_policy == "sfdp" else None
+    unlabeled_as_points = large_graph_policy == "no-labels"
+
+    if not render_natively:
+        dot_options = dict(
+            sha_ones_on_labels=opts.all_commits and not unlabeled_as_points,
+            with_commit_messages=annotation_settings["messages"] and not unlabeled_as_points,
+            unlabeled_as_points=unlabeled_as_points,
+            rank_hints=output_settings[RANK_HINTS],
+            contains=contains,
+        )
+
+    # NOTE: Unconnected parts of the graph are laid out in parallel, if asked for
+    component_dot_files_lines = None
+    layout_jobs = output_settings[LAYOUT_JOBS] or os.cpu_count() or 1
+    if not (render_natively or output_settings[GRAPHVIZ] or opts.submodules) and layout_jobs > 1:
+        with phase("components"):
+            components = graph.components()
+        if len(components) > 1:
+            debug(f"Laying out {len(components)} components with {layout_jobs} jobs")
+            with phase("dot generation"):
+                component_dot_files_lines = [
+                    component._generate_dot_file(
+                        sha_one_digits=sha_one_digits,
+                        history_direction=opts.history_direction,
+                        **dot_options,
+                    )
+                    for component in components
+                ]
+
+    if not render_natively and component_dot_files_lines is None:
+        with phase("dot generation"):
+            if opts.submodules:
+                toplevel = graph.git(["git", "rev-parse", "--show-toplevel"])[0]
+                dot_file_lines = generate_clustered_dot_file(
+                    [(os.path.basename(toplevel), graph, sha_one_digits)]
+                    + [(path, g, g._minimal_sha_one_digits()) for path, g in submodule_graphs],
+                    history_direction=opts.history_direction,
+                    **dot_options,
+                )
+            else:
+                dot_file_lines = graph._generate_dot_file(
+                    sha_one_digits=sha_one_digits,
+                    history_direction=opts.history_direction,
+                    **dot_options,
+                )
+
+    if output_settings[SIMPLIFY] and component_dot_files_lines is None:
+        with phase("tred"):
+            dot_file_lines = simplify_using_tred(dot_file_lines).decode("utf-8").split("\n")
 
     # if plain just print dot input to stdout
     if output_settings[GRAPHVIZ]:
         debug("Will now print dot format")
-        for line in dot_file_lines:
-            print(line)
+        with phase("output write"):
+            for line in dot_file_lines:
+                print(line)
         return
     # check for format mismatch between -f and -o
     if output_settings[FORMAT] and output_settings[OUT_FILE]:
@@ -1204,8 +4261,41 @@ def innermost_main(opts):
         if guess is None:
             warn("Filename had no suffix, using format: %s" % output_settings[FORMAT])
             output_settings[OUT_FILE] += "." + output_settings[FORMAT]
-    # run the 'dot' utility
-    dot_output = run_dot(output_settings[FORMAT], dot_file_lines)
+    if render_natively:
+        if output_settings[FORMAT] != "svg":
+            barf(
+                f"Format {output_settings[FORMAT]!r} is not supported by the native renderer"
+                ", only 'svg' is.",
+                EXIT_CODES["not_supported_by_renderer"],
+            )
+
+        # NOTE: Layout happens while writing, so there is no separate rendering phase
+        def write_output(f):
+            graph._write_svg(
+                f,
+                sha_ones_on_labels=opts.all_commits,
+                with_commit_messages=annotation_settings["messages"],
+                sha_one_digits=sha_one_digits,
+                history_direction=opts.history_direction,
+                contains=contains,
+            )
+
+    else:
+        # NOTE: The 'dot' utility writes to the output file or to stdout directly
+        #       rather than through us, so rendering is part of writing, too
+        def write_output(f):
+            if component_dot_files_lines is not None:
+                run_dot_in_parallel(
+                    output_settings[FORMAT],
+                    component_dot_files_lines,
+                    layout_engine,
+                    jobs=layout_jobs,
+                    simplify=output_settings[SIMPLIFY],
+                    out=f,
+                )
+            else:
+                run_dot(output_settings[FORMAT], dot_file_lines, layout_engine, out=f)
+
     # create outfile and possibly view that or a temporary file in viewer
     if output_settings[VIEWER] or output_settings[OUT_FILE]:
         # no output file requested, create a temporary one
@@ -1218,12 +4308,16 @@ def innermost_main(opts):
                 output_settings[OUT_FILE] = temporary_file.name
                 debug("Created temp file: '%s'" % output_settings[OUT_FILE])
             debug("Writing to file: '%s'" % output_settings[OUT_FILE])
-            write_to_file(output_settings[OUT_FILE], dot_output)
+            with phase("output write"):
+                write_to_file(
+                    output_settings[OUT_FILE], write_output, fsync=output_settings[FSYNC]
+                )
             if output_settings[VIEWER]:
                 debug("Will now open file in viewer: '%s'" % output_settings[VIEWER])
                 if temporary_file is not None:
                     wait_until = time.time() + max(0, output_settings[WAIT_SECONDS])
-                show_in_viewer(output_settings[OUT_FILE], output_settings[VIEWER])
+                with phase("viewer"):
+                    show_in_viewer(output_settings[OUT_FILE], output_settings[VIEWER])
                 if temporary_file is not None:
                     # NOTE: The idea is to sleep for WAIT_SECONDS minus the process runtim
                     #       duration.  As a result, for a long-running process we don't wait
@@ -1238,7 +4332,8 @@ def innermost_main(opts):
                 temporary_file.close()  # also removes the file
     elif output_settings[PROCESSED]:
         debug("Will now print dot processed output in format: '%s'" % output_settings[FORMAT])
-        sys.stdout.buffer.write(dot_output)
+        with phase("output write"):
+            write_output(sys.stdout.buffer)
 
 
 def inner_main():
@@ -1249,10 +4344,27 @@ def inner_main():
         DEBUG = True
         debug("Activate debug")
 
-    try:
-        get_command_output(["git", "--help"])
-    except Exception as e:
-        barf("git is either not installed or not on your $PATH:\n>>>%s" % e, EXIT_CODES["no_git"])
+    global TIMINGS, MEMSTATS, PROCESSES, PROGRESS
+    TIMINGS = Timings()
+    PROCESSES = ProcessLog()
+    if opts.memstats_top_count is not None:
+        tracemalloc.start()
+        MEMSTATS = MemStats(opts.memstats_top_count)
+    else:
+        MEMSTATS = None
+    if opts.progress_mode == "always" or (opts.progress_mode == "auto" and sys.stderr.isatty()):
+        PROGRESS = Progress(sys.stderr)
+    else:
+        PROGRESS = None
+
+    with phase("git preflight"):
+        try:
+            get_command_output(["git", "--help"])
+        except Exception as e:
+            barf(
+                "git is either not installed or not on your $PATH:\n>>>%s" % e,
+                EXIT_CODES["no_git"],
+            )
 
     if opts.pstats_outfile is not None:
         import cProfile
@@ -1262,6 +4374,26 @@ def inner_main():
     else:
         innermost_main(opts)
 
+    if PROGRESS is not None:
+        PROGRESS.finish()
+        PROGRESS = None
+    debug("Child processes: %s" % (PROCESSES.summary() or "none"))
+    if opts.timings_format is not None:
+        TIMINGS.report(opts.timings_format)
+        PROCESSES.report(opts.timings_format)
+    if opts.process_log_file is not None:
+        try:
+            with open(opts.process_log_file, "w") as f:
+                PROCESSES.write_records(f)
+        except OSError as e:
+            barf(
+                f"Could not write to file '{opts.process_log_file}':\n>>>{e}",
+                EXIT_CODES["not_write_to_file"],
+            )
+    if MEMSTATS is not None:
+        MEMSTATS = None
+        tracemalloc.stop()
+
 
 def main():
     try:
@@ -19,15 +19,19 @@
 # You should have received a copy of the GNU General Public License
 # along with git-big-picture.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import os
 import shlex
 import shutil as sh
 import sys
 import tempfile as tf
+import threading
+import time
 import unittest as ut
-from io import StringIO
+from io import BytesIO, StringIO
 from textwrap import dedent
-from unittest.mock import patch
+from unittest.mock import Mock, patch
+from xml.etree import ElementTree
 
 from parameterized import parameterized
 
@@ -134,6 +138,229 @@ class RunGraphvizCommandTest(ut.TestCase):
         self.assertEqual(stderr.getvalue(), expected_stderr)
         self.assertEqual(self._exit_value, magic_exit_code)
 
+    def test_output_to_file_descriptor(self):
+        with tf.TemporaryFile() as f:
+            result = gbp.run_graphviz_command(["cat"], ["a", "b"], 0, 0, 0, out=f)
+            f.seek(0)
+
+            self.assertEqual(f.read(), b"a\nb")
+        self.assertIsNone(result)
+
+    def test_output_to_file_object(self):
+        out = BytesIO()
+
+        gbp.run_graphviz_command(["cat"], ["a", "b"], 0, 0, 0, out=out)
+
+        self.assertEqual(out.getvalue(), b"a\nb")
+
+
+class WriteToFileTest(ut.TestCase):
+    def setUp(self):
+        self.directory = tf.mkdtemp(prefix="gbp-testing-", dir="/tmp")
+        self.output_file = os.path.join(self.directory, "out.svg")
+
+    def tearDown(self):
+        sh.rmtree(self.directory)
+
+    def test_replaces_atomically(self):
+        with open(self.output_file, "wb") as f:
+            f.write(b"old")
+        written_to = []
+
+        def write_output(f):
+            written_to.append(f.name)
+            self.assertEqual(os.path.dirname(f.name), self.directory)
+            f.write(b"new")
+
+        gbp.write_to_file(self.output_file, write_output, fsync=True)
+
+        with open(self.output_file, "rb") as f:
+            self.assertEqual(f.read(), b"new")
+        self.assertNotEqual(written_to, [self.output_file])
+        self.assertEqual(os.listdir(self.directory), ["out.svg"])
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(self.output_file).st_mode & 0o777, 0o666 & ~umask)
+
+    def test_keeps_mode(self):
+        with open(self.output_file, "wb") as f:
+            f.write(b"old")
+        os.chmod(self.output_file, 0o640)
+
+        gbp.write_to_file(self.output_file, lambda f: f.write(b"new"))
+
+        self.assertEqual(os.stat(self.output_file).st_mode & 0o777, 0o640)
+
+    def test_follows_symlink(self):
+        target_directory = os.path.join(self.directory, "target")
+        target_file = os.path.join(target_directory, "out.svg")
+        os.mkdir(target_directory)
+        with open(target_file, "wb") as f:
+            f.write(b"old")
+        os.symlink(target_file, self.output_file)
+
+        gbp.write_to_file(self.output_file, lambda f: f.write(b"new"))
+
+        self.assertTrue(os.path.islink(self.output_file))
+        with open(target_file, "rb") as f:
+            self.assertEqual(f.read(), b"new")
+        self.assertEqual(os.listdir(target_directory), ["out.svg"])
+
+    def test_keeps_old_file_on_failure(self):
+        with open(self.output_file, "wb") as f:
+            f.write(b"old")
+
+        def write_output(f):
+            f.write(b"partial")
+            raise OSError("disk full")
+
+        with patch("sys.stderr", StringIO()), self.assertRaises(SystemExit):
+            gbp.write_to_file(self.output_file, write_output)
+
+        with open(self.output_file, "rb") as f:
+            self.assertEqual(f.read(), b"old")
+        self.assertEqual(os.listdir(self.directory), ["out.svg"])
+
+
+class StreamCommandTest(ut.TestCase):
+    def _python(self, code):
+        return [sys.executable, "-c", code]
+
+    def test_chatty_stderr(self):
+        code = "import sys; sys.stderr.write('x' * 1_000_000); print('done')"
+
+        output = b"".join(gbp.stream_command(self._python(code)))
+
+        self.assertEqual(output, b"done\n")
+
+    def test_stdin_and_lines(self):
+        code = "import sys; sys.stdout.write(sys.stdin.read().upper())"
+        stdin_bytes = b"a\n" * 100_000
+
+        lines = list(gbp.stream_command(self._python(code), stdin_bytes=stdin_bytes, lines=True))
+
+        self.assertEqual(lines, ["A"] * 100_000)
+
+    def test_error_keeps_stderr_tail(self):
+        code = "import sys; sys.stderr.write('x' * 1_000_000 + 'tail'); sys.exit(3)"
+
+        with self.assertRaises(gbp.CommandError) as caught:
+            list(gbp.stream_command(self._python(code)))
+
+        self.assertEqual(caught.exception.returncode, 3)
+        self.assertEqual(len(caught.exception.stderr_tail), gbp.STDERR_TAIL_BYTES)
+        self.assertTrue(caught.exception.stderr_tail.endswith(b"tail"))
+        self.assertIn("Return code 3 from command", str(caught.exception))
+
+    def test_timeout(self):
+        code = "import time; time.sleep(60)"
+
+        with self.assertRaises(gbp.CommandTimeoutError):
+            list(gbp.stream_command(self._python(code), timeout=0.1))
+
+    def test_close_early(self):
+        code = "while True: print('y' * 100)"
+
+        with patch("git_big_picture._main.PROCESSES", gbp.ProcessLog()) as processes:
+            output = gbp.stream_command(self._python(code), lines=True)
+            self.assertEqual(next(output), "y" * 100)
+            output.close()
+
+        self.assertLess(processes.records[0]["exit_status"], 0)
+
+
+@ut.skipIf(gbp.numpy is None, "NumPy is not installed")
+class VectorizedCommitGraphTest(_GitRepoTestMixin, ut.TestCase):
+    def assert_same_as_pure_python(self, graph):
+        def classify():
+            graph._commit_arrays = None
+            return (
+                graph.roots,
+                graph.merges,
+                graph.bifurcations,
+                graph._minimal_sha_one_digits(),
+            )
+
+        with patch.object(gbp, "VECTORIZE_MIN_COMMITS", float("inf")):
+            expected = classify()
+        with patch.object(gbp, "VECTORIZE_MIN_COMMITS", 0):
+            actual = classify()
+            self.assertIsNotNone(graph._vectorized())
+        self.assertEqual(actual, expected)
+
+    def test_repository(self):
+        a = empty_commit("a")
+        empty_commit("b")
+        dispatch("git checkout -b other HEAD^")
+        empty_commit("c")
+        dispatch("git merge master")
+        dispatch("git checkout --orphan root")
+        empty_commit("d")
+        graph = gbp.graph_factory(self.testing_dir)
+
+        self.assert_same_as_pure_python(graph)
+        with patch.object(gbp, "VECTORIZE_MIN_COMMITS", 0):
+            self.assertEqual(graph.bifurcations, [a])
+
+    @parameterized.expand(
+        [
+            ("empty", []),
+            ("single", ["0123456789"]),
+            ("prefix of another", ["abc", "abcdef", "abd"]),
+            ("long common prefix", ["0" * 39 + "1", "0" * 39 + "2", "f" * 40]),
+            ("eight digits", ["1234567a", "1234567b", "12345"]),
+        ]
+    )
+    def test_unique_prefix_length(self, _label, sha_ones):
+        parents = {sha_one: set(sha_ones[i + 1 : i + 2]) for i, sha_one in enumerate(sha_ones)}
+        graph = gbp.CommitGraph(parents, {}, {})
+
+        self.assert_same_as_pure_python(graph)
+
+    def test_unique_prefix_length_across_chunks(self):
+        sha_ones = ["%040x" % (i * 0x10001) for i in range(100)]
+        graph = gbp.CommitGraph({sha_one: set() for sha_one in sha_ones}, {}, {})
+
+        with patch.object(gbp, "PREFIX_CHUNK_SIZE", 7):
+            self.assert_same_as_pure_python(graph)
+
+
+@ut.skipIf(gbp.sqlite3 is None, "SQLite is not available")
+class SubjectStoreTest(_GitRepoTestMixin, ut.TestCase):
+    def test_only_missing_subjects_are_read(self):
+        a = empty_commit("a")
+        b = empty_commit("b")
+        git = gbp.Git(self.testing_dir)
+        self.assertEqual(git.get_subjects([a]), {a: "a"})
+
+        with patch.object(git, "_read_subjects", wraps=git._read_subjects) as read_subjects:
+            self.assertEqual(git.get_subjects([a, b]), {a: "a", b: "b"})
+            self.assertEqual(gbp.Git(self.testing_dir).get_subjects([b, a]), {a: "a", b: "b"})
+
+        read_subjects.assert_called_once_with([b])
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(self.testing_dir, ".git", gbp.CACHE_DIR, gbp.SUBJECT_STORE_FILE)
+            )
+        )
+
+    def test_unusable_store_falls_back_to_git(self):
+        a = empty_commit("a")
+        os.makedirs(os.path.join(".git", gbp.CACHE_DIR, gbp.SUBJECT_STORE_FILE))
+
+        self.assertEqual(gbp.Git(self.testing_dir).get_subjects([a]), {a: "a"})
+
+    def test_oldest_subjects_are_dropped(self):
+        filename = os.path.join(self.testing_dir, "store", gbp.SUBJECT_STORE_FILE)
+        store = gbp.SubjectStore(filename, max_entries=2)
+        try:
+            store.put({"a": "first"})
+            store.put({"b": "second", "c": "third"})
+            store.put({"c": "ignored"})
+            self.assertEqual(store.get(["a", "b", "c"]), {"b": "second", "c": "third"})
+        finally:
+            store.close()
+
 
 class SimplificationTest(_GitRepoTestMixin, ut.TestCase):
     def setUp(self):
@@ -172,6 +399,801 @@ class SimplificationTest(_GitRepoTestMixin, ut.TestCase):
         self.assertEqual(actual_edge_count, expected_edge_count)
 
 
+class GraphSizeLimitTest(_GitRepoTestMixin, ut.TestCase):
+    def setUp(self):
+        super().setUp()
+        r"""
+        Now create this graph:
+
+            A---B---C master
+            |   |
+           0.1 0.2
+        """
+        tag(empty_commit("A"), "0.1")
+        tag(empty_commit("B"), "0.2")
+        empty_commit("C")
+
+    def test_refuse(self):
+        opts = gbp.create_parser().parse_args(
+            ["--processed", "--max-nodes=2", "--max-edges=2", "--on-large-graph=refuse"]
+        )
+        expected_stderr = (
+            "fatal: Graph to render has 3 nodes (limit: 2) and 2 edges (limit: 2)"
+            "; refusing to render it.\n"
+            "Use '--on-large-graph', '--max-nodes' or '--max-edges' to render it anyway.\n"
+        )
+
+        with (
+            patch("sys.stderr", StringIO()) as stderr,
+            self.assertRaises(SystemExit) as caught,
+        ):
+            gbp.innermost_main(opts)
+
+        self.assertEqual(caught.exception.code, gbp.EXIT_CODES["graph_too_large"])
+        self.assertEqual(stderr.getvalue(), expected_stderr)
+
+    def test_invalid_config_value_falls_back_to_default(self):
+        dispatch("git config big-picture.largegraph bogus")
+        dispatch("git config big-picture.renderer bogus")
+        opts = gbp.create_parser().parse_args(["--graphviz"])
+
+        with (
+            patch("sys.stdout", StringIO()),
+            patch("sys.stderr", StringIO()) as stderr,
+        ):
+            gbp.innermost_main(opts)
+
+        self.assertEqual(
+            stderr.getvalue().splitlines(),
+            [
+                "warning: Ignoring invalid value 'bogus' of setting big-picture.largegraph,"
+                " expected one of: refuse, warn, simplify, sfdp, no-labels",
+                "warning: Ignoring invalid value 'bogus' of setting big-picture.renderer,"
+                " expected one of: graphviz, native",
+            ],
+        )
+
+    @parameterized.expand([("not a number", "many"), ("negative", "-2")])
+    def test_invalid_layout_jobs(self, _label, value):
+        dispatch(f"git config big-picture.layoutjobs {value}")
+
+        with patch("sys.stderr", StringIO()) as stderr:
+            config = gbp.Git(self.testing_dir).config([gbp.LAYOUT_JOBS])
+        with patch("sys.stderr", StringIO()), self.assertRaises(SystemExit):
+            gbp.create_parser().parse_args([f"--layout-jobs={value}"])
+
+        self.assertEqual(config, {gbp.LAYOUT_JOBS: None})
+        self.assertTrue(
+            stderr.getvalue().startswith(
+                f"warning: Ignoring invalid value {value!r} of setting big-picture.layoutjobs"
+            )
+        )
+
+    @parameterized.expand(
+        [
+            ("within limits", 3, 2, None, ""),
+            ("too many nodes", 2, 2, "sfdp", "3 nodes (limit: 2)"),
+            ("too many edges", 3, 1, "sfdp", "2 edges (limit: 1)"),
+        ]
+    )
+    def test_check_graph_size(self, _label, max_nodes, max_edges, expected_policy, expected_part):
+        with patch("sys.stderr", StringIO()) as stderr:
+            policy = gbp.check_graph_size(3, 2, max_nodes, max_edges, "sfdp")
+
+        self.assertEqual(policy, expected_policy)
+        self.assertIn(expected_part, stderr.getvalue())
+        self.assertEqual(bool(stderr.getvalue()), expected_policy is not None)
+
+    def test_unlabeled_as_points(self):
+        graph = gbp.graph_factory(self.testing_dir).filter()
+
+        dot_file_lines = graph._generate_dot_file(
+            sha_ones_on_labels=False,
+            with_commit_messages=False,
+            sha_one_digits=7,
+            unlabeled_as_points=True,
+        )
+
+        self.assertIn("\tnode[shape=point];", dot_file_lines)
+        self.assertEqual(len([line for line in dot_file_lines if "label=" in line]), 3)
+        self.assertTrue(
+            all("shape=ellipse" in line for line in dot_file_lines if "label=" in line)
+        )
+
+
+class NativeRendererTest(_GitRepoTestMixin, ut.TestCase):
+    def setUp(self):
+        super().setUp()
+        r"""
+        Now create this graph:
+
+            A-------C master
+             \     /
+              B---- topic
+        """
+        self.a = empty_commit("A")
+        dispatch("git checkout -b topic")
+        self.b = empty_commit("B")
+        dispatch("git checkout master")
+        dispatch("git merge --no-ff topic")
+        self.c = get_head_sha()
+
+    def _render(self, extra_argv):
+        opts = gbp.create_parser().parse_args(["--renderer=native", "--processed"] + extra_argv)
+        stdout = Mock()
+        stdout.buffer = BytesIO()
+
+        with patch("sys.stdout", stdout):
+            gbp.innermost_main(opts)
+
+        return ElementTree.fromstring(stdout.buffer.getvalue())
+
+    def test_layered_layout(self):
+        graph = gbp.graph_factory(self.testing_dir)
+
+        self.assertEqual(graph._layered_layout(), [[self.a], [self.b], [self.c]])
+
+    def test_labels_and_edges(self):
+        svg = self._render([])
+
+        ns = {"svg": "http://www.w3.org/2000/svg"}
+        texts = sorted(text.text for text in svg.iterfind(".//svg:text", ns))
+        self.assertEqual(texts, sorted(["master", "topic", self.a[:7]]))
+        self.assertEqual(len(svg.findall(".//svg:ellipse", ns)), 3)
+        self.assertEqual(len(svg.findall(".//svg:line", ns)), 3)
+
+    @parameterized.expand(
+        [
+            ("downwards", 1, +1),
+            ("leftwards", 0, -1),
+            ("rightwards", 0, +1),
+            ("upwards", 1, -1),
+        ]
+    )
+    def test_history_direction(self, history_direction, axis, sign):
+        svg = self._render([f"--history-direction={history_direction}"])
+
+        ns = {"svg": "http://www.w3.org/2000/svg"}
+        center_of = {
+            node.find("svg:title", ns).text: (
+                float(node.find("svg:ellipse", ns).get("cx")),
+                float(node.find("svg:ellipse", ns).get("cy")),
+            )
+            for node in svg.iterfind(".//svg:g[@class='node']", ns)
+        }
+        self.assertGreater(sign * center_of[self.c][axis], sign * center_of[self.b][axis])
+        self.assertGreater(sign * center_of[self.b][axis], sign * center_of[self.a][axis])
+
+    def test_format_not_supported(self):
+        opts = gbp.create_parser().parse_args(["--renderer=native", "--processed", "-f", "png"])
+
+        with (
+            patch("sys.stderr", StringIO()) as stderr,
+            self.assertRaises(SystemExit) as caught,
+        ):
+            gbp.innermost_main(opts)
+
+        self.assertEqual(caught.exception.code, gbp.EXIT_CODES["not_supported_by_renderer"])
+        self.assertEqual(
+            stderr.getvalue(),
+            "fatal: Format 'png' is not supported by the native renderer, only 'svg' is.\n",
+        )
+
+
+class ExportTest(_GitRepoTestMixin, ut.TestCase):
+    def setUp(self):
+        super().setUp()
+        r"""
+        Now create this graph:
+
+            A-------C master
+             \     /
+              B---- topic
+                    0.1
+        """
+        self.a = empty_commit("A")
+        dispatch("git checkout -b topic")
+        self.b = empty_commit("B")
+        tag(self.b, "0.1")
+        dispatch("git checkout master")
+        dispatch("git merge --no-ff -m C topic")
+        self.c = get_head_sha()
+
+    def _export(self, extra_argv):
+        opts = gbp.create_parser().parse_args(extra_argv)
+        stdout = Mock()
+        stdout.buffer = BytesIO()
+
+        with patch("sys.stdout", stdout):
+            gbp.innermost_main(opts)
+
+        return stdout.buffer.getvalue()
+
+    def test_records_are_streamed(self):
+        graph = gbp.graph_factory(self.testing_dir).filter()
+        out = Mock()
+
+        with (
+            patch.object(gbp, "SUBJECTS_PER_GIT_LOG", 1),
+            patch.object(graph.git, "get_subjects", wraps=graph.git.get_subjects) as get_subjects,
+        ):
+            graph._export_jsonl(out, with_commit_messages=True)
+
+        records = [json.loads(c.args[0]) for c in out.write.call_args_list]
+        self.assertEqual(records[0], {"type": "graph", "nodes": 3, "edges": 3})
+        self.assertEqual([record["type"] for record in records[1:]], ["node"] * 3 + ["edge"] * 3)
+        self.assertEqual(
+            [c.args[0] for c in get_subjects.call_args_list], [[self.c], [self.b], [self.a]]
+        )
+
+    @ut.skipIf(gbp.sqlite3 is None, "SQLite is not available")
+    def test_subject_store_is_opened_once(self):
+        graph = gbp.graph_factory(self.testing_dir).filter()
+        get_command_output = gbp.get_command_output
+
+        with (
+            patch.object(gbp, "SUBJECTS_PER_GIT_LOG", 1),
+            patch("git_big_picture._main.get_command_output", wraps=get_command_output) as command,
+            patch.object(gbp, "SubjectStore", wraps=gbp.SubjectStore) as subject_store,
+        ):
+            graph._export_jsonl(Mock(), with_commit_messages=True)
+
+        self.assertEqual(
+            [c.args[0][:2] for c in command.call_args_list].count(["git", "rev-parse"]), 1
+        )
+        subject_store.assert_called_once()
+
+    def test_jsonl(self):
+        output = self._export(["--export=jsonl", "--commit-messages"])
+
+        records = [json.loads(line) for line in output.decode("utf-8").splitlines()]
+        self.assertEqual(records[0], {"type": "graph", "nodes": 3, "edges": 3})
+        nodes = {record["sha1"]: record for record in records if record["type"] == "node"}
+        self.assertEqual(
+            {sha_one: node["subject"] for sha_one, node in nodes.items()},
+            {self.a: "A", self.b: "B", self.c: "C"},
+        )
+        self.assertEqual(nodes[self.c]["branches"], ["master"])
+        self.assertEqual(nodes[self.b]["branches"], ["topic"])
+        self.assertEqual(nodes[self.b]["tags"], ["0.1"])
+        self.assertNotIn("branches", nodes[self.a])
+        edges = {(record["from"], record["to"]) for record in records if record["type"] == "edge"}
+        id_of = {sha_one: node["id"] for sha_one, node in nodes.items()}
+        self.assertEqual(
+            edges,
+            {
+                (id_of[self.c], id_of[self.a]),
+                (id_of[self.c], id_of[self.b]),
+                (id_of[self.b], id_of[self.a]),
+            },
+        )
+
+    def test_binary(self):
+        output = BytesIO(self._export(["--export=binary"]))
+
+        def read_varint():
+            number, shift = 0, 0
+            while True:
+                byte = output.read(1)[0]
+                number |= (byte & 0x7F) << shift
+                shift += 7
+                if byte < 0x80:
+                    return number
+
+        def read_string():
+            return output.read(read_varint()).decode("utf-8")
+
+        self.assertEqual(output.read(5), b"GBP\x01\x14")
+        sha_ones, refs, parents = [], {}, {}
+        for node_id in range(read_varint()):
+            sha_ones.append(output.read(20).hex())
+            flags = output.read(1)[0]
+            self.assertFalse(flags & 4)
+            for flag in (1, 2):
+                if flags & flag:
+                    refs.setdefault(sha_ones[-1], []).extend(
+                        read_string() for _ in range(read_varint())
+                    )
+            zigzags = [read_varint() for _ in range(read_varint())]
+            parents[node_id] = [
+                node_id + (zigzag // 2 if zigzag % 2 == 0 else -(zigzag + 1) // 2)
+                for zigzag in zigzags
+            ]
+        self.assertEqual(output.read(), b"")
+
+        self.assertEqual(sorted(sha_ones), sorted([self.a, self.b, self.c]))
+        self.assertEqual(refs, {self.c: ["master"], self.b: ["topic", "0.1"]})
+        self.assertEqual(
+            {sha_ones[i]: sorted(sha_ones[p] for p in ps) for i, ps in parents.items()},
+            {self.a: [], self.b: [self.a], self.c: sorted([self.a, self.b])},
+        )
+
+    def test_export_others(self):
+        opts = gbp.create_parser().parse_args(["--export=jsonl", "--processed"])
+
+        with (
+            patch("sys.stderr", StringIO()),
+            self.assertRaises(SystemExit) as caught,
+        ):
+            gbp.innermost_main(opts)
+
+        self.assertEqual(caught.exception.code, gbp.EXIT_CODES["export_others"])
+
+
+class SubmodulesTest(_GitRepoTestMixin, ut.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.sub_dir = os.path.join(self.testing_dir, "upstream")
+        dispatch(f"git init -b master {self.sub_dir}")
+        dispatch(
+            f"git -C {self.sub_dir} -c user.name=a -c user.email=a@b"
+            " commit --allow-empty -m S --quiet"
+        )
+        self.sub_head = dispatch(f"git -C {self.sub_dir} rev-parse HEAD").rstrip()
+        dispatch(
+            f"git -c protocol.file.allow=always submodule --quiet add {self.sub_dir} libs/sub"
+        )
+        dispatch("git commit -m A --quiet")
+        self.head = get_head_sha()
+
+    def test_get_submodules(self):
+        git = gbp.Git(self.testing_dir)
+
+        with patch(
+            "git_big_picture._main.get_command_output", wraps=gbp.get_command_output
+        ) as get_command_output:
+            submodules = git.get_submodules()
+
+        self.assertEqual(submodules, [("libs/sub", os.path.join(self.testing_dir, "libs/sub"))])
+        self.assertTrue(
+            all(c.kwargs.get("git_env") == git.env for c in get_command_output.mock_calls)
+        )
+
+    def test_clusters(self):
+        opts = gbp.create_parser().parse_args(["--graphviz", "--submodules"])
+
+        with patch("sys.stdout", StringIO()) as stdout:
+            gbp.innermost_main(opts)
+
+        dot_file_lines = stdout.getvalue().splitlines()
+        self.assertIn('\tsubgraph "cluster_0" {', dot_file_lines)
+        self.assertIn(f'\t\tlabel="{os.path.basename(self.testing_dir)}";', dot_file_lines)
+        self.assertIn('\tsubgraph "cluster_1" {', dot_file_lines)
+        self.assertIn('\t\tlabel="libs/sub";', dot_file_lines)
+        self.assertTrue(
+            any(line.startswith(f'\t\t"libs/sub:{self.sub_head}"[') for line in dot_file_lines)
+        )
+
+    def test_serial_with_memstats(self):
+        preparation = {
+            "all_commits": False,
+            "filter_settings": gbp.FILTER_DEFAULTS,
+            "collapse_patterns": [],
+            "collapse_tag_runs": False,
+        }
+        thread_pool_executor = gbp.concurrent.futures.ThreadPoolExecutor
+        dispatch(
+            f"git -c protocol.file.allow=always submodule --quiet add {self.sub_dir} libs/other"
+        )
+        dispatch("git commit -m B --quiet")
+
+        gbp.tracemalloc.start()
+        try:
+            with (
+                patch.object(gbp, "MEMSTATS", gbp.MemStats(0)),
+                patch("sys.stderr", StringIO()),
+                patch("os.cpu_count", return_value=4),
+                patch.object(
+                    gbp.concurrent.futures, "ThreadPoolExecutor", wraps=thread_pool_executor
+                ) as executor,
+            ):
+                graphs = gbp.collect_submodule_graphs(gbp.Git(self.testing_dir), preparation)
+        finally:
+            gbp.tracemalloc.stop()
+
+        self.assertEqual([path for path, _ in graphs], ["libs/sub", "libs/other"])
+        self.assertEqual({c.kwargs["max_workers"] for c in executor.call_args_list}, {1})
+
+    def test_cache(self):
+        sub_path = os.path.join(self.testing_dir, "libs/sub")
+        cache_dir = os.path.join(self.testing_dir, ".git", gbp.CACHE_DIR)
+        preparation = {
+            "all_commits": False,
+            "filter_settings": gbp.FILTER_DEFAULTS,
+            "collapse_patterns": [],
+            "collapse_tag_runs": False,
+        }
+        graph = gbp.load_submodule_graph(sub_path, cache_dir, preparation)
+
+        with patch("git_big_picture._main.graph_factory", side_effect=AssertionError):
+            cached_graph = gbp.load_submodule_graph(sub_path, cache_dir, preparation)
+        dispatch(f"git -C {sub_path} branch topic")
+        updated_graph = gbp.load_submodule_graph(sub_path, cache_dir, preparation)
+
+        self.assertEqual(cached_graph.parents, graph.parents)
+        self.assertEqual(cached_graph.branches, graph.branches)
+        self.assertEqual(
+            updated_graph.branches[self.sub_head],
+            {"master", "origin/HEAD", "origin/master", "topic"},
+        )
+
+    @parameterized.expand(
+        [
+            ("truncated", '{"key": '),
+            ("not a graph", "[]"),
+            ("missing parents", None),
+            ("wrong types", None),
+        ]
+    )
+    def test_bad_cache_file(self, label, content):
+        sub_path = os.path.join(self.testing_dir, "libs/sub")
+        cache_dir = os.path.join(self.testing_dir, ".git", gbp.CACHE_DIR)
+        preparation = {
+            "all_commits": False,
+            "filter_settings": gbp.FILTER_DEFAULTS,
+            "collapse_patterns": [],
+            "collapse_tag_runs": False,
+        }
+        graph = gbp.load_submodule_graph(sub_path, cache_dir, preparation)
+        (cache_file,) = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if label == "missing parents":
+            del cached["parents"]
+            content = json.dumps(cached)
+        elif label == "wrong types":
+            cached["tags"] = {self.sub_head: "0.1"}
+            content = json.dumps(cached)
+        with open(cache_file, "w") as f:
+            f.write(content)
+
+        reloaded_graph = gbp.load_submodule_graph(sub_path, cache_dir, preparation)
+
+        self.assertEqual(reloaded_graph.parents, graph.parents)
+        self.assertEqual(reloaded_graph.branches, graph.branches)
+        self.assertEqual(reloaded_graph.tags, graph.tags)
+
+    def test_cache_with_ref_max_age(self):
+        sub_path = os.path.join(self.testing_dir, "libs/sub")
+        cache_dir = os.path.join(self.testing_dir, ".git", gbp.CACHE_DIR)
+        preparation = {
+            "all_commits": False,
+            "filter_settings": gbp.FILTER_DEFAULTS,
+            "collapse_patterns": [],
+            "collapse_tag_runs": False,
+        }
+        graph = gbp.load_submodule_graph(sub_path, cache_dir, {**preparation, "min_ref_date": 0})
+
+        with patch("git_big_picture._main.graph_factory", side_effect=AssertionError):
+            cached_graph = gbp.load_submodule_graph(
+                sub_path, cache_dir, {**preparation, "min_ref_date": 1}
+            )
+        stale_graph = gbp.load_submodule_graph(
+            sub_path, cache_dir, {**preparation, "min_ref_date": int(time.time()) + 3600}
+        )
+
+        self.assertEqual(cached_graph.branches, graph.branches)
+        self.assertEqual(stale_graph.branches, {})
+
+
+class CloneTest(_GitRepoTestMixin, ut.TestCase):
+    def setUp(self):
+        super().setUp()
+        r"""
+        Now create this graph in the upstream repository:
+
+            A---B---C master (adding file bar)
+                |
+               0.1
+
+        and tag blob-tag pointing to a blob, and nested-tag pointing to it.
+        """
+        empty_commit("A")
+        self.b = empty_commit("B")
+        tag(self.b, "0.1")
+        with open("bar", "w") as f:
+            f.write("bar")
+        dispatch("git add bar")
+        dispatch("git commit -m C")
+        self.c = get_head_sha()
+        with open("foo", "w") as f:
+            f.write("foo")
+        self.blob = dispatch("git hash-object -w foo").rstrip()
+        dispatch(f'git tag -m "blob-tag" blob-tag {self.blob}')
+        dispatch('git tag -m "nested-tag" nested-tag blob-tag')
+        dispatch("git config uploadpack.allowFilter true")
+        self.clone_dir = os.path.join(self.testing_dir, "clone")
+
+    def _missing_objects(self):
+        return dispatch(f"git -C {self.clone_dir} rev-list --objects --all --missing=print").count(
+            "\n?"
+        )
+
+    def test_partial_clone(self):
+        dispatch(
+            "git clone --quiet --no-checkout --filter=blob:none"
+            f" file://{self.testing_dir} {self.clone_dir}"
+        )
+        missing_objects = self._missing_objects()
+
+        git = gbp.Git(self.clone_dir)
+        (_, _, _), (_, ctags, nctags) = git.get_mappings()
+        with patch.object(gbp.Git, "is_partial_clone") as is_partial_clone:
+            graph = gbp.graph_factory(self.clone_dir)
+        graph.filter()._generate_dot_file(sha_ones_on_labels=True, with_commit_messages=True)
+
+        is_partial_clone.assert_not_called()  # only checked for --debug
+        self.assertTrue(git.is_partial_clone())
+        self.assertFalse(gbp.Git(self.testing_dir).is_partial_clone())
+        self.assertEqual(nctags, {self.blob: {"blob-tag", "nested-tag"}})
+        self.assertEqual(ctags, {self.b: {"0.1"}})
+        self.assertEqual(missing_objects, 1)
+        self.assertEqual(self._missing_objects(), missing_objects)
+
+    def test_partial_clone_without_lazy_fetch_support(self):
+        dispatch(
+            "git clone --quiet --no-checkout --filter=blob:none"
+            f" file://{self.testing_dir} {self.clone_dir}"
+        )
+        missing_objects = self._missing_objects()
+        git = gbp.Git(self.clone_dir)
+        del git.env["GIT_NO_LAZY_FETCH"]  # as ignored by git before 2.39.4
+        (blob,) = git(["git", "rev-parse", "HEAD:bar"])
+
+        with self.assertRaises(gbp.CommandError):
+            git(["git", "cat-file", "-p", blob])
+
+        self.assertEqual(self._missing_objects(), missing_objects)
+
+    def test_shallow_clone(self):
+        dispatch(f"git clone --quiet --depth=1 file://{self.testing_dir} {self.clone_dir}")
+
+        graph = gbp.graph_factory(self.clone_dir)
+        filtered_graph = graph.filter()
+        dot_file_lines = filtered_graph._generate_dot_file(
+            sha_ones_on_labels=False, with_commit_messages=False, sha_one_digits=7
+        )
+
+        self.assertEqual(graph.dotdot, {self.b})
+        self.assertEqual(graph.parents[self.c], {self.b})
+        self.assertEqual(filtered_graph.parents, {self.c: {self.b}, self.b: set()})
+        self.assertIn(f'\t"{self.b}"[label="..."];', dot_file_lines)
+
+    def test_shallow_clone_with_missing_boundary(self):
+        dispatch(f"git clone --quiet --depth=1 file://{self.testing_dir} {self.clone_dir}")
+        with open(os.path.join(self.clone_dir, ".git", "shallow"), "a") as f:
+            f.write(f"{self.b}\n")  # not part of the clone
+
+        shallow_parents = gbp.Git(self.clone_dir).get_shallow_parents()
+
+        self.assertEqual(shallow_parents, {self.c: {self.b}})
+
+    def test_shallow_clone_collapsed(self):
+        dispatch(f"git clone --quiet --depth=1 file://{self.testing_dir} {self.clone_dir}")
+
+        graph = gbp.graph_factory(self.clone_dir).collapse_refs(["origin/*"], tag_runs=True)
+        dot_file_lines = graph.filter()._generate_dot_file(
+            sha_ones_on_labels=False, with_commit_messages=False, sha_one_digits=7
+        )
+
+        self.assertEqual(graph.dotdot, {self.b})
+        self.assertIn(f'\t"{self.b}"[label="..."];', dot_file_lines)
+
+
+class ProgressTest(_GitRepoTestMixin, ut.TestCase):
+    def setUp(self):
+        super().setUp()
+        empty_commit("A")
+        empty_commit("B")
+
+    def run_main(self, argv, isatty=False):
+        stderr = StringIO()
+        stderr.isatty = lambda: isatty
+        with (
+            patch("sys.argv", ["git-big-picture", "--graphviz"] + argv),
+            patch("sys.stdout", StringIO()),
+            patch("sys.stderr", stderr),
+        ):
+            gbp.inner_main()
+        return stderr.getvalue()
+
+    def test_always(self):
+        lines = self.run_main(["--progress=always"]).splitlines()
+
+        self.assertTrue(all(line.startswith("progress: ") for line in lines))
+        self.assertIn("progress: filter: ", "\n".join(lines))
+        self.assertTrue(lines[-1].startswith("progress: output write: "))
+        for counter in ["1 refs loaded", "2 commits parsed", "2 commits filtered"]:
+            self.assertRegex(lines[-1], counter + r" \([\d,]+/s\)")
+
+    def test_auto_on_terminal_rewrites_a_single_line(self):
+        output = self.run_main(["--progress"], isatty=True)
+
+        self.assertNotIn("\n", output)
+        self.assertTrue(output.startswith("\rprogress: git preflight\x1b[K"))
+        self.assertTrue(output.endswith("\r\x1b[K"))
+
+    @parameterized.expand(
+        [
+            ("auto", ["--progress"]),
+            ("off", []),
+        ]
+    )
+    def test_silent_unless_terminal_or_forced(self, _label, argv):
+        self.assertEqual(self.run_main(argv), "")
+        self.assertIsNone(gbp.PROGRESS)
+
+    def test_costs_nothing_when_off(self):
+        items = [1, 2, 3]
+
+        self.assertIs(gbp.progress("items", items), items)
+
+    def test_updates_are_rate_limited(self):
+        stream = StringIO()
+        progress = gbp.Progress(stream)
+
+        with patch.object(gbp, "PROGRESS_INTERVAL_SECONDS", 3600):
+            items = list(progress.iterate("items", range(10), check_every=1))
+
+        self.assertEqual(items, list(range(10)))
+        self.assertRegex(stream.getvalue(), r"^progress: starting: 1 items \([\d,]+/s\)\n$")
+        self.assertEqual(progress.counters["items"][0], 10)
+
+
+class TimingsTest(_GitRepoTestMixin, ut.TestCase):
+    def setUp(self):
+        super().setUp()
+        empty_commit("A")
+
+    @parameterized.expand(
+        [
+            ("default", ["--timings"], "table"),
+            ("table", ["--timings=table"], "table"),
+            ("json", ["--timings=json"], "json"),
+            ("off", [], None),
+        ]
+    )
+    def test_parse_timings_format(self, _label, argv, expected_format):
+        opts = gbp.create_parser().parse_args(argv)
+
+        self.assertEqual(opts.timings_format, expected_format)
+
+    def test_json_lines(self):
+        with (
+            patch("sys.argv", ["git-big-picture", "--graphviz", "--timings=json"]),
+            patch("sys.stdout", StringIO()),
+            patch("sys.stderr", StringIO()) as stderr,
+        ):
+            gbp.inner_main()
+
+        records = [json.loads(line) for line in stderr.getvalue().splitlines()]
+        program_records = [record for record in records if "program" in record]
+        records = [record for record in records if "phase" in record]
+        phases = [record["phase"] for record in records]
+        self.assertEqual(phases[:1], ["git preflight"])
+        self.assertCountEqual(
+            phases[1:5], ["config read", "config", "ref loading", "history walk"]
+        )
+        self.assertEqual(
+            phases[5:],
+            ["graph build", "filter", "dot generation", "output write", "total"],
+        )
+        for record in records[:-1]:
+            self.assertEqual(
+                sorted(record),
+                ["child_cpu_seconds", "concurrent", "cpu_seconds", "phase", "wall_seconds"],
+            )
+            self.assertEqual(record["cpu_seconds"] is None, record["concurrent"])
+        self.assertGreaterEqual(
+            records[-1]["wall_seconds"], max(record["wall_seconds"] for record in records[:-1])
+        )
+        self.assertEqual([record["program"] for record in program_records], ["git"])
+
+    def test_memstats(self):
+        with (
+            patch("sys.argv", ["git-big-picture", "--graphviz", "--memstats=1"]),
+            patch("sys.stdout", StringIO()),
+            patch("sys.stderr", StringIO()) as stderr,
+        ):
+            gbp.inner_main()
+
+        phase_lines = [
+            line for line in stderr.getvalue().splitlines() if not line.startswith("memstats:  ")
+        ]
+        self.assertEqual(len(phase_lines), 10)
+        self.assertTrue(phase_lines[-1].startswith("memstats: output write: traced "))
+        self.assertIn(" (peak ", phase_lines[-1])
+        self.assertFalse(gbp.tracemalloc.is_tracing())
+
+    def test_concurrent_phases_have_no_cpu_time(self):
+        timings = gbp.Timings()
+        inner_entered = threading.Event()
+        outer_may_end = threading.Event()
+
+        def inner():
+            with timings.phase("inner"):
+                inner_entered.set()
+                outer_may_end.wait()
+
+        with timings.phase("alone"):
+            pass
+        with timings.phase("outer"):
+            thread = threading.Thread(target=inner)
+            thread.start()
+            inner_entered.wait()
+            outer_may_end.set()
+            thread.join()
+
+        self.assertEqual(timings.concurrent, {"outer", "inner"})
+        with patch("sys.stderr", StringIO()) as stderr:
+            timings.report("table")
+        lines = stderr.getvalue().splitlines()
+        self.assertNotIn("n/a", lines[1])
+        self.assertTrue(lines[2].startswith("inner "))
+        self.assertTrue(lines[2].endswith(" n/a       n/a (concurrent)"))
+
+    def test_phases_add_up(self):
+        timings = gbp.Timings()
+
+        for _ in range(2):
+            with timings.phase("phase"):
+                pass
+
+        self.assertEqual(list(timings.phases), ["phase"])
+        with patch("sys.stderr", StringIO()) as stderr:
+            timings.report("table")
+        self.assertEqual(
+            [line.split()[0] for line in stderr.getvalue().splitlines()],
+            ["phase", "phase", "total"],
+        )
+
+
+class ProcessLogTest(_GitRepoTestMixin, ut.TestCase):
+    def setUp(self):
+        super().setUp()
+        empty_commit("A")
+
+    def test_records(self):
+        with patch("git_big_picture._main.PROCESSES", gbp.ProcessLog()) as processes:
+            lines = list(gbp.get_command_output_lines(["git", "rev-list", "HEAD"]))
+            output = gbp.get_command_output(["git", "rev-parse", "HEAD"])
+            gbp.run_graphviz_command(["cat"], ["digraph {", "}"], 0, 0, 0)
+
+        self.assertEqual(
+            [record["argv"] for record in processes.records],
+            [["git", "rev-list", "HEAD"], ["git", "rev-parse", "HEAD"], ["cat"]],
+        )
+        self.assertEqual(
+            [record["bytes_read"] for record in processes.records], [41 * len(lines), 41, 11]
+        )
+        self.assertEqual([record["bytes_written"] for record in processes.records], [0, 0, 11])
+        self.assertEqual([record["exit_status"] for record in processes.records], [0, 0, 0])
+        self.assertEqual(output, lines[0] + "\n")
+        self.assertEqual(processes.summary().split(" (")[0], "2 git processes")
+        self.assertEqual(list(processes.totals()), ["git", "cat"])
+
+    def test_process_log_file(self):
+        process_log_file = os.path.join(self.testing_dir, "process-log.jsonl")
+
+        with (
+            patch("sys.argv", ["git-big-picture", "-g", f"--process-log={process_log_file}"]),
+            patch("sys.stdout", StringIO()),
+        ):
+            gbp.inner_main()
+
+        with open(process_log_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records[0]["argv"], ["git", "--help"])
+        self.assertTrue(all(record["argv"][0] == "git" for record in records))
+        self.assertTrue(
+            all(
+                sorted(record)
+                == ["argv", "bytes_read", "bytes_written", "exit_status", "wall_seconds"]
+                for record in records
+            )
+        )
+
+
 class TestGitTools(_GitRepoTestMixin, ut.TestCase):
     @property
     def graph(self):
@@ -239,6 +1261,37 @@ class TestGitTools(_GitRepoTestMixin, ut.TestCase):
         self.assertEqual(set(graph.merges), {d})
         self.assertEqual(set(graph.bifurcations), {a})
 
+    def test_get_parent_map_shares_ids(self):
+        a = empty_commit("a")
+        b = empty_commit("b")
+        parents = gbp.Git(self.testing_dir).get_parent_map()
+
+        self.assertEqual(parents, {a: set(), b: {a}})
+        (parent,) = parents[b]
+        self.assertIs(parent, next(k for k in parents if k == a))
+
+    def test_sha256(self):
+        try:
+            dispatch("git init -q -b master --object-format=sha256 sha256")
+        except gbp.CommandError:
+            self.skipTest("Git does not support SHA-256 repositories")
+        os.chdir("sha256")
+        dispatch("git config user.name git-big-picture")
+        dispatch("git config user.email git-big-picture@example.org")
+        a = empty_commit("a")
+        b = empty_commit("b")
+        tag(a, "v1")
+
+        git = gbp.Git(".")
+        graph = gbp.graph_factory(".")
+
+        self.assertEqual((git.object_format, git.object_id_digits), ("sha256", 64))
+        self.assertEqual(len(b), 64)
+        self.assertEqual(graph.parents, {a: set(), b: {a}})
+        self.assertEqual(graph.object_id_digits, 64)
+        self.assertEqual(graph._minimal_sha_one_digits(), 7)
+        self.assertEqual(graph._format_sha_one(b, 64), b)
+
     def test_get_parent_map(self):
         r"""Check get_parent_map() works:
 
@@ -263,6 +1316,570 @@ class TestGitTools(_GitRepoTestMixin, ut.TestCase):
         }
         self.assertEqual(gbp.Git(self.testing_dir).get_parent_map(), expected_parents)
 
+    def test_get_mappings(self):
+        """Check get_mappings() classifies all kinds of refs."""
+        a = empty_commit("a")
+        dispatch('git branch "single\'tick"')
+        dispatch("git update-ref refs/remotes/origin/feature HEAD")
+        dispatch("git update-ref refs/stash HEAD")
+        dispatch("git tag lightweight")
+        dispatch("git tag -m annotated annotated")
+        dispatch("git tag -m nested nested annotated")
+
+        (lb, rb, ab), (tags, ctags, nctags) = gbp.Git(self.testing_dir).get_mappings()
+
+        self.assertEqual(lb, {a: {"master", "single'tick"}})
+        self.assertEqual(rb, {a: {"origin/feature"}})
+        self.assertEqual(ab, {a: {"master", "single'tick", "origin/feature"}})
+        self.assertEqual(tags, {a: {"lightweight", "annotated", "nested"}})
+        self.assertEqual(ctags, tags)
+        self.assertEqual(nctags, {})
+
+    def test_rank_hints(self):
+        r"""
+        Create this graph:
+
+            A---B master
+             \
+              C topic
+        """
+        a = empty_commit("A")
+        b = empty_commit("B")
+        dispatch(f"git checkout -b topic {a}")
+        c = empty_commit("C")
+        graph = gbp.graph_factory(self.testing_dir)
+
+        self.assertEqual(graph._generations(), [[a], sorted([b, c])])
+        dot_file_lines = graph._generate_dot_file(
+            sha_ones_on_labels=False, with_commit_messages=False, rank_hints=True
+        )
+        self.assertEqual(
+            [line for line in dot_file_lines if "rank=same" in line],
+            ['\t{rank=same; "%s"; "%s";}' % tuple(sorted([b, c]))],
+        )
+
+    def test_collapse_patterns(self):
+        a = empty_commit("A")
+        tag(a, "nightly-1")
+        tag(a, "keep")
+        b = empty_commit("B")
+        tag(b, "nightly-2")
+        dispatch("git branch ticket-1")
+        c = empty_commit("C")
+        graph = gbp.graph_factory(self.testing_dir)
+
+        collapsed = graph.collapse_refs(["nightly-*", "ticket-*"])
+
+        self.assertEqual(collapsed.tags, {a: {"keep"}, b: {"nightly-* (2 tags)"}})
+        self.assertEqual(collapsed.branches, {b: {"ticket-1"}, c: {"master"}})
+        self.assertEqual(graph.tags[a], {"keep", "nightly-1"})
+
+    def test_collapse_tag_runs(self):
+        r"""
+        Create this graph:
+
+            A---B---C---D master
+            |   |   |   |
+            v1  v2  v3  v4
+                     \
+                      E topic
+        """
+        a = empty_commit("A")
+        tag(a, "v1")
+        b = empty_commit("B")
+        tag(b, "v2")
+        c = empty_commit("C")
+        tag(c, "v3")
+        d = empty_commit("D")
+        tag(d, "v4")
+        dispatch(f"git checkout -b topic {c}")
+        empty_commit("E")
+        graph = gbp.graph_factory(self.testing_dir)
+
+        collapsed = graph.collapse_refs(tag_runs=True)
+
+        self.assertEqual(collapsed.tags, {c: {"v1 .. v3 (3 tags)"}, d: {"v4"}})
+        self.assertEqual(len(collapsed.filter().parents), 4)
+
+    def test_collapse_tag_runs_across_untagged_commits(self):
+        r"""
+        Create this graph:
+
+            A---x---B---y---z---C---w---D master
+            |       |           |       |
+            n1      n2          n3      n4
+                                 \
+                                  E topic
+        """
+        a = empty_commit("A")
+        tag(a, "n1")
+        empty_commit("x")
+        b = empty_commit("B")
+        tag(b, "n2")
+        empty_commit("y")
+        z = empty_commit("z")
+        c = empty_commit("C")
+        tag(c, "n3")
+        empty_commit("w")
+        d = empty_commit("D")
+        tag(d, "n4")
+        dispatch(f"git checkout -b topic {z}")
+        empty_commit("E")
+        graph = gbp.graph_factory(self.testing_dir)
+
+        collapsed = graph.collapse_refs(tag_runs=True)
+
+        self.assertEqual(collapsed.tags, {b: {"n1 .. n2 (2 tags)"}, c: {"n3"}, d: {"n4"}})
+        dispatch("git checkout master")
+        dispatch("git branch -D topic")
+        graph = gbp.graph_factory(self.testing_dir)
+        self.assertEqual(
+            graph.collapse_refs(tag_runs=True).tags, {c: {"n1 .. n3 (3 tags)"}, d: {"n4"}}
+        )
+
+    def test_simplify_by_decoration(self):
+        r"""
+        Create this graph, with a file added by each commit:
+
+            A---B---X---C---F master
+                 \     /
+                  D---E topic
+                  |   |
+                  v1  v2
+            O---P orphan
+        """
+
+        def commit(name):
+            with open(name, "w") as f:
+                f.write(name)
+            dispatch(f"git add {name}")
+            return empty_commit(name)
+
+        commit("A")
+        commit("B")
+        dispatch("git checkout -b topic")
+        tag(commit("D"), "v1")
+        tag(commit("E"), "v2")
+        dispatch("git checkout master")
+        commit("X")
+        dispatch("git merge --no-ff topic -m C")
+        commit("F")
+        dispatch("git checkout --orphan orphan")
+        dispatch("git rm -r -q --cached .")
+        commit("O")
+        commit("P")
+
+        def reachability(graph):
+            return {sha_one: graph.commits_containing(sha_one) for sha_one in graph.parents}
+
+        expected = gbp.graph_factory(self.testing_dir).filter()
+        reduced_graph = gbp.graph_factory(self.testing_dir, simplify_by_decoration=True)
+        actual = reduced_graph.filter()
+
+        self.assertLess(len(reduced_graph.parents), 9)
+        self.assertEqual(reachability(actual), reachability(expected))
+
+        dispatch("git checkout --orphan empty")
+        dispatch("git rm -r -q --cached .")
+        empty_commit("empty-root")
+
+        fallback_graph = gbp.graph_factory(self.testing_dir, simplify_by_decoration=True)
+
+        self.assertEqual(len(fallback_graph.parents), 10)
+
+    @parameterized.expand(
+        [
+            ("hide merged", ["--hide-merged=master~2"]),
+            ("collapse", ["--collapse=r*"]),
+            ("collapse tag runs", ["--collapse-tag-runs"]),
+        ]
+    )
+    def test_simplify_by_decoration_with_preparation(self, _label, argv):
+        r"""
+        Create this graph:
+
+            1---2---3---4---5---6 master
+            |   |   |       |
+          base old  r1      r2
+
+        with base and old branches and r1 and r2 tags.  Commits have files,
+        so that git does not simplify commits with an empty tree away.
+        """
+
+        def commit(name):
+            with open(name, "w") as f:
+                f.write(name)
+            dispatch(f"git add {name}")
+            return empty_commit(name)
+
+        dispatch(f"git branch base {commit('1')}")
+        dispatch(f"git branch old {commit('2')}")
+        tag(commit("3"), "r1")
+        commit("4")
+        tag(commit("5"), "r2")
+        commit("6")
+        graph_factory = gbp.graph_factory
+
+        def run_main(reduce):
+            def graph_factory_reducing(*args, simplify_by_decoration, **kwargs):
+                def decide(git):
+                    return simplify_by_decoration(git) and reduce
+
+                return graph_factory(*args, simplify_by_decoration=decide, **kwargs)
+
+            opts = gbp.create_parser().parse_args(["--graphviz", "--simplify"] + argv)
+            with (
+                patch("git_big_picture._main.graph_factory", side_effect=graph_factory_reducing),
+                patch(
+                    "git_big_picture._main.simplify_using_tred",
+                    side_effect=lambda lines: "\n".join(lines).encode("utf-8"),
+                ),
+                patch("sys.stdout", StringIO()) as stdout,
+            ):
+                gbp.innermost_main(opts)
+            return stdout.getvalue()
+
+        self.assertEqual(run_main(reduce=True), run_main(reduce=False))
+
+    def test_config_is_read_while_loading_refs(self):
+        empty_commit("A")
+        read_config = gbp.Git.read_config
+        threads = []
+
+        def read_config_recording_thread(git):
+            threads.append(threading.current_thread())
+            return read_config(git)
+
+        opts = gbp.create_parser().parse_args(["--graphviz", "--simplify"])
+        with (
+            patch.object(gbp.Git, "read_config", read_config_recording_thread),
+            patch.object(gbp.Git, "get_parent_map", wraps=None) as get_parent_map,
+            patch("git_big_picture._main.simplify_using_tred", side_effect=lambda lines: b""),
+            patch("sys.stdout", StringIO()),
+        ):
+            get_parent_map.return_value = {}
+            gbp.innermost_main(opts)
+
+        self.assertNotIn(threading.main_thread(), threads)
+        self.assertEqual(get_parent_map.call_args_list[0].args, (True,))
+
+    def test_components(self):
+        r"""
+        Create this graph:
+
+            A---B master    C gh-pages    D---E docs
+        """
+        a = empty_commit("A")
+        b = empty_commit("B")
+        dispatch("git checkout --orphan gh-pages")
+        c = empty_commit("C")
+        dispatch("git checkout --orphan docs")
+        d = empty_commit("D")
+        e = empty_commit("E")
+        tag(d, "v1")
+        graph = gbp.graph_factory(self.testing_dir)
+
+        components = graph.components()
+
+        self.assertCountEqual(
+            [set(component.parents) for component in components], [{a, b}, {c}, {d, e}]
+        )
+        self.assertEqual(len(components[-1].parents), 1)
+        docs = next(component for component in components if d in component.parents)
+        self.assertEqual(docs.branches, {e: {"docs"}})
+        self.assertEqual(docs.tags, {d: {"v1"}})
+        self.assertEqual(docs.parents, {d: set(), e: {d}})
+
+        def fake_graphviz(argv, stdin_lines, *args, out=None, **kwargs):
+            calls.append((argv, stdin_lines))
+            if out is not None:
+                out.write(b"image")
+            return b"laid out"
+
+        calls = []
+        out = BytesIO()
+        with patch("git_big_picture._main.run_graphviz_command", side_effect=fake_graphviz):
+            gbp.run_dot_in_parallel(
+                "png", [["graph 1"], ["graph 2"]], jobs=2, simplify=True, out=out
+            )
+
+        self.assertEqual(out.getvalue(), b"image")
+        self.assertCountEqual(
+            [call for call in calls if call[0][0] in ("tred", "dot")],
+            [
+                (["tred"], ["graph 1"]),
+                (["tred"], ["graph 2"]),
+                (["dot", "-Tdot"], ["laid out"]),
+                (["dot", "-Tdot"], ["laid out"]),
+            ],
+        )
+        self.assertEqual(
+            calls[-2:],
+            [
+                (["gvpack"], ["laid out", "laid out"]),
+                (["neato", "-s", "-n2", "-Tpng"], ["laid out"]),
+            ],
+        )
+
+        opts = gbp.create_parser().parse_args(["--layout-jobs=2", "--processed", "-f", "png"])
+        with (
+            patch("git_big_picture._main.run_dot_in_parallel") as run_dot_in_parallel,
+            patch.object(
+                gbp.CommitGraph,
+                "_generate_dot_file",
+                autospec=True,
+                side_effect=gbp.CommitGraph._generate_dot_file,
+            ) as generate_dot_file,
+        ):
+            gbp.innermost_main(opts)
+
+        self.assertEqual(len(run_dot_in_parallel.call_args.args[1]), 3)
+        self.assertEqual(generate_dot_file.call_count, 3)  # once per component only
+
+    def test_contains(self):
+        r"""
+        Create this graph:
+
+            A---B---C master
+                 \
+                  D topic
+                  |
+                  v1
+        """
+        a = empty_commit("A")
+        b = empty_commit("B")
+        c = empty_commit("C")
+        dispatch(f"git checkout -b topic {b}")
+        d = empty_commit("D")
+        tag(d, "v1")
+        graph = gbp.graph_factory(self.testing_dir).filter(additional=[a])
+
+        self.assertEqual(graph.commits_containing(a), {a, c, d})
+        self.assertEqual(graph.commits_containing(c), {c})
+        self.assertEqual(graph.commits_containing(d), {d})
+        self.assertEqual(graph.commits_containing("0" * 40), set())
+        with patch.object(graph, "children", {}):  # walked once only
+            self.assertEqual(graph.commits_containing(a), {a, c, d})
+        dot_file_lines = graph._generate_dot_file(
+            sha_ones_on_labels=False, with_commit_messages=False, contains=d
+        )
+        self.assertIn(
+            f'\t"{d}"[label="v1\\ntopic", color="red", fillcolor="/pastel13/3", penwidth=3'
+            ", style=filled];",
+            dot_file_lines,
+        )
+        self.assertIn(
+            f'\t"{c}"[label="master", color="/pastel13/2", style=filled];', dot_file_lines
+        )
+        self.assertIn(f'\t"{d}"[peripheries=2];', dot_file_lines)
+
+        with (
+            patch("sys.argv", ["git-big-picture", f"--contains={a}"]),
+            patch("sys.stdout", StringIO()) as stdout,
+        ):
+            gbp.inner_main()
+
+        self.assertEqual(stdout.getvalue(), "master\ntopic\nv1\n")
+
+    def test_hide_merged(self):
+        r"""
+        Create this graph:
+
+            A---B---D master, same
+             \ /
+              C merged
+               \
+                E topic
+        """
+        empty_commit("A")
+        dispatch("git checkout -b merged")
+        c = empty_commit("C")
+        dispatch("git checkout -b topic")
+        e = empty_commit("E")
+        dispatch("git checkout master")
+        dispatch("git merge --no-ff merged")
+        d = empty_commit("D")
+        dispatch("git branch same")
+
+        with (
+            patch("sys.argv", ["git-big-picture", "-g", "--hide-merged"]),
+            patch("sys.stdout", StringIO()) as stdout,
+        ):
+            gbp.inner_main()
+
+        self.assertNotIn(f'"{c}"', stdout.getvalue())
+        self.assertIn(f'\t"{d}"[label="master\\nsame"', stdout.getvalue())
+        self.assertIn(f'\t"{e}"[label="topic"', stdout.getvalue())
+
+        graph = gbp.graph_factory(self.testing_dir).hide_merged(e)
+
+        self.assertEqual(graph.branches, {d: {"master", "same"}, e: {"topic"}})
+
+    def test_save_snapshot_with_hide_merged(self):
+        r"""
+        Create this graph and save a snapshot hiding what is merged into master:
+
+            A---B---D master
+             \ /
+              C merged
+               \
+                E topic
+        """
+        empty_commit("A")
+        dispatch("git checkout -b merged")
+        empty_commit("C")
+        dispatch("git checkout -b topic")
+        e = empty_commit("E")
+        dispatch("git checkout master")
+        dispatch("git merge --no-ff merged")
+        d = empty_commit("D")
+        snapshot_file = os.path.join(self.testing_dir, "snapshot.json")
+
+        with patch(
+            "sys.argv",
+            ["git-big-picture", "--hide-merged", f"--save-snapshot={snapshot_file}"],
+        ):
+            gbp.inner_main()
+
+        snapshot = gbp.read_snapshot(snapshot_file)
+        self.assertEqual(snapshot["branches"], {"master": d, "topic": e})
+
+    def test_ref_max_age(self):
+        r"""
+        Create this graph, with A and B committed long ago:
+
+            A---B---C master
+            |   |
+            v1  old
+            |
+            v1-annotated
+        """
+        with patch.dict(os.environ, GIT_COMMITTER_DATE="2001-01-01T00:00:00Z"):
+            a = empty_commit("A")
+            tag(a, "v1")
+            dispatch(f"git tag -a -m annotated v1-annotated {a}")
+            dispatch("git checkout -b old")
+            b = empty_commit("B")
+            dispatch("git checkout master")
+            dispatch("git merge --ff-only old")
+        c = empty_commit("C")
+        dispatch("git tag -a -m blob blob-tag HEAD:")
+        graph = gbp.graph_factory(self.testing_dir)
+
+        self.assertEqual(graph.commit_dates[a], 978307200)
+        self.assertEqual(graph.commit_dates[b], 978307200)
+
+        fresh = graph.hide_stale_refs(978307201)
+
+        self.assertEqual(fresh.branches, {c: {"master"}})
+        self.assertEqual(list(fresh.tags.values()), [{"blob-tag"}])
+
+        with (
+            patch("sys.argv", ["git-big-picture", "-g", "--ref-max-age=52w"]),
+            patch("sys.stdout", StringIO()) as stdout,
+        ):
+            gbp.inner_main()
+
+        self.assertIn('[label="master"', stdout.getvalue())
+        self.assertNotIn('[label="old"', stdout.getvalue())
+        self.assertNotIn("v1", stdout.getvalue())
+
+    @parameterized.expand(
+        [
+            ("days by default", "90", 90 * 24 * 60 * 60),
+            ("hours", "12h", 12 * 60 * 60),
+            ("weeks", "2w", 2 * 7 * 24 * 60 * 60),
+            ("years", "1y", 365 * 24 * 60 * 60),
+        ]
+    )
+    def test_parse_age(self, _label, text, expected_seconds):
+        self.assertEqual(gbp.parse_age(text), expected_seconds)
+
+    def test_parse_age_invalid(self):
+        with self.assertRaises(gbp.argparse.ArgumentTypeError):
+            gbp.parse_age("3 months")
+
+    def test_diff_snapshot(self):
+        r"""
+        Create this graph, save a snapshot, then move master, delete
+        topic and add tag v2:
+
+            A---B---C---D master
+            |   |   |   |
+            v1  |   |   v2
+                |   feature
+                topic
+        """
+        a = empty_commit("A")
+        tag(a, "v1")
+        b = empty_commit("B")
+        dispatch("git branch topic")
+        c = empty_commit("C")
+        dispatch("git branch feature")
+        dispatch("git branch unrelated")
+        snapshot_file = os.path.join(self.testing_dir, "snapshot.json")
+        with patch("sys.argv", ["git-big-picture", f"--save-snapshot={snapshot_file}"]):
+            gbp.inner_main()
+        d = empty_commit("D")
+        tag(d, "v2")
+        dispatch("git branch -D topic")
+        graph = gbp.graph_factory(self.testing_dir)
+
+        changed_graph, changed = graph.diff_snapshot(gbp.read_snapshot(snapshot_file))
+
+        self.assertEqual(changed, {b, c, d})
+        self.assertEqual(
+            changed_graph.branches,
+            {
+                b: {"topic (deleted)"},
+                c: {"feature", "master (old)", "unrelated"},
+                d: {"master (moved)"},
+            },
+        )
+
+        with (
+            patch("sys.argv", ["git-big-picture", "-g", f"--diff-snapshot={snapshot_file}"]),
+            patch("sys.stdout", StringIO()) as stdout,
+        ):
+            gbp.inner_main()
+
+        self.assertCountEqual(
+            stdout.getvalue().splitlines()[2:-1],
+            [
+                f'\t"{a}"[label="v1", color="/pastel13/1", style=filled];',
+                f'\t"{b}"[label="topic (deleted)", color="/pastel13/2", style=filled];',
+                f'\t"{c}"[label="feature\\nmaster (old)\\nunrelated", color="/pastel13/2"'
+                ", style=filled];",
+                f'\t"{d}"[label="v2 (new)\\nmaster (moved)", color="/pastel13/3", style=filled];',
+                f'\t"{b}" -> "{a}";',
+                f'\t"{c}" -> "{b}";',
+                f'\t"{d}" -> "{c}";',
+            ],
+        )
+
+    @parameterized.expand(
+        [
+            ("missing branches", {"tags": {}, "parents": {}}),
+            ("tags not a dict", {"branches": {}, "tags": [], "parents": {}}),
+            ("parents not lists", {"branches": {}, "tags": {}, "parents": {"a": "b"}}),
+        ]
+    )
+    def test_read_invalid_snapshot(self, _label, content):
+        snapshot_file = os.path.join(self.testing_dir, "snapshot.json")
+        with open(snapshot_file, "w") as f:
+            json.dump(
+                {"format": gbp.SNAPSHOT_FORMAT, "version": gbp.SNAPSHOT_VERSION, **content}, f
+            )
+
+        with (
+            patch("sys.stderr", StringIO()) as stderr,
+            self.assertRaises(SystemExit) as caught,
+        ):
+            gbp.read_snapshot(snapshot_file)
+
+        self.assertEqual(caught.exception.code, gbp.EXIT_CODES["bad_snapshot"])
+        self.assertIn("missing or invalid", stderr.getvalue())
+
     def test_filter_one(self):
         """Remove a single commit from between two commits.
 